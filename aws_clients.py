@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+役割: boto3 クライアントの共有（check_aws_environment.py / manage_passkeys.py / mqtt_test.py 共通）
+- (サービス, リージョン, 認証情報) ごとにクライアントを 1 つだけ作り、プロセス内で使い回す
+- Session 間で botocore のデータローダを共有し、サービス定義・エンドポイント定義の読み込みを 1 回に抑える
+- 接続プール（max_pool_connections）とリトライ（adaptive）を揃えて設定
+- 作成はロックで直列化（boto3 の Session はスレッドセーフでない。作成済みクライアントは共有してよい）
+
+使い方:
+    idp = aws_clients.get_client("cognito-idp", region="ap-northeast-1")
+    s3 = aws_clients.get_client("s3", session=aws_clients.get_session(profile, region))
+
+環境変数:
+    AWS_MAX_POOL_CONNECTIONS  クライアントごとの HTTP 接続プール上限（既定 32）
+    AWS_RETRY_MODE / AWS_MAX_ATTEMPTS  指定時は botocore の既定解決に任せる
+        （~/.aws/config のプロファイルに retry_mode / max_attempts がある場合も同様。どちらも無ければ adaptive / 5）
+"""
+
+import hashlib
+import os
+import threading
+from typing import Any, Dict, Optional
+
+import boto3
+import botocore.session
+from botocore.config import Config
+from botocore.exceptions import ProfileNotFound
+
+MAX_POOL_CONNECTIONS = 32
+RETRY_MODE = "adaptive"
+RETRY_MAX_ATTEMPTS = 5
+
+_lock = threading.RLock()
+_loader = None  # 共有する botocore のデータローダ
+_sessions: Dict[tuple, boto3.Session] = {}
+_clients: Dict[tuple, Any] = {}
+
+
+def _retries_configured(profile: Optional[str]) -> bool:
+    """環境変数、またはプロファイル（~/.aws/config）で retry_mode / max_attempts が指定されているか"""
+    if os.environ.get("AWS_RETRY_MODE") or os.environ.get("AWS_MAX_ATTEMPTS"):
+        return True
+    # get_config_variable は未指定でも既定値（legacy）を返すため、プロファイルの設定そのものを見る
+    try:
+        scoped = botocore.session.Session(profile=profile).get_scoped_config()
+    except ProfileNotFound:
+        return False
+    return "retry_mode" in scoped or "max_attempts" in scoped
+
+
+def _config(profile: Optional[str] = None) -> Config:
+    kwargs: Dict[str, Any] = {
+        "max_pool_connections": int(
+            os.environ.get("AWS_MAX_POOL_CONNECTIONS", str(MAX_POOL_CONNECTIONS))
+        )
+    }
+    # Config の retries は環境変数・プロファイルより優先されるため、どちらにも無い場合だけ指定する
+    if not _retries_configured(profile):
+        kwargs["retries"] = {"mode": RETRY_MODE, "max_attempts": RETRY_MAX_ATTEMPTS}
+    return Config(**kwargs)
+
+
+def _credentials_key(credentials: Optional[Dict[str, str]]) -> Optional[str]:
+    """一時認証情報の識別子（秘密鍵そのものはキーに残さない）"""
+    if not credentials:
+        return None
+    raw = "\0".join(
+        credentials.get(k) or ""
+        for k in ("AccessKeyId", "SecretKey", "SessionToken")
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _new_session(
+    profile: Optional[str], region: Optional[str], credentials: Optional[Dict[str, str]]
+) -> boto3.Session:
+    global _loader
+    core = botocore.session.get_session()
+    if profile and profile not in core.available_profiles:
+        # boto3.Session(profile_name=...) と同じく作成時に検出する
+        raise ProfileNotFound(profile=profile)
+    if _loader is None:
+        _loader = core.get_component("data_loader")
+    else:
+        core.register_component("data_loader", _loader)
+    kwargs: Dict[str, Any] = {"botocore_session": core, "region_name": region}
+    if profile:
+        kwargs["profile_name"] = profile
+    if credentials:
+        kwargs.update(
+            aws_access_key_id=credentials["AccessKeyId"],
+            aws_secret_access_key=credentials["SecretKey"],
+            aws_session_token=credentials.get("SessionToken"),
+        )
+    return boto3.Session(**kwargs)
+
+
+def get_session(
+    profile: Optional[str] = None,
+    region: Optional[str] = None,
+    credentials: Optional[Dict[str, str]] = None,
+) -> boto3.Session:
+    """(プロファイル, リージョン, 認証情報) に対応する共有 Session を返す（ProfileNotFound はそのまま送出）"""
+    key = (profile or None, region or None, _credentials_key(credentials))
+    with _lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _new_session(profile, region, credentials)
+            _sessions[key] = session
+        return session
+
+
+def get_client(
+    service: str,
+    region: Optional[str] = None,
+    profile: Optional[str] = None,
+    credentials: Optional[Dict[str, str]] = None,
+    session: Optional[boto3.Session] = None,
+):
+    """共有クライアントを返す（無ければ作成）
+
+    session を渡した場合はその Session から作る（profile/credentials は無視）。
+    credentials は Cognito Identity の GetCredentialsForIdentity 形式
+    （AccessKeyId / SecretKey / SessionToken）。
+    """
+    with _lock:
+        if session is None:
+            session = get_session(profile, region, credentials)
+        region = region or session.region_name
+        # id(session) の再利用を避けるため Session 自体も値として保持する
+        key = (id(session), service, region)
+        hit = _clients.get(key)
+        if hit is not None:
+            return hit[1]
+        client = session.client(service, region_name=region, config=_config(session.profile_name))
+        _clients[key] = (session, client)
+        return client
+
+
+def clear() -> None:
+    """キャッシュを破棄（認証情報を切り替えた後など）"""
+    with _lock:
+        _clients.clear()
+        _sessions.clear()
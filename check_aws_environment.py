@@ -14,14 +14,36 @@
 import os
 import sys
 import json
+import time
+import hashlib
+import argparse
+import threading
+import csv
+import contextlib
+import multiprocessing
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    ProcessPoolExecutor,
+    wait,
+    as_completed,
+    FIRST_COMPLETED,
+)
 from typing import Dict, Any, List, Optional, Tuple, Set
 from urllib.parse import urlparse
 from datetime import datetime, timezone
 
+try:
+    import fcntl  # POSIX
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
 import boto3
 from botocore.exceptions import ClientError, ProfileNotFound
 from dotenv import load_dotenv
 
+import aws_clients
+
 # ===== .env =====
 load_dotenv(os.environ.get("ENV_FILE") or ".env")
 
@@ -31,10 +53,20 @@ META: Dict[str, Any] = {
     "Account": None,
     "CfnStacks": [],  # [{StackId, StackName, Outputs}]
     "CfnResourceIndex": {},  # {Type: [PhysicalId,...]}
+    "Checks": [],  # [{name, tags, deps, status, seconds}]（run_checks が記録）
+    "Selection": {},  # {tags, skip_tags}
+    "DiscoveryCache": None,  # hit / miss / stale / refresh / off
 }
+# 並列実行中のチェックは結果をスレッドごとのバッファに積む（run_checks が登録順に RESULTS へ）
+_local = threading.local()
 
 
 # ----- helpers -----
+def _sink() -> List[Dict[str, Any]]:
+    buf = getattr(_local, "results", None)
+    return RESULTS if buf is None else buf
+
+
 def _add(
     check: str,
     ok: bool,
@@ -42,7 +74,7 @@ def _add(
     data: Optional[Dict[str, Any]] = None,
     critical: bool = True,
 ):
-    RESULTS.append(
+    _sink().append(
         {
             "check": check,
             "ok": ok,
@@ -53,11 +85,12 @@ def _add(
     )
 
 
-def _skip(check: str, reason: str):
-    RESULTS.append(
+def _skip(check: str, reason: str, blocked: bool = False):
+    """SKIP を記録。blocked は依存チェックの失敗で実行できなかったもの（未確認のため ok にしない）"""
+    _sink().append(
         {
             "check": check,
-            "ok": True,
+            "ok": not blocked,
             "detail": f"SKIP: {reason}",
             "data": {},
             "critical": False,
@@ -69,6 +102,10 @@ def _icon(ok: bool) -> str:
     return "PASS" if ok else "FAIL"
 
 
+def _is_skip(r: Dict[str, Any]) -> bool:
+    return r["detail"].startswith("SKIP:")
+
+
 def _getenv(name: str, default: Optional[str] = None) -> Optional[str]:
     v = os.environ.get(name)
     return v if (v is not None and v != "") else default
@@ -89,17 +126,99 @@ def _same_host(a: Optional[str], b: Optional[str]) -> bool:
     return (_host(a) or "").lower() == (_host(b) or "").lower()
 
 
-def _summarize_and_exit(ctx: Dict[str, str], emit_env_block: Optional[str] = None):
-    print("\n=== Environment Check Summary ===")
-    width = max((len(r["check"]) for r in RESULTS), default=10)
+# ----- streaming (NDJSON) -----
+# OUTPUT_NDJSON（--ndjson）を指定すると、チェックが終わるたびに結果を 1 行 1 JSON で追記する。
+# ファイルへは 1 行を 1 回の write(O_APPEND) で書くため、fan-out の子プロセスが同じファイルへ同時に書いても行は混ざらない
+# （通常ファイルの場合。パイプは PIPE_BUF を超える write が分割されうる）。
+# "-" は標準出力（このとき人向けの表示は標準エラーへ回す）。fan-out では子プロセスは標準出力へ直接書かず、
+# キュー経由で親へ送って親が 1 本のスレッドで書く。
+_ndjson_lock = threading.Lock()
+_ndjson_fd: Dict[int, int] = {}  # pid -> fd（fork 後の子プロセスは自分で開き直す）
+_ndjson_target: Optional[str] = None  # fan-out 時のターゲット名
+_ndjson_queue = None  # fan-out の子プロセスで "-" のとき、親へ行を送るキュー
+
+
+def _ndjson_path() -> Optional[str]:
+    return _getenv("OUTPUT_NDJSON")
+
+
+def _emit(kind: str, **fields):
+    """NDJSON を 1 行出力（未設定なら何もしない）"""
+    path = _ndjson_path()
+    if not path:
+        return
+    rec: Dict[str, Any] = {
+        "type": kind,
+        "ts": datetime.now(timezone.utc).astimezone().isoformat(timespec="milliseconds"),
+    }
+    if _ndjson_target:
+        rec["target"] = _ndjson_target
+    rec.update(fields)
+    line = (json.dumps(rec, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+    if _ndjson_queue is not None:
+        _ndjson_queue.put(line)
+        return
+    _write_ndjson(path, line)
+
+
+def _write_ndjson(path: str, line: bytes):
+    with _ndjson_lock:
+        fd = _ndjson_fd.get(os.getpid())
+        if fd is None:
+            if path == "-":
+                fd = sys.__stdout__.fileno()
+            else:
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            _ndjson_fd[os.getpid()] = fd
+        os.write(fd, line)
+
+
+def _init_ndjson_queue(queue):
+    """fan-out の子プロセス初期化: NDJSON の行を親へ送る"""
+    global _ndjson_queue
+    _ndjson_queue = queue
+
+
+def _relay_ndjson(queue, path: str):
+    """親プロセス: 子から届いた行を順に書く（None で終了）"""
+    for line in iter(queue.get, None):
+        _write_ndjson(path, line)
+
+
+def _emit_unit(unit: Dict[str, Any], status: str):
+    """1 チェック（ユニット）の結果行と、所要時間つきの完了行を出力"""
+    seconds = round(unit.get("seconds", 0.0), 3)
+    for r in unit.get("results") or []:
+        _emit("result", unit=unit["name"], seconds=seconds, **r)
+    _emit(
+        "check",
+        name=unit["name"],
+        tags=list(unit["tags"]),
+        status=status,
+        seconds=seconds,
+        results=len(unit.get("results") or []),
+    )
+
+
+def _print_results(results: List[Dict[str, Any]]) -> bool:
+    """結果一覧を表示し、critical な FAIL があったかを返す"""
+    width = max((len(r["check"]) for r in results), default=10)
     failed_critical = False
-    for r in RESULTS:
-        line = f"[{_icon(r['ok'])}] {r['check']:<{width}} : {r['detail']}"
+    for r in results:
+        icon = "SKIP" if _is_skip(r) else _icon(r["ok"])
+        line = f"[{icon}] {r['check']:<{width}} : {r['detail']}"
         print(line)
         if r["data"]:
             print("        " + json.dumps(r["data"], ensure_ascii=False))
         if not r["ok"] and r.get("critical", True):
             failed_critical = True
+    return failed_critical
+
+
+def _summarize_and_exit(ctx: Dict[str, str], emit_env_block: Optional[str] = None):
+    print("\n=== Environment Check Summary ===")
+    failed_critical = _print_results(RESULTS)
     if emit_env_block:
         print("\n--- Suggested .env (discovered) ---")
         print(emit_env_block)
@@ -112,15 +231,10 @@ def _summarize_and_exit(ctx: Dict[str, str], emit_env_block: Optional[str] = Non
     sys.exit(1 if failed_critical else 0)
 
 
-def _save_json(ctx: Dict[str, str]) -> str:
-    outdir = _getenv("OUTPUT_DIR", ".")
-    base = _getenv("OUTPUT_BASENAME", "envcheck")
-    os.makedirs(outdir, exist_ok=True)
-    now = datetime.now(timezone.utc).astimezone()
-    stamp = now.strftime("%Y%m%d-%H%M%S")
-    path = os.path.join(outdir, f"{base}-{stamp}.json")
-    payload = {
-        "timestamp": now.isoformat(),
+def _report(ctx: Dict[str, str]) -> Dict[str, Any]:
+    """JSON 出力用の 1 ターゲット分のレポート"""
+    return {
+        "timestamp": datetime.now(timezone.utc).astimezone().isoformat(),
         "account": META.get("Account"),
         "region": ctx.get("AWS_REGION"),
         "target_scope": _getenv("TARGET_SCOPE", "all"),
@@ -140,19 +254,33 @@ def _save_json(ctx: Dict[str, str]) -> str:
             "require_cloudfront": _getenv("REQUIRE_CLOUDFRONT", "false"),
             "require_identity_pool": _getenv("REQUIRE_IDENTITY_POOL", "false"),
             "cfn_strict_ownership": _getenv("CFN_STRICT_OWNERSHIP", ""),
+            "cache": META.get("DiscoveryCache"),
         },
         "context": ctx,
         "cfn": {
             "stacks": META.get("CfnStacks"),
             "resource_index": META.get("CfnResourceIndex"),
         },
+        "selection": META.get("Selection"),
+        "checks": META.get("Checks"),
         "results": RESULTS,
     }
+
+
+def _write_json(payload: Dict[str, Any], base: str) -> str:
+    outdir = _getenv("OUTPUT_DIR", ".")
+    os.makedirs(outdir, exist_ok=True)
+    stamp = datetime.now(timezone.utc).astimezone().strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(outdir, f"{base}-{stamp}.json")
     with open(path, "w", encoding="utf-8") as f:
         json.dump(payload, f, ensure_ascii=False, indent=2)
     return path
 
 
+def _save_json(ctx: Dict[str, str]) -> str:
+    return _write_json(_report(ctx), _getenv("OUTPUT_BASENAME", "envcheck"))
+
+
 # ----- CloudFormation discovery & ownership -----
 CFN_TYPES_OF_INTEREST = [
     "AWS::Cognito::UserPool",
@@ -164,19 +292,67 @@ CFN_TYPES_OF_INTEREST = [
 ]
 
 
-def _collect_stack_resources(cfn, stack_id_or_name: str) -> Dict[str, Set[str]]:
-    """Return {Type: set(PhysicalIds)} for one stack."""
+CFN_NESTED_STACK_TYPE = "AWS::CloudFormation::Stack"
+CFN_WORKERS = 8  # スタックリソース取得の並列数
+
+
+def _collect_stack_resources(
+    cfn, stack_id_or_name: str
+) -> Tuple[Dict[str, Set[str]], List[str]]:
+    """Return ({Type: set(PhysicalIds)}, [nested stack ids]) for one stack.
+
+    describe_stack_resources は 100 件で打ち切られるため list_stack_resources を全ページ読む。
+    """
     index: Dict[str, Set[str]] = {t: set() for t in CFN_TYPES_OF_INTEREST}
+    nested: List[str] = []
     try:
-        resp = cfn.describe_stack_resources(StackName=stack_id_or_name)
-        for r in resp.get("StackResources", []):
-            t = r.get("ResourceType")
-            pid = r.get("PhysicalResourceId")
-            if t in index and pid:
-                index[t].add(pid)
+        pager = cfn.get_paginator("list_stack_resources")
+        for page in pager.paginate(StackName=stack_id_or_name):
+            for r in page.get("StackResourceSummaries", []):
+                t = r.get("ResourceType")
+                pid = r.get("PhysicalResourceId")
+                if not pid:
+                    continue
+                if t == CFN_NESTED_STACK_TYPE:
+                    nested.append(pid)  # ネストスタックの ARN
+                elif t in index:
+                    index[t].add(pid)
     except ClientError:
         pass
-    return index
+    return index, nested
+
+
+def _collect_all_stack_resources(cfn, stack_ids: List[str]) -> Dict[str, Set[str]]:
+    """複数スタック（ネストスタックを含む）のリソースを並列に集めて統合"""
+    merged: Dict[str, Set[str]] = {t: set() for t in CFN_TYPES_OF_INTEREST}
+    seen: Set[str] = set()
+    workers = int(_getenv("CFN_WORKERS", str(CFN_WORKERS)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        running = set()
+
+        def submit(sid: str):
+            if sid not in seen:
+                seen.add(sid)
+                running.add(pool.submit(_collect_stack_resources, cfn, sid))
+
+        for sid in stack_ids:
+            submit(sid)
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                running.discard(fut)
+                idx, nested = fut.result()
+                _merge_index(merged, idx)
+                # ネストスタックは見つかった時点で追加投入（深さに関わらず並列）
+                for sid in nested:
+                    submit(sid)
+    return merged
+
+
+def _stack_updated(st: Dict[str, Any]) -> Optional[str]:
+    """スタックの最終更新時刻（未更新なら作成時刻）を ISO 文字列で"""
+    t = st.get("LastUpdatedTime") or st.get("CreationTime")
+    return t.isoformat() if hasattr(t, "isoformat") else t
 
 
 def _merge_index(dst: Dict[str, Set[str]], src: Dict[str, Set[str]]):
@@ -189,7 +365,7 @@ def _merge_index(dst: Dict[str, Set[str]], src: Dict[str, Set[str]]):
 def discover_from_cfn(session: boto3.Session, ctx: Dict[str, str]) -> Dict[str, str]:
     if _getenv("CFN_DISCOVERY", "false").lower() != "true":
         return ctx
-    cfn = session.client("cloudformation")
+    cfn = aws_clients.get_client("cloudformation", session=session)
 
     # 第一優先: 明示のスタックID群
     ids_csv = _getenv("CFN_STACK_IDS", "") or ""
@@ -244,6 +420,7 @@ def discover_from_cfn(session: boto3.Session, ctx: Dict[str, str]) -> Dict[str,
                                 "StackId": sid,
                                 "StackName": sn,
                                 "Outputs": st.get("Outputs", []),
+                                "LastUpdatedTime": _stack_updated(st),
                             }
                         )
         except ClientError:
@@ -260,6 +437,7 @@ def discover_from_cfn(session: boto3.Session, ctx: Dict[str, str]) -> Dict[str,
                             "StackId": st.get("StackId"),
                             "StackName": st.get("StackName"),
                             "Outputs": st.get("Outputs", []),
+                            "LastUpdatedTime": _stack_updated(st),
                         }
                     )
             except ClientError:
@@ -306,10 +484,7 @@ def discover_from_cfn(session: boto3.Session, ctx: Dict[str, str]) -> Dict[str,
             continue
 
     # d) 所有権インデックスを構築
-    merged: Dict[str, Set[str]] = {t: set() for t in CFN_TYPES_OF_INTEREST}
-    for sid in target_ids:
-        idx = _collect_stack_resources(cfn, sid)
-        _merge_index(merged, idx)
+    merged = _collect_all_stack_resources(cfn, target_ids)
     # 保存（JSON出力用）
     META["CfnResourceIndex"] = {k: sorted(list(v)) for k, v in merged.items()}
 
@@ -317,6 +492,125 @@ def discover_from_cfn(session: boto3.Session, ctx: Dict[str, str]) -> Dict[str,
 
 
 # ----- SSM / Tag / CloudFront 逆引き -----
+CF_TAG_WORKERS = 8  # list_tags_for_resource の同時実行数
+
+
+def _find_distribution(
+    cfr,
+    target_dom: Optional[str],
+    tag_key: Optional[str],
+    tag_val: Optional[str],
+    stage: Optional[str],
+) -> Optional[Tuple[str, str]]:
+    """ドメイン/エイリアス一致、なければタグ一致のディストリビューションを探す → (Id, DomainName)
+
+    - ドメイン/エイリアスは一覧の項目だけで判定できるため、タグより優先し一致した時点で終了
+    - タグ（tag_key 指定時）は一覧を読みながら上限付きの並列で取得し、
+      一致が確定したら未実行の取得は取り消す。複数一致時は一覧順で最初のもの
+      （取得の完了順に依らない）
+    """
+    pool = (
+        ThreadPoolExecutor(max_workers=int(_getenv("CF_TAG_WORKERS", str(CF_TAG_WORKERS))))
+        if tag_key
+        else None
+    )
+    futures = []
+
+    def tag_match(d: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+        try:
+            tags = (
+                cfr.list_tags_for_resource(Resource=d.get("ARN"))
+                .get("Tags", {})
+                .get("Items", [])
+            )
+        except ClientError:
+            return None
+        tmap = {t.get("Key"): t.get("Value") for t in tags}
+        if tmap.get(tag_key) == tag_val and (not stage or tmap.get("Stage") == stage):
+            return d.get("Id"), d.get("DomainName")
+        return None
+
+    def first_match_so_far() -> Optional[Tuple[str, str]]:
+        # 一覧順で手前の取得がすべて終わり、一致が確定したものだけ返す
+        for f in futures:
+            if not f.done():
+                return None
+            if f.result():
+                return f.result()
+        return None
+
+    try:
+        pager = cfr.get_paginator("list_distributions")
+        for page in pager.paginate():
+            items = ((page.get("DistributionList") or {}).get("Items")) or []
+            for d in items:
+                dom = d.get("DomainName")
+                aliases = (d.get("Aliases") or {}).get("Items") or []
+                if target_dom and (
+                    target_dom in aliases or _same_host(target_dom, dom)
+                ):
+                    return d.get("Id"), dom
+                if pool:
+                    futures.append(pool.submit(tag_match, d))
+            # ドメインで探す必要がなければ、タグ一致が確定した時点で残りのページは読まない
+            if not target_dom:
+                hit = first_match_so_far()
+                if hit:
+                    return hit
+        for f in futures:
+            if f.result():
+                return f.result()
+        return None
+    finally:
+        if pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+SSM_KEYS = (
+    "Cognito/UserPoolId",
+    "Cognito/AppClientId",
+    "Cognito/IdentityPoolId",
+    "Cognito/RpId",
+    "CloudFront/DistributionId",
+    "CloudFront/DomainName",
+    "S3/Bucket",
+    "IoT/Endpoint",
+    "IoT/ProvisioningTemplate",
+)
+
+
+def _load_ssm_namespace(ssm, ns: str) -> Dict[str, str]:
+    """SSM_NAMESPACE 配下をまとめて読み込み {相対名: 値} を返す。
+
+    get_parameters_by_path（再帰・ページング）で 1 往復〜数往復に抑える。
+    一括取得が失敗した場合（権限不足・途中のページでのスロットリング等）は、
+    取得できなかった SSM_KEYS を 1 件ずつ取得する。
+    """
+    prefix = "/" + ns.strip("/") + "/"
+    values: Dict[str, str] = {}
+    try:
+        pages = ssm.get_paginator("get_parameters_by_path").paginate(
+            Path=prefix.rstrip("/"), Recursive=True
+        )
+        for page in pages:
+            for p in page.get("Parameters", []):
+                name = p.get("Name", "")
+                if name.startswith(prefix):
+                    values[name[len(prefix):]] = p.get("Value")
+        return values
+    except ClientError:
+        pass
+    for rel in SSM_KEYS:
+        if rel in values:
+            continue
+        try:
+            resp = ssm.get_parameter(Name=prefix + rel)
+            values[rel] = resp.get("Parameter", {}).get("Value")
+        except ClientError:
+            pass
+    return values
+
+
 def discover_values(session: boto3.Session, ctx: Dict[str, str]) -> Dict[str, str]:
     region = ctx.get("AWS_REGION") or "ap-northeast-1"
     scope = _getenv("TARGET_SCOPE", "all").lower()
@@ -330,21 +624,16 @@ def discover_values(session: boto3.Session, ctx: Dict[str, str]) -> Dict[str, st
     if _getenv("CFN_DISCOVERY", "false").lower() == "true":
         ctx = discover_from_cfn(session, ctx)
 
-    idp = session.client("cognito-idp")
-    ssm = session.client("ssm") if do_ssm and ssm_ns else None
-    cfr = session.client("cloudfront")
-    cid = session.client("cognito-identity")
+    idp = aws_clients.get_client("cognito-idp", session=session)
+    ssm = aws_clients.get_client("ssm", session=session) if do_ssm and ssm_ns else None
+    cfr = aws_clients.get_client("cloudfront", session=session)
+    cid = aws_clients.get_client("cognito-identity", session=session)
 
     # --- SSM (補完) ---
+    ssm_values = _load_ssm_namespace(ssm, ssm_ns) if ssm else {}
+
     def ssm_get(rel: str) -> Optional[str]:
-        if not ssm:
-            return None
-        name = ssm_ns.rstrip("/") + "/" + rel.lstrip("/")
-        try:
-            resp = ssm.get_parameter(Name=name)
-            return resp.get("Parameter", {}).get("Value")
-        except ClientError:
-            return None
+        return ssm_values.get(rel.strip("/"))
 
     if do_ssm and ssm_ns:
         ctx.setdefault(
@@ -392,44 +681,19 @@ def discover_values(session: boto3.Session, ctx: Dict[str, str]) -> Dict[str, st
         stage = _getenv("DISCOVERY_STAGE")
         try:
             if not dist_id or not dist_domain:
-                pager = cfr.get_paginator("list_distributions")
-                for page in pager.paginate():
-                    items = ((page.get("DistributionList") or {}).get("Items")) or []
-                    for d in items:
-                        did = d.get("Id")
-                        dom = d.get("DomainName")
-                        aliases = [
-                            a for a in ((d.get("Aliases") or {}).get("Items") or [])
-                        ]
-                        target_dom = expected_rp or dist_domain
-                        if target_dom and (
-                            target_dom in aliases or _same_host(target_dom, dom)
-                        ):
-                            ctx["CLOUDFRONT_DISTRIBUTION_ID"] = did
-                            ctx["CLOUDFRONT_DOMAIN_NAME"] = dom
-                            if not expected_rp:
-                                ctx["EXPECTED_RP_ID"] = dom
-                            raise StopIteration
-                        if do_tag and tag_val:
-                            try:
-                                tags = (
-                                    cfr.list_tags_for_resource(Resource=d.get("ARN"))
-                                    .get("Tags", {})
-                                    .get("Items", [])
-                                )
-                                tmap = {t.get("Key"): t.get("Value") for t in tags}
-                                if tmap.get(tag_key) == tag_val and (
-                                    not stage or tmap.get("Stage") == stage
-                                ):
-                                    ctx["CLOUDFRONT_DISTRIBUTION_ID"] = did
-                                    ctx["CLOUDFRONT_DOMAIN_NAME"] = dom
-                                    if not expected_rp:
-                                        ctx["EXPECTED_RP_ID"] = dom
-                                    raise StopIteration
-                            except ClientError:
-                                pass
-        except StopIteration:
-            pass
+                found = _find_distribution(
+                    cfr,
+                    expected_rp or dist_domain,
+                    tag_key if (do_tag and tag_val) else None,
+                    tag_val,
+                    stage,
+                )
+                if found:
+                    did, dom = found
+                    ctx["CLOUDFRONT_DISTRIBUTION_ID"] = did
+                    ctx["CLOUDFRONT_DOMAIN_NAME"] = dom
+                    if not expected_rp:
+                        ctx["EXPECTED_RP_ID"] = dom
         except ClientError:
             pass
 
@@ -460,6 +724,171 @@ def discover_values(session: boto3.Session, ctx: Dict[str, str]) -> Dict[str, st
     return ctx
 
 
+# ----- Discovery cache -----
+# 探索結果（ctx の補完値・CFN スタック/リソース索引・CloudFront ETag）をディスクに保存し、
+# 同じ条件（アカウント/リージョン/探索設定/.env の入力値）での再実行では API 探索を省く。
+# TTL 内でも、スタックの LastUpdatedTime と配信の ETag が変わっていれば破棄して再探索する。
+DISCOVERY_CACHE_FILE = os.path.join(".checks", "discovery-cache.json")
+DISCOVERY_CACHE_TTL = 3600  # 秒
+DISCOVERY_ENV_KEYS = [
+    "TARGET_SCOPE",
+    "DISCOVERY_BY_SSM",
+    "SSM_NAMESPACE",
+    "CFN_DISCOVERY",
+    "CFN_STACK_IDS",
+    "CFN_STACK_NAMES",
+    "CFN_STACK_PREFIX",
+    "CFN_STACK_TAG_KEY",
+    "CFN_STACK_TAG_VALUE",
+    "DISCOVERY_BY_TAG",
+    "DISCOVERY_TAG_KEY",
+    "DISCOVERY_TAG_VALUE",
+    "DISCOVERY_STAGE",
+]
+
+
+def _discovery_cache_key(ctx: Dict[str, str]) -> str:
+    basis = {
+        "account": META.get("Account"),
+        "profile": _getenv("AWS_PROFILE"),
+        "env": {k: _getenv(k, "") for k in DISCOVERY_ENV_KEYS},
+        "ctx": ctx,  # 探索前（.env の入力値）
+    }
+    raw = json.dumps(basis, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _cache_path() -> str:
+    return _getenv("DISCOVERY_CACHE_FILE", DISCOVERY_CACHE_FILE)
+
+
+def _cache_read_all() -> Dict[str, Any]:
+    try:
+        with open(_cache_path(), encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+@contextlib.contextmanager
+def _cache_lock(path: str):
+    """<path>.lock の排他ロックで、キャッシュの読み直し〜書き込みをプロセス間で直列化"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".lock", "a+b") as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass  # LK_LOCK は約 10 秒で諦めるため、取れるまで繰り返す
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _cache_write(key: str, entry: Dict[str, Any]):
+    """エントリを追加して保存（fan-out の並列プロセスが互いの追加を上書きしないようロック中に読み直す）"""
+    path = _cache_path()
+    with _cache_lock(path):
+        data = _cache_read_all()
+        now = time.time()
+        ttl = float(_getenv("DISCOVERY_CACHE_TTL", str(DISCOVERY_CACHE_TTL)))
+        # 期限切れのエントリは掃除
+        data = {k: v for k, v in data.items() if now - v.get("saved_at", 0) < ttl}
+        data[key] = entry
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+
+
+def _distribution_etag(cfr, dist_id: str) -> Optional[str]:
+    try:
+        return cfr.get_distribution_config(Id=dist_id).get("ETag")
+    except ClientError:
+        return None
+
+
+def _stack_unchanged(cfn, stack_id: str, updated: Optional[str]) -> bool:
+    """キャッシュ時から削除・更新されていなければ True"""
+    try:
+        found = cfn.describe_stacks(StackName=stack_id).get("Stacks") or []
+    except ClientError:
+        return False
+    return bool(found) and found[0].get("StackStatus") != "DELETE_COMPLETE" and _stack_updated(found[0]) == updated
+
+
+def _cache_still_valid(session: boto3.Session, entry: Dict[str, Any]) -> bool:
+    """TTL と、スタックの LastUpdatedTime / 配信の ETag で鮮度を確認"""
+    ttl = float(_getenv("DISCOVERY_CACHE_TTL", str(DISCOVERY_CACHE_TTL)))
+    if time.time() - entry.get("saved_at", 0) >= ttl:
+        return False
+    stacks = {s["StackId"]: s.get("LastUpdatedTime") for s in entry.get("cfn_stacks") or []}
+    if stacks:
+        # キャッシュしたスタックだけを StackId で取得（アカウント全体の一覧は引かない）
+        # スタックごとの確認は CFN_WORKERS 本で並列に
+        cfn = aws_clients.get_client("cloudformation", session=session)
+        workers = int(_getenv("CFN_WORKERS", str(CFN_WORKERS)))
+        with ThreadPoolExecutor(max_workers=min(workers, len(stacks))) as pool:
+            if not all(pool.map(lambda item: _stack_unchanged(cfn, *item), stacks.items())):
+                return False
+    dist = entry.get("distribution") or {}
+    if dist.get("Id"):
+        cfr = aws_clients.get_client("cloudfront", session=session)
+        etag = _distribution_etag(cfr, dist["Id"])
+        if etag is None or etag != dist.get("ETag"):
+            return False
+    return True
+
+
+def discover_values_cached(session: boto3.Session, ctx: Dict[str, str]) -> str:
+    """キャッシュがあれば ctx/META に反映し、なければ discover_values して保存
+
+    戻り値は "hit" / "miss" / "stale" / "refresh" / "off"。
+    """
+    if _getenv("DISCOVERY_CACHE", "true").lower() != "true":
+        discover_values(session, ctx)
+        return "off"
+
+    key = _discovery_cache_key(ctx)
+    entry = _cache_read_all().get(key)
+    refresh = _getenv("DISCOVERY_CACHE_REFRESH", "false").lower() == "true"
+    if entry and not refresh and _cache_still_valid(session, entry):
+        ctx.update(entry.get("ctx") or {})
+        META["CfnStacks"] = entry.get("cfn_stacks") or []
+        META["CfnResourceIndex"] = entry.get("cfn_index") or {}
+        return "hit"
+
+    discover_values(session, ctx)
+    dist_id = ctx.get("CLOUDFRONT_DISTRIBUTION_ID")
+    cfr = aws_clients.get_client("cloudfront", session=session)
+    _cache_write(
+        key,
+        {
+            "saved_at": time.time(),
+            "ctx": ctx,
+            "cfn_stacks": META.get("CfnStacks"),
+            "cfn_index": META.get("CfnResourceIndex"),
+            "distribution": (
+                {"Id": dist_id, "ETag": _distribution_etag(cfr, dist_id)}
+                if dist_id
+                else {}
+            ),
+        },
+    )
+    return "refresh" if refresh else "stale" if entry else "miss"
+
+
 # ----- Ownership check helpers -----
 def _ownership_required() -> bool:
     """CFN_STRICT_OWNERSHIP:
@@ -484,84 +913,168 @@ def _belongs(resource_type: str, physical_id: Optional[str]) -> bool:
     return physical_id in allowed if allowed else False
 
 
-# ===== Main checks =====
-def main():
-    # env → ctx
-    profile = _getenv("AWS_PROFILE")
-    region = _getenv("AWS_REGION", "ap-northeast-1")
-    scope = _getenv("TARGET_SCOPE", "all").lower()
+# ===== Check registry / runner =====
+# 各チェックは名前・タグ・依存関係（deps）付きで登録し、依存を満たしたものから
+# スレッドプールで並列実行する。結果の表示順は登録順で固定（実行順に依らない）。
+# 実行対象はタグで絞り込める（CHECK_TAGS / CHECK_SKIP_TAGS、または --tags / --skip-tags）。
+# 絞り込んでも依存先は自動で含める。"meta" タグのチェックは常に実行。
+CHECK_WORKERS = 8
+CHECK_TAGS = ("meta", "discovery", "cognito", "s3", "iot", "cloudfront", "ownership")
+CHECKS: List[Dict[str, Any]] = []  # [{name, fn, deps, tags}]（登録順）
 
-    ctx: Dict[str, str] = {
-        "AWS_REGION": region,
-        "COGNITO_USER_POOL_ID": _getenv("COGNITO_USER_POOL_ID", ""),
-        "COGNITO_APP_CLIENT_ID": _getenv("COGNITO_APP_CLIENT_ID", ""),
-        "COGNITO_USERNAME": _getenv("COGNITO_USERNAME", ""),
-        "COGNITO_USER_POOL_DOMAIN": _getenv("COGNITO_USER_POOL_DOMAIN", ""),
-        "COGNITO_IDENTITY_POOL_ID": _getenv("COGNITO_IDENTITY_POOL_ID", ""),
-        "CLOUDFRONT_DISTRIBUTION_ID": _getenv("CLOUDFRONT_DISTRIBUTION_ID", ""),
-        "CLOUDFRONT_DOMAIN_NAME": _getenv("CLOUDFRONT_DOMAIN_NAME", ""),
-        "EXPECTED_RP_ID": _getenv("EXPECTED_RP_ID", ""),
-        "S3_BUCKET": _getenv("S3_BUCKET", ""),
-        "S3_INDEX_KEY": _getenv("S3_INDEX_KEY", "index.html"),
-        "S3_FAVICON_KEY": _getenv("S3_FAVICON_KEY", "assets/favicon.ico"),
-        "IOT_ENDPOINT": _getenv("IOT_ENDPOINT", ""),
-        "IOT_PROVISIONING_TEMPLATE": _getenv("IOT_PROVISIONING_TEMPLATE", ""),
-    }
 
-    # 必須（最小限）
-    missing = [
-        k
-        for k, v in {
-            "COGNITO_USER_POOL_ID": ctx["COGNITO_USER_POOL_ID"],
-            "COGNITO_APP_CLIENT_ID": ctx["COGNITO_APP_CLIENT_ID"],
-            "COGNITO_USERNAME": ctx["COGNITO_USERNAME"],
-        }.items()
-        if not v
-    ]
-    if missing:
-        print(f"ERROR: .env の必須値が未設定です: {', '.join(missing)}")
-        sys.exit(2)
+def check(name: str, tags: Tuple[str, ...] = (), deps: Tuple[str, ...] = ()):
+    """チェック関数を登録するデコレータ。fn(ctx, clients) の形で呼ばれる"""
+    unknown = [t for t in tags if t not in CHECK_TAGS]
+    if unknown:
+        raise ValueError(f"未定義のタグ: {name} -> {unknown}")
 
-    # session
+    def deco(fn):
+        CHECKS.append(
+            {"name": name, "fn": fn, "deps": tuple(deps), "tags": tuple(tags)}
+        )
+        return fn
+
+    return deco
+
+
+def _csv_set(v: Optional[str]) -> Set[str]:
+    return {x.strip().lower() for x in (v or "").split(",") if x.strip()}
+
+
+def select_checks(
+    tags: Optional[Set[str]] = None, skip_tags: Optional[Set[str]] = None
+) -> List[Dict[str, Any]]:
+    """タグで実行対象を選ぶ（依存先は含める）。戻り値は登録順"""
+    unknown = sorted(((tags or set()) | (skip_tags or set())) - set(CHECK_TAGS))
+    if unknown:
+        raise ValueError(f"未定義のタグ: {unknown}（有効: {', '.join(CHECK_TAGS)}）")
+    by_name = {u["name"]: u for u in CHECKS}
+    chosen: Set[str] = set()
+    for u in CHECKS:
+        t = set(u["tags"])
+        if "meta" in t:
+            chosen.add(u["name"])
+            continue
+        if tags and not (t & tags):
+            continue
+        if skip_tags and (t & skip_tags):
+            continue
+        chosen.add(u["name"])
+    # 依存先を閉包で追加
+    stack = list(chosen)
+    while stack:
+        for d in by_name[stack.pop()]["deps"]:
+            if d in by_name and d not in chosen:
+                chosen.add(d)
+                stack.append(d)
+    return [u for u in CHECKS if u["name"] in chosen]
+
+
+def _run_one(unit: Dict[str, Any], ctx: Dict[str, str], clients: Dict[str, Any]):
+    """1 チェックを実行し、その中の _add/_skip を専用バッファに集める"""
+    _local.results = []
+    t0 = time.perf_counter()
+    status = "error"
+    try:
+        unit["fn"](ctx, clients)
+        status = "ok"
+    except Exception as e:
+        _add(unit["name"], False, f"内部エラー: {type(e).__name__}: {e}")
+        raise
+    finally:
+        unit["seconds"] = time.perf_counter() - t0
+        results, _local.results = _local.results, None
+        unit["results"] = results
+        _emit_unit(unit, status)
+
+
+def run_checks(
+    ctx: Dict[str, str],
+    clients: Dict[str, Any],
+    workers: int = CHECK_WORKERS,
+    selected: Optional[List[Dict[str, Any]]] = None,
+):
+    """依存関係を満たしたチェックから並列に実行し、RESULTS に登録順で追加
+
+    各チェックの所要時間・状態は META["Checks"] に残す（JSON 出力用）。
+    """
+    units = {u["name"]: dict(u) for u in (CHECKS if selected is None else selected)}
+    for u in units.values():
+        unknown = [d for d in u["deps"] if d not in units]
+        if unknown:
+            raise ValueError(f"未登録の依存チェック: {u['name']} -> {unknown}")
+
+    done: Dict[str, bool] = {}  # name -> 成功したか
+    running: Dict[Any, str] = {}  # Future -> name
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while len(done) < len(units):
+            progressed = False
+            for name, u in units.items():
+                if name in done or name in running.values():
+                    continue
+                if not all(d in done for d in u["deps"]):
+                    continue
+                failed = [d for d in u["deps"] if not done[d]]
+                if failed:
+                    # 依存先が例外で落ちた場合は実行しない
+                    u["results"] = []
+                    _local.results = u["results"]
+                    _skip(name, f"依存チェックが失敗: {', '.join(failed)}", blocked=True)
+                    _local.results = None
+                    _emit_unit(u, "skipped")
+                    done[name] = False
+                    progressed = True
+                    continue
+                running[pool.submit(_run_one, u, ctx, clients)] = name
+            if not running:
+                if not progressed:
+                    left = [n for n in units if n not in done]
+                    raise ValueError(f"依存関係が循環しています: {left}")
+                continue
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for fut in finished:
+                name = running.pop(fut)
+                done[name] = fut.exception() is None
+
+    for u in units.values():
+        RESULTS.extend(u.get("results") or [])
+        META["Checks"].append(
+            {
+                "name": u["name"],
+                "tags": list(u["tags"]),
+                "deps": list(u["deps"]),
+                "status": (
+                    "ok" if done[u["name"]] else "error" if "seconds" in u else "skipped"
+                ),
+                "seconds": round(u.get("seconds", 0.0), 3),
+            }
+        )
+
+
+# ===== Checks =====
+@check("Meta: アカウント", tags=("meta",))
+def check_account(ctx, clients):
     try:
-        session = boto3.Session(profile_name=profile, region_name=region)
-        sts = session.client("sts")
-        ident = sts.get_caller_identity()
+        ident = clients["sts"].get_caller_identity()
         META["Account"] = ident.get("Account")
-    except ProfileNotFound as e:
-        print(f"ERROR: AWS profile not found: {e}")
-        sys.exit(2)
     except ClientError:
         META["Account"] = None
 
-    # ディスカバリ（CFN/SSM/Tag/逆引き）
-    ctx = discover_values(session, ctx)
 
-    # clients
-    idp = session.client("cognito-idp")
-    s3 = session.client("s3")
-    cid = session.client("cognito-identity")
-    iot = session.client("iot")
-    iam = session.client("iam")
+@check("Discovery", tags=("discovery",), deps=("Meta: アカウント",))
+def check_discovery(ctx, clients):
+    # ディスカバリ（CFN/SSM/Tag/逆引き）。ctx をその場で補完する
+    # キャッシュキーにアカウント ID を含めるため、アカウント取得の後に実行
+    META["DiscoveryCache"] = discover_values_cached(clients["session"], ctx)
 
-    # CloudFront client（cdk-only の場合は DistributionId が確定している時のみ）
-    create_cf_client = (
-        (
-            scope != "cdk-only"
-            and (
-                ctx.get("CLOUDFRONT_DISTRIBUTION_ID")
-                or ctx.get("EXPECTED_RP_ID")
-                or ctx.get("CLOUDFRONT_DOMAIN_NAME")
-            )
-        )
-        or (scope == "cdk-only" and ctx.get("CLOUDFRONT_DISTRIBUTION_ID"))
-        or (_getenv("REQUIRE_CLOUDFRONT", "false").lower() == "true")
-    )
-    cfr = session.client("cloudfront") if create_cf_client else None
 
-    # 0) リージョン整合（Advisory）
+# 0) リージョン整合（Advisory）— 以降の Cognito チェックも ID は探索結果で補完された ctx を読む
+@check("Meta: リージョン整合", tags=("cognito",), deps=("Discovery",))
+def check_region(ctx, clients):
+    region = ctx["AWS_REGION"]
     try:
-        up = idp.describe_user_pool(UserPoolId=ctx["COGNITO_USER_POOL_ID"])
+        up = clients["idp"].describe_user_pool(UserPoolId=ctx["COGNITO_USER_POOL_ID"])
         up_id = up.get("UserPool", {}).get("Id") or ctx["COGNITO_USER_POOL_ID"]
         prefix = (up_id.split("_", 1)[0] if "_" in up_id else "").strip()
         reg_ok = (not prefix) or (prefix == region)
@@ -580,9 +1093,14 @@ def main():
             critical=False,
         )
 
-    # 1) WebAuthn（RP / UV）
+
+# 1) WebAuthn（RP / UV）— RP ID 一致は CloudFront 探索結果に依存
+@check("Cognito: WebAuthn", tags=("cognito",), deps=("Discovery",))
+def check_webauthn(ctx, clients):
     try:
-        resp = idp.get_user_pool_mfa_config(UserPoolId=ctx["COGNITO_USER_POOL_ID"])
+        resp = clients["idp"].get_user_pool_mfa_config(
+            UserPoolId=ctx["COGNITO_USER_POOL_ID"]
+        )
         webauthn = resp.get("WebAuthnConfiguration") or resp.get(
             "webauthnConfiguration"
         )
@@ -623,9 +1141,12 @@ def main():
             f"API error: {e.response['Error']['Message']}",
         )
 
-    # 2) App client: Flows / Secret
+
+# 2) App client: Flows / Secret
+@check("App Client", tags=("cognito",), deps=("Discovery",))
+def check_app_client(ctx, clients):
     try:
-        c = idp.describe_user_pool_client(
+        c = clients["idp"].describe_user_pool_client(
             UserPoolId=ctx["COGNITO_USER_POOL_ID"],
             ClientId=ctx["COGNITO_APP_CLIENT_ID"],
         )
@@ -663,9 +1184,12 @@ def main():
             f"API error: {e.response['Error']['Message']}",
         )
 
-    # 3) User existence & status
+
+# 3) User existence & status
+@check("User", tags=("cognito",), deps=("Discovery",))
+def check_user(ctx, clients):
     try:
-        u = idp.admin_get_user(
+        u = clients["idp"].admin_get_user(
             UserPoolId=ctx["COGNITO_USER_POOL_ID"], Username=ctx["COGNITO_USERNAME"]
         )
         enabled = bool(u.get("Enabled"))
@@ -684,12 +1208,16 @@ def main():
             "取得失敗（ユーザーが存在しない可能性）",
         )
 
-    # 4) Identity Pool
+
+# 4) Identity Pool
+@check("Identity Pool", tags=("cognito",), deps=("Discovery",))
+def check_identity_pool(ctx, clients):
+    region = ctx["AWS_REGION"]
     identity_pool_id = ctx.get("COGNITO_IDENTITY_POOL_ID")
     require_id = _getenv("REQUIRE_IDENTITY_POOL", "false").lower() == "true"
     if identity_pool_id:
         try:
-            ip = cid.describe_identity_pool(IdentityPoolId=identity_pool_id)
+            ip = clients["cid"].describe_identity_pool(IdentityPoolId=identity_pool_id)
             providers = ip.get("CognitoIdentityProviders") or []
             provider_names = [p.get("ProviderName") for p in providers]
             expected_provider = (
@@ -730,85 +1258,109 @@ def main():
         else:
             _skip("Identity Pool: 連携", "ID プール未設定（任意）")
 
-    # 5) S3
-    if ctx.get("S3_BUCKET"):
-        try:
-            head = s3.head_object(Bucket=ctx["S3_BUCKET"], Key=ctx["S3_INDEX_KEY"])
-            ctype = (head.get("ContentType") or "").lower()
-            ok = ctype.startswith("text/html") or ctx["S3_INDEX_KEY"].endswith(".html")
-            _add(
-                "S3: index.html の存在/Content-Type",
-                ok,
-                "OK" if ok else f"Content-Type が text/html ではない: {ctype}",
-                {
-                    "Bucket": ctx["S3_BUCKET"],
-                    "Key": ctx["S3_INDEX_KEY"],
-                    "ContentType": ctype,
-                },
-            )
-        except ClientError as e:
-            _add(
-                "S3: index.html の存在/Content-Type",
-                False,
-                f"head_object 失敗: {e.response['Error']['Message']}",
-            )
-        try:
-            head = s3.head_object(Bucket=ctx["S3_BUCKET"], Key=ctx["S3_FAVICON_KEY"])
-            ctype = (head.get("ContentType") or "").lower()
-            ok = ctype in ("image/x-icon", "image/vnd.microsoft.icon") or ctx[
-                "S3_FAVICON_KEY"
-            ].endswith(".ico")
-            _add(
-                "S3: favicon の存在/Content-Type",
-                ok,
-                "OK" if ok else f"Content-Type が ico ではない: {ctype}",
-                {
-                    "Bucket": ctx["S3_BUCKET"],
-                    "Key": ctx["S3_FAVICON_KEY"],
-                    "ContentType": ctype,
-                },
-            )
-        except ClientError as e:
-            _add(
-                "S3: favicon の存在/Content-Type",
-                False,
-                f"head_object 失敗: {e.response['Error']['Message']}",
-            )
-        try:
-            pab = s3.get_public_access_block(Bucket=ctx["S3_BUCKET"]).get(
-                "PublicAccessBlockConfiguration", {}
-            )
-            flags = [
-                pab.get(k)
-                for k in [
-                    "BlockPublicAcls",
-                    "IgnorePublicAcls",
-                    "BlockPublicPolicy",
-                    "RestrictPublicBuckets",
-                ]
-            ]
-            ok = all(bool(x) for x in flags)
-            _add(
-                "S3: Block Public Access（4項目）",
-                ok,
-                "OK: 4項目すべて True" if ok else f"NG: {pab}",
-                {"PublicAccessBlock": pab},
-            )
-        except ClientError as e:
-            _add(
-                "S3: Block Public Access（4項目）",
-                False,
-                f"API error: {e.response['Error']['Message']}",
-            )
-    else:
+
+# 5) S3（バケットは CF→Origin 逆引きで補完されることがあるため探索後）
+@check("S3: index.html", tags=("s3",), deps=("Discovery",))
+def check_s3_index(ctx, clients):
+    if not ctx.get("S3_BUCKET"):
         _skip(
             "S3: index/favicon/BPA",
             "S3_BUCKET 未設定（CF→Origin逆引きで補完できる場合あり）",
         )
+        return
+    try:
+        head = clients["s3"].head_object(
+            Bucket=ctx["S3_BUCKET"], Key=ctx["S3_INDEX_KEY"]
+        )
+        ctype = (head.get("ContentType") or "").lower()
+        ok = ctype.startswith("text/html") or ctx["S3_INDEX_KEY"].endswith(".html")
+        _add(
+            "S3: index.html の存在/Content-Type",
+            ok,
+            "OK" if ok else f"Content-Type が text/html ではない: {ctype}",
+            {
+                "Bucket": ctx["S3_BUCKET"],
+                "Key": ctx["S3_INDEX_KEY"],
+                "ContentType": ctype,
+            },
+        )
+    except ClientError as e:
+        _add(
+            "S3: index.html の存在/Content-Type",
+            False,
+            f"head_object 失敗: {e.response['Error']['Message']}",
+        )
 
-    # 6) IoT
+
+@check("S3: favicon", tags=("s3",), deps=("Discovery",))
+def check_s3_favicon(ctx, clients):
+    if not ctx.get("S3_BUCKET"):
+        return  # SKIP は index 側で 1 件だけ出す
     try:
-        de = iot.describe_endpoint(endpointType="iot:Data-ATS")
+        head = clients["s3"].head_object(
+            Bucket=ctx["S3_BUCKET"], Key=ctx["S3_FAVICON_KEY"]
+        )
+        ctype = (head.get("ContentType") or "").lower()
+        ok = ctype in ("image/x-icon", "image/vnd.microsoft.icon") or ctx[
+            "S3_FAVICON_KEY"
+        ].endswith(".ico")
+        _add(
+            "S3: favicon の存在/Content-Type",
+            ok,
+            "OK" if ok else f"Content-Type が ico ではない: {ctype}",
+            {
+                "Bucket": ctx["S3_BUCKET"],
+                "Key": ctx["S3_FAVICON_KEY"],
+                "ContentType": ctype,
+            },
+        )
+    except ClientError as e:
+        _add(
+            "S3: favicon の存在/Content-Type",
+            False,
+            f"head_object 失敗: {e.response['Error']['Message']}",
+        )
+
+
+@check("S3: Block Public Access", tags=("s3",), deps=("Discovery",))
+def check_s3_bpa(ctx, clients):
+    if not ctx.get("S3_BUCKET"):
+        return
+    try:
+        pab = (
+            clients["s3"]
+            .get_public_access_block(Bucket=ctx["S3_BUCKET"])
+            .get("PublicAccessBlockConfiguration", {})
+        )
+        flags = [
+            pab.get(k)
+            for k in [
+                "BlockPublicAcls",
+                "IgnorePublicAcls",
+                "BlockPublicPolicy",
+                "RestrictPublicBuckets",
+            ]
+        ]
+        ok = all(bool(x) for x in flags)
+        _add(
+            "S3: Block Public Access（4項目）",
+            ok,
+            "OK: 4項目すべて True" if ok else f"NG: {pab}",
+            {"PublicAccessBlock": pab},
+        )
+    except ClientError as e:
+        _add(
+            "S3: Block Public Access（4項目）",
+            False,
+            f"API error: {e.response['Error']['Message']}",
+        )
+
+
+# 6) IoT
+@check("IoT: エンドポイント", tags=("iot",), deps=("Discovery",))
+def check_iot_endpoint(ctx, clients):
+    try:
+        de = clients["iot"].describe_endpoint(endpointType="iot:Data-ATS")
         endpoint_addr = de.get("endpointAddress")
         ok = bool(endpoint_addr)
         if ctx.get("IOT_ENDPOINT"):
@@ -833,9 +1385,12 @@ def main():
             f"API error: {e.response['Error']['Message']}",
         )
 
+
+@check("IoT: プロビジョニングテンプレート", tags=("iot",), deps=("Discovery",))
+def check_iot_template(ctx, clients):
     if ctx.get("IOT_PROVISIONING_TEMPLATE"):
         try:
-            desc = iot.describe_provisioning_template(
+            desc = clients["iot"].describe_provisioning_template(
                 templateName=ctx["IOT_PROVISIONING_TEMPLATE"]
             )
             ok = bool(desc.get("templateArn"))
@@ -859,9 +1414,27 @@ def main():
             "IOT_PROVISIONING_TEMPLATE 未設定",
         )
 
-    # 7) CloudFront
+
+# 7) CloudFront（DistributionId は探索で確定する）
+@check("CloudFront", tags=("cloudfront",), deps=("Discovery",))
+def check_cloudfront(ctx, clients):
+    region = ctx["AWS_REGION"]
+    scope = _getenv("TARGET_SCOPE", "all").lower()
     require_cf = _getenv("REQUIRE_CLOUDFRONT", "false").lower() == "true"
-    cfr_client_ready = bool(cfr)
+    # cdk-only の場合は DistributionId が確定している時のみ検査
+    cfr_client_ready = bool(
+        (
+            scope != "cdk-only"
+            and (
+                ctx.get("CLOUDFRONT_DISTRIBUTION_ID")
+                or ctx.get("EXPECTED_RP_ID")
+                or ctx.get("CLOUDFRONT_DOMAIN_NAME")
+            )
+        )
+        or (scope == "cdk-only" and ctx.get("CLOUDFRONT_DISTRIBUTION_ID"))
+        or require_cf
+    )
+    cfr = clients["cloudfront"]
     if cfr_client_ready and ctx.get("CLOUDFRONT_DISTRIBUTION_ID"):
         try:
             cg = cfr.get_distribution_config(Id=ctx["CLOUDFRONT_DISTRIBUTION_ID"])
@@ -945,7 +1518,10 @@ def main():
         else:
             _skip("CloudFront: DefaultRoot/OAC/CSP", "配信を特定できず（任意）")
 
-    # 8) 所有権チェック（指定スタックの所有物か）
+
+# 8) 所有権チェック（指定スタックの所有物か）— API 呼び出しなし、探索結果のみ参照
+@check("Ownership", tags=("ownership",), deps=("Discovery",))
+def check_ownership(ctx, clients):
     strict = _ownership_required()
 
     def own_check(name: str, typ: str, pid: Optional[str]):
@@ -991,6 +1567,88 @@ def main():
             ctx.get("IOT_PROVISIONING_TEMPLATE"),
         )
 
+
+# ===== Main =====
+class SetupError(Exception):
+    """設定不備（.env の必須値・プロファイル・ターゲット一覧）。終了コード 2"""
+
+
+def run_target(selected: List[Dict[str, Any]]) -> Tuple[Dict[str, str], Optional[str]]:
+    """現在の環境変数で 1 ターゲット分のチェックを実行し、(ctx, .env 候補) を返す"""
+    # env → ctx
+    profile = _getenv("AWS_PROFILE")
+    region = _getenv("AWS_REGION", "ap-northeast-1")
+
+    ctx: Dict[str, str] = {
+        "AWS_REGION": region,
+        "COGNITO_USER_POOL_ID": _getenv("COGNITO_USER_POOL_ID", ""),
+        "COGNITO_APP_CLIENT_ID": _getenv("COGNITO_APP_CLIENT_ID", ""),
+        "COGNITO_USERNAME": _getenv("COGNITO_USERNAME", ""),
+        "COGNITO_USER_POOL_DOMAIN": _getenv("COGNITO_USER_POOL_DOMAIN", ""),
+        "COGNITO_IDENTITY_POOL_ID": _getenv("COGNITO_IDENTITY_POOL_ID", ""),
+        "CLOUDFRONT_DISTRIBUTION_ID": _getenv("CLOUDFRONT_DISTRIBUTION_ID", ""),
+        "CLOUDFRONT_DOMAIN_NAME": _getenv("CLOUDFRONT_DOMAIN_NAME", ""),
+        "EXPECTED_RP_ID": _getenv("EXPECTED_RP_ID", ""),
+        "S3_BUCKET": _getenv("S3_BUCKET", ""),
+        "S3_INDEX_KEY": _getenv("S3_INDEX_KEY", "index.html"),
+        "S3_FAVICON_KEY": _getenv("S3_FAVICON_KEY", "assets/favicon.ico"),
+        "IOT_ENDPOINT": _getenv("IOT_ENDPOINT", ""),
+        "IOT_PROVISIONING_TEMPLATE": _getenv("IOT_PROVISIONING_TEMPLATE", ""),
+    }
+
+    # 必須（最小限）。Cognito 系を実行しない絞り込み時は不要
+    need_cognito = any("cognito" in u["tags"] for u in selected)
+    missing = [
+        k
+        for k, v in {
+            "COGNITO_USER_POOL_ID": ctx["COGNITO_USER_POOL_ID"],
+            "COGNITO_APP_CLIENT_ID": ctx["COGNITO_APP_CLIENT_ID"],
+            "COGNITO_USERNAME": ctx["COGNITO_USERNAME"],
+        }.items()
+        if not v
+    ]
+    if missing and need_cognito:
+        raise SetupError(f".env の必須値が未設定です: {', '.join(missing)}")
+
+    # session
+    try:
+        session = aws_clients.get_session(profile, region)
+    except ProfileNotFound as e:
+        raise SetupError(f"AWS profile not found: {e}")
+
+    # clients（aws_clients が (サービス, リージョン, 認証情報) ごとに 1 つだけ作り、
+    # 探索処理とも共有する。作成はロックで直列化されるのでスレッドから呼んでよい）
+    clients: Dict[str, Any] = {
+        "session": session,
+        "sts": aws_clients.get_client("sts", session=session),
+        "idp": aws_clients.get_client("cognito-idp", session=session),
+        "s3": aws_clients.get_client("s3", session=session),
+        "cid": aws_clients.get_client("cognito-identity", session=session),
+        "iot": aws_clients.get_client("iot", session=session),
+        "cloudfront": aws_clients.get_client("cloudfront", session=session),
+    }
+
+    # 0)〜8) 依存関係に沿って並列実行
+    workers = int(_getenv("CHECK_WORKERS", str(CHECK_WORKERS)))
+    t0 = time.perf_counter()
+    _emit(
+        "start",
+        profile=profile,
+        region=region,
+        checks=[u["name"] for u in selected],
+    )
+    run_checks(ctx, clients, workers, selected)
+    _emit(
+        "end",
+        account=META.get("Account"),
+        seconds=round(time.perf_counter() - t0, 3),
+        total=len(RESULTS),
+        failed=sum(1 for r in RESULTS if not r["ok"] and not _is_skip(r)),
+        failed_critical=[
+            r["check"] for r in RESULTS if not r["ok"] and r.get("critical", True)
+        ],
+    )
+
     # 9) .env 候補の出力
     emit = _getenv("EMIT_DISCOVERED_ENV", "false").lower() == "true"
     env_block = None
@@ -1019,7 +1677,273 @@ def main():
         ]
         env_block = "\n".join(lines)
 
-    _summarize_and_exit(ctx, env_block)
+    return ctx, env_block
+
+
+# ----- Fan-out（複数プロファイル/リージョン/ステージ） -----
+# RESULTS/META/os.environ はプロセス単位の状態なので、ターゲットごとにプロセスを分けて並列実行する。
+FANOUT_WORKERS = 4
+TARGET_KEYS = {
+    "profile": "AWS_PROFILE",
+    "region": "AWS_REGION",
+    "stage": "DISCOVERY_STAGE",
+}
+
+
+def _target_label(t: Dict[str, Any]) -> str:
+    return "/".join(
+        [t.get("profile") or "default", t.get("region") or "-", t.get("stage") or "-"]
+    )
+
+
+def _normalize_target(raw: Dict[str, Any]) -> Dict[str, Any]:
+    t: Dict[str, Any] = {"profile": "", "region": "", "stage": "", "env": {}}
+    for k, v in raw.items():
+        if v is None or v == "":
+            continue
+        key = str(k).strip()
+        if key == "env" and isinstance(v, dict):
+            t["env"].update({str(ek): str(ev) for ek, ev in v.items()})
+        elif key.lower() in TARGET_KEYS:
+            t[key.lower()] = str(v).strip()
+        elif key in TARGET_KEYS.values():
+            t[next(n for n, e in TARGET_KEYS.items() if e == key)] = str(v).strip()
+        else:
+            # それ以外の列/キーはそのターゲットでだけ上書きする環境変数
+            t["env"][key] = str(v)
+    return t
+
+
+def load_targets(path: str) -> List[Dict[str, Any]]:
+    """ターゲット一覧を読み込む
+
+    - .json: [{"profile", "region", "stage", "env": {...}}, ...]（{"targets": [...]} も可）
+    - それ以外: CSV（ヘッダ行必須。profile/region/stage 以外の列は環境変数として上書き）
+    """
+    try:
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            if path.lower().endswith(".json"):
+                data = json.load(f)
+                rows = data.get("targets") if isinstance(data, dict) else data
+            else:
+                rows = list(csv.DictReader(f))
+    except (OSError, ValueError) as e:
+        raise SetupError(f"ターゲット一覧を読めません: {path}: {e}")
+    if not isinstance(rows, list) or not all(isinstance(r, dict) for r in rows):
+        raise SetupError(f"ターゲット一覧の形式が不正です: {path}")
+    targets = [_normalize_target(r) for r in rows]
+    if not targets:
+        raise SetupError(f"ターゲットがありません: {path}")
+    return targets
+
+
+def _run_target_process(
+    target: Dict[str, Any], tags: Set[str], skip_tags: Set[str]
+) -> Dict[str, Any]:
+    """子プロセス: 環境変数をターゲット用に差し替えて run_target し、レポートを返す
+
+    NDJSON 出力時は結果を逐次書き出し済みなので、レポート本体は返さない（親のメモリを抑える）。
+    """
+    global _ndjson_target
+    _ndjson_target = _target_label(target)
+    saved = dict(os.environ)
+    t0 = time.perf_counter()
+    ctx: Dict[str, str] = {}
+    error = None
+    try:
+        for name, env in TARGET_KEYS.items():
+            if target.get(name):
+                os.environ[env] = target[name]
+        os.environ.update(target.get("env") or {})
+        # プロセスは複数ターゲットで使い回されるため、前回の結果を消してから実行
+        RESULTS.clear()
+        META.update(
+            Account=None,
+            CfnStacks=[],
+            CfnResourceIndex={},
+            Checks=[],
+            Selection={"tags": sorted(tags), "skip_tags": sorted(skip_tags)},
+            DiscoveryCache=None,
+        )
+        ctx, _ = run_target(select_checks(tags, skip_tags))
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        report = None if _ndjson_path() else _report(ctx)
+        os.environ.clear()
+        os.environ.update(saved)
+    failed = [r["check"] for r in RESULTS if not r["ok"] and r.get("critical", True)]
+    return {
+        "target": target,
+        "label": _target_label(target),
+        "ok": error is None and not failed,
+        "error": error,
+        "seconds": round(time.perf_counter() - t0, 3),
+        "summary": {
+            "total": len(RESULTS),
+            "passed": sum(1 for r in RESULTS if r["ok"] and not _is_skip(r)),
+            "skipped": sum(1 for r in RESULTS if _is_skip(r)),
+            "blocked": sum(1 for r in RESULTS if _is_skip(r) and not r["ok"]),
+            "failed": sum(1 for r in RESULTS if not r["ok"] and not _is_skip(r)),
+            "failed_critical": failed,
+        },
+        "report": report,
+    }
+
+
+def run_fanout(
+    targets: List[Dict[str, Any]], tags: Set[str], skip_tags: Set[str], workers: int
+):
+    """全ターゲットをプロセスプールで並列に実行し、1 つの JSON にまとめて終了"""
+    t0 = time.perf_counter()
+    entries: List[Optional[Dict[str, Any]]] = [None] * len(targets)
+    pool_args: Dict[str, Any] = {}
+    relay = None
+    if _ndjson_path() == "-":
+        # 子プロセスが同じパイプへ直接書くと長い行が混ざりうるため、親がまとめて書く
+        queue = multiprocessing.SimpleQueue()
+        pool_args = {"initializer": _init_ndjson_queue, "initargs": (queue,)}
+        relay = threading.Thread(target=_relay_ndjson, args=(queue, "-"), daemon=True)
+        relay.start()
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(targets))), **pool_args) as pool:
+        futures = {
+            pool.submit(_run_target_process, t, tags, skip_tags): i
+            for i, t in enumerate(targets)
+        }
+        for fut in as_completed(futures):
+            i = futures[fut]
+            try:
+                entries[i] = fut.result()
+            except Exception as e:  # 子プロセスの異常終了など
+                entries[i] = {
+                    "target": targets[i],
+                    "label": _target_label(targets[i]),
+                    "ok": False,
+                    "error": f"{type(e).__name__}: {e}",
+                    "seconds": 0.0,
+                    "summary": {},
+                    "report": None,
+                }
+            e = entries[i]
+            print(f"[{'PASS' if e['ok'] else 'FAIL'}] {e['label']} ({e['seconds']:.1f}s)")
+            _emit(
+                "target",
+                label=e["label"],
+                ok=e["ok"],
+                error=e["error"],
+                seconds=e["seconds"],
+                summary=e["summary"],
+            )
+    if relay:
+        queue.put(None)
+        relay.join()
+
+    # 表示はターゲット一覧の順
+    for e in entries:
+        print(f"\n=== Environment Check Summary: {e['label']} ===")
+        if e["error"]:
+            print(f"ERROR: {e['error']}")
+        if e["report"]:
+            _print_results(e["report"]["results"])
+    print("\n=== Fan-out Summary ===")
+    width = max(len(e["label"]) for e in entries)
+    for e in entries:
+        sm = e["summary"]
+        detail = e["error"] or (
+            f"pass={sm.get('passed', 0)} skip={sm.get('skipped', 0)} fail={sm.get('failed', 0)}"
+            + (f" critical: {', '.join(sm['failed_critical'])}" if sm.get("failed_critical") else "")
+        )
+        print(f"[{_icon(e['ok'])}] {e['label']:<{width}} : {detail}")
+    print("=" * 34)
+
+    payload = {
+        "timestamp": datetime.now(timezone.utc).astimezone().isoformat(),
+        "mode": "fanout",
+        "selection": {"tags": sorted(tags), "skip_tags": sorted(skip_tags)},
+        "seconds": round(time.perf_counter() - t0, 3),
+        "summary": {
+            "targets": len(entries),
+            "ok": sum(1 for e in entries if e["ok"]),
+            "failed": [e["label"] for e in entries if not e["ok"]],
+        },
+        "targets": entries,
+    }
+    base = _getenv("OUTPUT_BASENAME", "envcheck") + "-fanout"
+    print(f"Saved JSON: {_write_json(payload, base)}")
+    sys.exit(0 if all(e["ok"] for e in entries) else 1)
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="AWS 環境設定の自動チェック")
+    parser.add_argument(
+        "--tags",
+        default=_getenv("CHECK_TAGS", ""),
+        help=f"実行するタグ（カンマ区切り。既定: 全て）: {', '.join(CHECK_TAGS)}",
+    )
+    parser.add_argument(
+        "--skip-tags",
+        default=_getenv("CHECK_SKIP_TAGS", ""),
+        help="除外するタグ（カンマ区切り）",
+    )
+    parser.add_argument(
+        "--refresh-discovery",
+        action="store_true",
+        help="探索キャッシュを使わずに再探索（結果はキャッシュに保存）",
+    )
+    parser.add_argument(
+        "--targets",
+        default=_getenv("CHECK_TARGETS", ""),
+        help="複数ターゲット（profile/region/stage）の一覧 CSV/JSON。指定時は並列に実行して 1 つの JSON にまとめる",
+    )
+    parser.add_argument(
+        "--target-workers",
+        type=int,
+        default=int(_getenv("CHECK_TARGET_WORKERS", str(FANOUT_WORKERS))),
+        help=f"--targets の同時実行プロセス数（既定 {FANOUT_WORKERS}）",
+    )
+    parser.add_argument(
+        "--ndjson",
+        default=_getenv("OUTPUT_NDJSON", ""),
+        help="チェック結果を完了順に 1 行 1 JSON で追記するファイル（- で標準出力。表示は標準エラーへ）",
+    )
+    parser.add_argument(
+        "--list-checks", action="store_true", help="登録済みチェックの一覧を表示して終了"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = _parse_args()
+    if args.list_checks:
+        for u in CHECKS:
+            deps = f" <- {', '.join(u['deps'])}" if u["deps"] else ""
+            print(f"{u['name']}  [{', '.join(u['tags'])}]{deps}")
+        return
+    tags, skip_tags = _csv_set(args.tags), _csv_set(args.skip_tags)
+    try:
+        selected = select_checks(tags, skip_tags)
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        sys.exit(2)
+    META["Selection"] = {"tags": sorted(tags), "skip_tags": sorted(skip_tags)}
+    if args.refresh_discovery:
+        os.environ["DISCOVERY_CACHE_REFRESH"] = "true"
+    if args.ndjson:
+        os.environ["OUTPUT_NDJSON"] = args.ndjson  # fan-out の子プロセスにも引き継ぐ
+
+    # NDJSON を標準出力に流すときは、人向けの表示を標準エラーへ
+    out = sys.stderr if args.ndjson == "-" else sys.stdout
+    with contextlib.redirect_stdout(out):
+        try:
+            if args.targets:
+                run_fanout(
+                    load_targets(args.targets), tags, skip_tags, args.target_workers
+                )
+            ctx, env_block = run_target(selected)
+        except SetupError as e:
+            print(f"ERROR: {e}")
+            sys.exit(2)
+        _summarize_and_exit(ctx, env_block)
 
 
 if __name__ == "__main__":
@@ -18,10 +18,11 @@ import sys
 from datetime import datetime
 from typing import Dict, List, Optional, Tuple
 
-import boto3
 from botocore.exceptions import ClientError, NoCredentialsError
 from colorama import Fore, Style, init
 
+import aws_clients
+
 # Coloramaを初期化（Windows対応）
 init(autoreset=True)
 
@@ -33,8 +34,8 @@ class CognitoAuthenticator:
         """初期化処理"""
         self.region = region
         try:
-            self.cognito_idp = boto3.client('cognito-idp', region_name=region)
-            self.cognito_identity = boto3.client('cognito-identity', region_name=region)
+            self.cognito_idp = aws_clients.get_client('cognito-idp', region=region)
+            self.cognito_identity = aws_clients.get_client('cognito-identity', region=region)
         except Exception as e:
             self._log_error(f"AWS Cognitoクライアントの初期化に失敗しました: {str(e)}")
             raise
@@ -228,16 +229,12 @@ class PasskeyManager:
         try:
             if aws_credentials:
                 # 一時的なAWS認証情報を使用
-                self.cognito_client = boto3.client(
-                    'cognito-idp',
-                    region_name=region,
-                    aws_access_key_id=aws_credentials['AccessKeyId'],
-                    aws_secret_access_key=aws_credentials['SecretKey'],
-                    aws_session_token=aws_credentials['SessionToken']
+                self.cognito_client = aws_clients.get_client(
+                    'cognito-idp', region=region, credentials=aws_credentials
                 )
             else:
-                # デフォルトのAWS認証情報を使用
-                self.cognito_client = boto3.client('cognito-idp', region_name=region)
+                # デフォルトのAWS認証情報を使用（CognitoAuthenticator と同じクライアントを共有）
+                self.cognito_client = aws_clients.get_client('cognito-idp', region=region)
                 
         except Exception as e:
             self._log_error(f"AWS Cognitoクライアントの初期化に失敗しました: {str(e)}")
@@ -1,5 +1,4 @@
 # mqtt_test_fixed.py
-import boto3
 import datetime
 from botocore.auth import SigV4QueryAuth
 from botocore.awsrequest import AWSRequest
@@ -9,6 +8,8 @@ from urllib.parse import urlparse, urlencode, parse_qsl, urlunparse
 import sys
 import ssl, socket, time, os, base64
 
+import aws_clients
+
 # --- 設定 ---
 REGION = "ap-northeast-1"
 USER_POOL_ID = "ap-northeast-1_2jfmfM2GA"
@@ -21,7 +22,7 @@ PASSWORD = "Lead9313-"  # 実運用では環境変数/Secretに
 # --- Cognito: ユーザープール認証 → IDプールで STS 一時クレデンシャル取得 ---
 def get_iot_credentials() -> dict | None:
     try:
-        idp = boto3.client("cognito-idp", region_name=REGION)
+        idp = aws_clients.get_client("cognito-idp", region=REGION)
         auth = idp.initiate_auth(
             AuthFlow="USER_PASSWORD_AUTH",
             AuthParameters={"USERNAME": USERNAME, "PASSWORD": PASSWORD},
@@ -33,7 +34,7 @@ def get_iot_credentials() -> dict | None:
         return None
 
     try:
-        ident = boto3.client("cognito-identity", region_name=REGION)
+        ident = aws_clients.get_client("cognito-identity", region=REGION)
         id_res = ident.get_id(
             IdentityPoolId=IDENTITY_POOL_ID,
             Logins={f"cognito-idp.{REGION}.amazonaws.com/{USER_POOL_ID}": id_token},
@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+役割: MQTT ペイロードの JSON コーデック（server.py / provision_and_verify.py 共通）
+- orjson → msgspec → 標準 json の順で、インストール済みのものを自動選択
+- 環境変数 IOTGW_JSON_CODEC（orjson / msgspec / json）で固定可
+- 呼出し（cmd/call）・ステータス・Shadow reported は型付きスキーマ（msgspec 時は Struct を事前コンパイル）
+- ステータスのバイナリ版（CBOR、先頭 1 バイトがスキーマバージョン）
+- `python codec.py` で各バックエンドの 1 メッセージあたりのコストを計測
+"""
+
+import json
+import os
+import time
+from typing import Any, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+# ========= スキーマ =========
+STATUS_FIELDS = ("state", "updatedAt", "heartbeatAt", "requestId")
+SHADOW_REPORTED_FIELDS = ("state", "version", "updatedAt")
+
+if msgspec is not None:
+
+    class CallMessage(msgspec.Struct):
+        """amr/{thing}/cmd/call のペイロード"""
+
+        requestId: Optional[str] = None
+        dest: Optional[str] = None
+
+    class StatusMessage(msgspec.Struct, omit_defaults=True, forbid_unknown_fields=True):
+        """amr/{thing}/status のペイロード（LWT は heartbeatAt なし）"""
+
+        state: str
+        updatedAt: int
+        heartbeatAt: Optional[int] = None
+        requestId: Optional[str] = None
+
+    class ShadowReported(msgspec.Struct, kw_only=True, omit_defaults=True, forbid_unknown_fields=True):
+        """Shadow update の state.reported（変更のあったキーだけを送るため state は省略可）"""
+
+        state: Optional[str] = None
+        version: int
+        updatedAt: int
+
+    class ShadowState(msgspec.Struct):
+        reported: ShadowReported
+
+    class ShadowUpdate(msgspec.Struct):
+        """$aws/things/{thing}/shadow/name/{shadow}/update のペイロード"""
+
+        state: ShadowState
+
+else:
+
+    class CallMessage:
+        """amr/{thing}/cmd/call のペイロード"""
+
+        __slots__ = ("requestId", "dest")
+
+        def __init__(self, requestId=None, dest=None):
+            self.requestId = requestId
+            self.dest = dest
+
+    StatusMessage = ShadowUpdate = None
+
+
+def _call_from_dict(d) -> CallMessage:
+    if not isinstance(d, dict):
+        raise ValueError(f"呼出しペイロードがオブジェクトではない: {d!r}")
+    req_id = d.get("requestId")
+    dest = d.get("dest")
+    if req_id is not None and not isinstance(req_id, str):
+        raise ValueError(f"requestId が文字列ではない: {req_id!r}")
+    if dest is not None and not isinstance(dest, str):
+        raise ValueError(f"dest が文字列ではない: {dest!r}")
+    return CallMessage(requestId=req_id, dest=dest)
+
+
+def _check_fields(what: str, d: dict, fields, required):
+    """dict ペイロードのキーと型を確認（msgspec が無いときのスキーマ相当）"""
+    unknown = [k for k in d if k not in fields]
+    if unknown:
+        raise ValueError(f"{what} に未定義のキー: {unknown}")
+    missing = [k for k in required if k not in d]
+    if missing:
+        raise ValueError(f"{what} に必須キーがない: {missing}")
+    for k, v in d.items():
+        if v is None:
+            if k in required:
+                raise ValueError(f"{what} の {k} が null")
+            continue
+        if k in ("state", "requestId"):
+            ok = isinstance(v, str)
+        else:
+            ok = isinstance(v, int) and not isinstance(v, bool)
+        if not ok:
+            raise ValueError(f"{what} の {k} の型が不正: {v!r}")
+
+
+# ========= バックエンド =========
+class JsonCodec:
+    """標準ライブラリ json"""
+
+    name = "json"
+
+    def encode(self, obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode(
+            "utf-8"
+        )
+
+    def decode(self, data) -> Any:
+        return json.loads(data)
+
+    def decode_call(self, data) -> CallMessage:
+        return _call_from_dict(self.decode(data))
+
+    def encode_status(self, payload: dict) -> bytes:
+        """ステータス（STATUS_FIELDS のキーのみ）を符号化"""
+        _check_fields("ステータス", payload, STATUS_FIELDS, ("state", "updatedAt"))
+        return self.encode(payload)
+
+    def decode_status(self, data) -> dict:
+        payload = self.decode(data)
+        if not isinstance(payload, dict):
+            raise ValueError(f"ステータスがオブジェクトではない: {payload!r}")
+        _check_fields("ステータス", payload, STATUS_FIELDS, ("state", "updatedAt"))
+        return payload
+
+    def encode_shadow(self, reported: dict) -> bytes:
+        """Shadow update（{"state": {"reported": reported}}）を符号化"""
+        _check_fields("Shadow reported", reported, SHADOW_REPORTED_FIELDS, ("version", "updatedAt"))
+        return self.encode({"state": {"reported": reported}})
+
+
+class OrjsonCodec(JsonCodec):
+    """orjson（Rust 実装、dumps が bytes を返す）"""
+
+    name = "orjson"
+
+    def encode(self, obj) -> bytes:
+        return orjson.dumps(obj)
+
+    def decode(self, data) -> Any:
+        return orjson.loads(data)
+
+
+class MsgspecCodec(JsonCodec):
+    """msgspec（エンコーダ/デコーダを使い回し、呼出しはスキーマで直接デコード）"""
+
+    name = "msgspec"
+
+    def __init__(self):
+        self._encoder = msgspec.json.Encoder()
+        self._decoder = msgspec.json.Decoder()
+        self._call_decoder = msgspec.json.Decoder(CallMessage)
+        self._status_decoder = msgspec.json.Decoder(StatusMessage)
+
+    def encode(self, obj) -> bytes:
+        return self._encoder.encode(obj)
+
+    # msgspec の DecodeError は ValueError ではないため、他バックエンドに揃えて変換する
+    def decode(self, data) -> Any:
+        try:
+            return self._decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
+
+    def decode_call(self, data) -> CallMessage:
+        try:
+            return self._call_decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise ValueError(f"呼出しペイロードが不正: {e}") from e
+
+    # Struct のコンストラクタは型を検証しないため、convert で検証してから符号化する
+    def encode_status(self, payload: dict) -> bytes:
+        try:
+            return self._encoder.encode(msgspec.convert(payload, StatusMessage))
+        except msgspec.ValidationError as e:
+            raise ValueError(f"ステータスが不正: {e}") from e
+
+    def decode_status(self, data) -> dict:
+        try:
+            msg = self._status_decoder.decode(data)
+            # 他バックエンドと同じく、省略されたキーは dict に含めない
+            return {k: v for k, v in msgspec.structs.asdict(msg).items() if v is not None}
+        except msgspec.DecodeError as e:
+            raise ValueError(f"ステータスが不正: {e}") from e
+
+    def encode_shadow(self, reported: dict) -> bytes:
+        try:
+            doc = msgspec.convert({"state": {"reported": reported}}, ShadowUpdate)
+        except msgspec.ValidationError as e:
+            raise ValueError(f"Shadow reported が不正: {e}") from e
+        return self._encoder.encode(doc)
+
+
+BACKENDS = {"json": JsonCodec}
+if orjson is not None:
+    BACKENDS["orjson"] = OrjsonCodec
+if msgspec is not None:
+    BACKENDS["msgspec"] = MsgspecCodec
+
+
+def select(name: Optional[str] = None) -> JsonCodec:
+    """バックエンドを選択（未指定/auto は orjson → msgspec → json）"""
+    name = (name or os.environ.get("IOTGW_JSON_CODEC") or "auto").lower()
+    if name == "auto":
+        for cand in ("orjson", "msgspec", "json"):
+            if cand in BACKENDS:
+                return BACKENDS[cand]()
+    if name not in BACKENDS:
+        raise ValueError(f"JSON コーデックが利用できません: {name}")
+    return BACKENDS[name]()
+
+
+# モジュール既定のコーデック
+codec = select()
+encode = codec.encode
+decode = codec.decode
+decode_call = codec.decode_call
+encode_status = codec.encode_status
+decode_status = codec.decode_status
+encode_shadow = codec.encode_shadow
+
+
+# ========= バイナリステータス（CBOR） =========
+# 形式: [バージョン 1 バイト] + CBOR 配列 [state, updatedAt, heartbeatAt - updatedAt, requestId]
+#   - state は STATUS_STATES の添字（未知の状態は文字列のまま）
+#   - heartbeatAt は updatedAt との差分（通常 0 で 1 バイト。heartbeatAt の無い LWT/offline は null）
+#   - requestId が無ければ null
+# 依存ライブラリを増やさないため、使う型（整数/文字列/null/配列）だけを直接符号化する
+STATUS_BINARY_VERSION = 1
+STATUS_STATES = ("idle", "moving", "offline")
+
+
+def _cbor_head(major: int, n: int) -> bytes:
+    if n < 24:
+        return bytes([major << 5 | n])
+    for info, size in ((24, 1), (25, 2), (26, 4), (27, 8)):
+        if n < 1 << (size * 8):
+            return bytes([major << 5 | info]) + n.to_bytes(size, "big")
+    raise ValueError(f"CBOR で表現できない値: {n}")
+
+
+def _cbor_item(v) -> bytes:
+    if v is None:
+        return b"\xf6"
+    if isinstance(v, bool):
+        return b"\xf5" if v else b"\xf4"
+    if isinstance(v, int):
+        return _cbor_head(0, v) if v >= 0 else _cbor_head(1, -1 - v)
+    if isinstance(v, str):
+        b = v.encode("utf-8")
+        return _cbor_head(3, len(b)) + b
+    if isinstance(v, (list, tuple)):
+        return _cbor_head(4, len(v)) + b"".join(_cbor_item(x) for x in v)
+    raise TypeError(f"CBOR 非対応の型: {type(v).__name__}")
+
+
+def _cbor_take(data: bytes, pos: int, n: int) -> int:
+    """data[pos:pos + n] が範囲内か確認し、終端位置を返す"""
+    end = pos + n
+    if end > len(data):
+        raise ValueError(f"CBOR が途中で終わっている（{len(data)} バイト中 {end} バイト目まで必要）")
+    return end
+
+
+def _cbor_read(data: bytes, pos: int):
+    _cbor_take(data, pos, 1)
+    ib = data[pos]
+    major, info = ib >> 5, ib & 0x1F
+    pos += 1
+    if major == 7:
+        simple = {20: False, 21: True, 22: None}
+        if info not in simple:
+            raise ValueError(f"CBOR 非対応の simple 値: {info}")
+        return simple[info], pos
+    if info < 24:
+        n = info
+    elif info in (24, 25, 26, 27):
+        size = 1 << (info - 24)
+        end = _cbor_take(data, pos, size)
+        n = int.from_bytes(data[pos:end], "big")
+        pos = end
+    else:
+        raise ValueError(f"CBOR 非対応の長さ表現: {info}")
+    if major == 0:
+        return n, pos
+    if major == 1:
+        return -1 - n, pos
+    if major == 3:
+        end = _cbor_take(data, pos, n)
+        return data[pos:end].decode("utf-8"), end
+    if major == 4:
+        items = []
+        for _ in range(n):
+            item, pos = _cbor_read(data, pos)
+            items.append(item)
+        return items, pos
+    raise ValueError(f"CBOR 非対応の major type: {major}")
+
+
+def encode_status_binary(payload: dict) -> bytes:
+    """ステータス（dict）をバイナリ形式に符号化"""
+    state = payload["state"]
+    code = STATUS_STATES.index(state) if state in STATUS_STATES else state
+    updated = payload["updatedAt"]
+    hb = payload.get("heartbeatAt")
+    hb_delta = None if hb is None else hb - updated
+    return bytes([STATUS_BINARY_VERSION]) + _cbor_item(
+        [code, updated, hb_delta, payload.get("requestId")]
+    )
+
+
+def decode_status_binary(data: bytes) -> dict:
+    """バイナリ形式のステータスを dict（JSON 版と同じキー）に戻す"""
+    if not data or data[0] != STATUS_BINARY_VERSION:
+        raise ValueError(f"未対応のスキーマバージョン: {data[:1]!r}")
+    items, end = _cbor_read(data, 1)
+    if end != len(data):
+        raise ValueError(f"ステータスの後ろに余分なデータ: {len(data) - end} バイト")
+    if not isinstance(items, list) or len(items) != 4:
+        raise ValueError(f"ステータスの配列が不正: {items!r}")
+    code, updated, hb_delta, req_id = items
+    if isinstance(code, int) and not isinstance(code, bool):
+        if not 0 <= code < len(STATUS_STATES):
+            raise ValueError(f"未知の状態コード: {code}")
+        state = STATUS_STATES[code]
+    elif isinstance(code, str):
+        state = code
+    else:
+        raise ValueError(f"状態の型が不正: {code!r}")
+    for name, v in (("updatedAt", updated), ("heartbeatAt", hb_delta)):
+        if v is not None and (not isinstance(v, int) or isinstance(v, bool)):
+            raise ValueError(f"{name} の型が不正: {v!r}")
+    if updated is None:
+        raise ValueError("updatedAt がない")
+    if req_id is not None and not isinstance(req_id, str):
+        raise ValueError(f"requestId の型が不正: {req_id!r}")
+    payload = {"state": state, "updatedAt": updated}
+    if hb_delta is not None:
+        payload["heartbeatAt"] = updated + hb_delta
+    if req_id is not None:
+        payload["requestId"] = req_id
+    return payload
+
+
+# ========= ベンチマーク =========
+def bench(n: int = 100000):
+    """代表ペイロードの encode/decode を各バックエンドで計測（µs/件）"""
+    status = {
+        "state": "moving",
+        "updatedAt": 1700000000000,
+        "heartbeatAt": 1700000000000,
+        "requestId": "1700000000000-abc123",
+    }
+    shadow = {
+        "state": {
+            "reported": {
+                "state": "idle",
+                "version": 42,
+                "updatedAt": 1700000000000,
+            }
+        }
+    }
+    call = b'{"requestId":"1700000000000-abc123","dest":"A-01"}'
+
+    print(f"{'backend':<8} {'status.enc':>11} {'shadow.enc':>11} {'call.dec':>11}")
+    for name in BACKENDS:
+        c = BACKENDS[name]()
+        results = []
+        for fn, arg in (
+            (c.encode_status, status),
+            (c.encode_shadow, shadow["state"]["reported"]),
+            (c.decode_call, call),
+        ):
+            t0 = time.perf_counter()
+            for _ in range(n):
+                fn(arg)
+            results.append((time.perf_counter() - t0) / n * 1e6)
+        print(f"{name:<8} " + " ".join(f"{r:>9.2f}us" for r in results))
+
+    print(
+        f"status size: json={len(JsonCodec().encode(status))}B"
+        f" binary={len(encode_status_binary(status))}B"
+    )
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+役割: ローカル検証用の AWS IoT Core スタンドイン（MQTT 3.1.1 ブローカー、TLS なし）
+- 通常トピックは購読者へ配送（retain / LWT / QoS0・1 に対応）
+- $aws/certificates/create/json（CreateKeysAndCertificate）を模擬
+- $aws/provisioning-templates/<template>/provision/json（RegisterThing）を模擬
+- $aws/things/<thing>/shadow[/name/<shadow>]/get|update（Device Shadow）を模擬
+※ 証明書/鍵はダミー文字列。本物の AWS と同様、API 応答は要求元の接続にだけ返す。
+
+使い方:
+    python iot_standin.py --port 1883 [--throttle 0.1] [--latency-ms 50]
+    python provision_and_verify.py --endpoint 127.0.0.1 --port 1883 --no-tls --batch devices.csv
+"""
+
+import argparse
+import asyncio
+import base64
+import os
+import random
+import struct
+import time
+import uuid
+
+import codec
+
+# MQTT パケット種別
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+CREATE_TOPIC = "$aws/certificates/create/json"
+PROVISION_PREFIX = "$aws/provisioning-templates/"
+PROVISION_SUFFIX = "/provision/json"
+
+
+# ======== MQTT 符号化 =========
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        b = n % 128
+        n //= 128
+        out.append(b | 0x80 if n else b)
+        if not n:
+            return bytes(out)
+
+
+def _str(s: str) -> bytes:
+    b = s.encode("utf-8")
+    return struct.pack("!H", len(b)) + b
+
+
+def _packet(ptype: int, flags: int, body: bytes) -> bytes:
+    return bytes([ptype << 4 | flags]) + _varint(len(body)) + body
+
+
+def topic_matches(flt: str, topic: str) -> bool:
+    """MQTT トピックフィルタ（+ / #）の一致判定。$ で始まるトピックはワイルドカード先頭に一致しない"""
+    if topic.startswith("$") and flt[:1] in ("+", "#"):
+        return False
+    fp, tp = flt.split("/"), topic.split("/")
+    for i, f in enumerate(fp):
+        if f == "#":
+            return True
+        if i >= len(tp) or (f != "+" and f != tp[i]):
+            return False
+    return len(fp) == len(tp)
+
+
+# ======== 接続 =========
+class Session:
+    def __init__(self, broker, reader, writer):
+        self.broker = broker
+        self.reader = reader
+        self.writer = writer
+        self.client_id = None
+        self.subs = {}  # filter -> qos
+        self.will = None  # (topic, payload, qos, retain)
+        self._next_pid = 0
+
+    def send_publish(self, topic: str, payload: bytes, qos: int, retain=False):
+        flags = (qos << 1) | (1 if retain else 0)
+        body = _str(topic)
+        if qos:
+            self._next_pid = self._next_pid % 65535 + 1
+            body += struct.pack("!H", self._next_pid)
+        self.writer.write(_packet(PUBLISH, flags, body + payload))
+
+    async def read_packet(self):
+        h = await self.reader.readexactly(1)
+        mult, length = 1, 0
+        while True:
+            b = (await self.reader.readexactly(1))[0]
+            length += (b & 0x7F) * mult
+            if not b & 0x80:
+                break
+            mult *= 128
+        body = await self.reader.readexactly(length) if length else b""
+        return h[0] >> 4, h[0] & 0x0F, body
+
+    async def serve(self):
+        clean = False
+        try:
+            while True:
+                ptype, flags, body = await self.read_packet()
+                if ptype == CONNECT:
+                    self._on_connect(body)
+                elif ptype == PUBLISH:
+                    await self._on_publish(flags, body)
+                elif ptype == SUBSCRIBE:
+                    self._on_subscribe(body)
+                elif ptype == UNSUBSCRIBE:
+                    self._on_unsubscribe(body)
+                elif ptype == PINGREQ:
+                    self.writer.write(_packet(PINGRESP, 0, b""))
+                elif ptype == DISCONNECT:
+                    clean = True
+                    return
+                await self.writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.broker.sessions.discard(self)
+            if not clean and self.will:
+                await self.broker.route(*self.will)
+            self.writer.close()
+
+    def _on_connect(self, body: bytes):
+        pos = 2 + struct.unpack("!H", body[:2])[0]  # protocol name
+        pos += 1  # protocol level
+        cflags = body[pos]
+        pos += 3  # flags + keepalive
+
+        def take():
+            nonlocal pos
+            n = struct.unpack("!H", body[pos : pos + 2])[0]
+            v = body[pos + 2 : pos + 2 + n]
+            pos += 2 + n
+            return v
+
+        self.client_id = take().decode("utf-8") or f"anon-{uuid.uuid4().hex[:8]}"
+        if cflags & 0x04:
+            will_topic = take().decode("utf-8")
+            will_msg = take()
+            self.will = (will_topic, will_msg, (cflags >> 3) & 0x03, bool(cflags & 0x20))
+        # 同一クライアントIDの既存接続は切断（AWS IoT と同じ挙動）
+        for other in list(self.broker.sessions):
+            if other.client_id == self.client_id:
+                other.writer.close()
+        self.broker.sessions.add(self)
+        self.writer.write(_packet(CONNACK, 0, b"\x00\x00"))
+        print(f"[STANDIN] connect: {self.client_id}")
+
+    async def _on_publish(self, flags: int, body: bytes):
+        qos = (flags >> 1) & 0x03
+        retain = bool(flags & 0x01)
+        n = struct.unpack("!H", body[:2])[0]
+        topic = body[2 : 2 + n].decode("utf-8")
+        pos = 2 + n
+        if qos:
+            pid = body[pos : pos + 2]
+            pos += 2
+            self.writer.write(_packet(PUBACK, 0, pid))
+        payload = body[pos:]
+        if topic.startswith("$aws/"):
+            asyncio.ensure_future(self.broker.handle_api(self, topic, payload))
+        else:
+            await self.broker.route(topic, payload, qos, retain)
+
+    def _on_subscribe(self, body: bytes):
+        pid, pos, granted = body[:2], 2, bytearray()
+        while pos < len(body):
+            n = struct.unpack("!H", body[pos : pos + 2])[0]
+            flt = body[pos + 2 : pos + 2 + n].decode("utf-8")
+            qos = min(body[pos + 2 + n], 1)
+            pos += 3 + n
+            self.subs[flt] = qos
+            granted.append(qos)
+            for topic, (payload, rqos) in self.broker.retained.items():
+                if topic_matches(flt, topic):
+                    self.send_publish(topic, payload, min(qos, rqos), retain=True)
+        self.writer.write(_packet(SUBACK, 0, pid + bytes(granted)))
+
+    def _on_unsubscribe(self, body: bytes):
+        pid, pos = body[:2], 2
+        while pos < len(body):
+            n = struct.unpack("!H", body[pos : pos + 2])[0]
+            self.subs.pop(body[pos + 2 : pos + 2 + n].decode("utf-8"), None)
+            pos += 2 + n
+        self.writer.write(_packet(UNSUBACK, 0, pid))
+
+
+# ======== ブローカー + AWS IoT API 模擬 =========
+class Broker:
+    def __init__(self, throttle: float = 0.0, latency_ms: int = 0):
+        self.sessions = set()
+        self.retained = {}  # topic -> (payload, qos)
+        self.throttle = throttle
+        self.latency = latency_ms / 1000.0
+        self.tokens = {}  # certificateOwnershipToken -> certificateId
+        self.shadows = {}  # shadow base topic -> (version, reported)
+        self.stats = {"create": 0, "provision": 0, "throttled": 0, "connects": 0}
+
+    async def route(self, topic: str, payload: bytes, qos: int, retain=False):
+        if retain:
+            if payload:
+                self.retained[topic] = (payload, qos)
+            else:
+                self.retained.pop(topic, None)
+        for s in list(self.sessions):
+            granted = [q for f, q in s.subs.items() if topic_matches(f, topic)]
+            if granted:
+                s.send_publish(topic, payload, min(qos, max(granted)))
+                try:
+                    await s.writer.drain()
+                except ConnectionError:
+                    pass
+
+    def _reply(self, session, topic: str, obj):
+        # API 応答は要求元の接続にのみ返す（購読していなければ届かない）
+        if any(topic_matches(f, topic) for f in session.subs):
+            session.send_publish(topic, codec.encode(obj), 1)
+
+    def _throttled(self, session, base: str) -> bool:
+        if self.throttle and random.random() < self.throttle:
+            self.stats["throttled"] += 1
+            self._reply(
+                session,
+                base + "/rejected",
+                {"statusCode": 429, "errorCode": "Throttled", "errorMessage": "Rate exceeded"},
+            )
+            return True
+        return False
+
+    async def handle_api(self, session, topic: str, payload: bytes):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        try:
+            req = codec.decode(payload) if payload else {}
+        except ValueError:
+            req = None
+
+        if topic == CREATE_TOPIC:
+            if not self._throttled(session, topic):
+                self.stats["create"] += 1
+                cert_id = uuid.uuid4().hex * 2
+                token = base64.b64encode(os.urandom(48)).decode("ascii")
+                self.tokens[token] = cert_id
+                self._reply(
+                    session,
+                    topic + "/accepted",
+                    {
+                        "certificateId": cert_id,
+                        "certificatePem": _fake_pem("CERTIFICATE"),
+                        "privateKey": _fake_pem("RSA PRIVATE KEY"),
+                        "certificateOwnershipToken": token,
+                    },
+                )
+        elif topic.startswith(PROVISION_PREFIX) and topic.endswith(PROVISION_SUFFIX):
+            if not self._throttled(session, topic):
+                token = (req or {}).get("certificateOwnershipToken")
+                params = (req or {}).get("parameters") or {}
+                if token not in self.tokens:
+                    self._reply(
+                        session,
+                        topic + "/rejected",
+                        {
+                            "statusCode": 400,
+                            "errorCode": "InvalidCertificateOwnershipToken",
+                            "errorMessage": "Certificate ownership token is invalid",
+                        },
+                    )
+                else:
+                    del self.tokens[token]
+                    self.stats["provision"] += 1
+                    thing = params.get("ThingName") or f"AMR-{params.get('SerialNumber', 'UNKNOWN')}"
+                    self._reply(
+                        session,
+                        topic + "/accepted",
+                        {"deviceConfiguration": {}, "thingName": thing},
+                    )
+        elif "/shadow" in topic and topic.endswith(("/get", "/update")):
+            self._handle_shadow(session, topic, req)
+        if not session.writer.is_closing():
+            await session.writer.drain()
+
+    def _handle_shadow(self, session, topic: str, req):
+        base, op = topic.rsplit("/", 1)
+        token = (req or {}).get("clientToken")
+        now = int(time.time())
+        if op == "get":
+            if base not in self.shadows:
+                resp = {"code": 404, "message": f"No shadow exists: {base}"}
+                if token:
+                    resp["clientToken"] = token
+                self._reply(session, topic + "/rejected", resp)
+                return
+            version, reported = self.shadows[base]
+            resp = {"state": {"reported": reported}, "version": version, "timestamp": now}
+            if token:
+                resp["clientToken"] = token
+            self._reply(session, topic + "/accepted", resp)
+        else:
+            patch = ((req or {}).get("state") or {}).get("reported")
+            if not isinstance(patch, dict):
+                self._reply(session, topic + "/rejected", {"code": 400, "message": "Missing required node: state"})
+                return
+            version, reported = self.shadows.get(base, (0, {}))
+            reported = dict(reported, **patch)
+            self.shadows[base] = (version + 1, reported)
+            resp = {"state": {"reported": patch}, "version": version + 1, "timestamp": now}
+            if token:
+                resp["clientToken"] = token
+            self._reply(session, topic + "/accepted", resp)
+
+
+def _fake_pem(kind: str) -> str:
+    body = base64.encodebytes(os.urandom(96)).decode("ascii")
+    return f"-----BEGIN {kind}-----\n{body}-----END {kind}-----\n"
+
+
+async def start(broker: Broker, host: str = "127.0.0.1", port: int = 0):
+    """broker を待ち受けるサーバを開始して返す（port=0 で空きポート。テストから利用）"""
+
+    async def on_client(reader, writer):
+        broker.stats["connects"] += 1
+        await Session(broker, reader, writer).serve()
+
+    return await asyncio.start_server(on_client, host, port)
+
+
+async def amain(host: str, port: int, throttle: float, latency_ms: int):
+    broker = Broker(throttle=throttle, latency_ms=latency_ms)
+    server = await start(broker, host, port)
+    print(f"[STANDIN] listening on {host}:{port} (throttle={throttle}, latency={latency_ms}ms)")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        print(f"[STANDIN] stats: {broker.stats}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AWS IoT Core のローカルスタンドイン")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--throttle", type=float, default=0.0, help="API 応答を 429 で拒否する確率（0〜1）")
+    parser.add_argument("--latency-ms", type=int, default=0, help="API 応答までの遅延（ミリ秒）")
+    args = parser.parse_args()
+    try:
+        asyncio.run(amain(args.host, args.port, args.throttle, args.latency_ms))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -6,17 +6,27 @@ AWS IoT: MQTT 経由の証明書ローテーション E2E 検証スクリプト
 - $aws/certificates/create/json で新しい本番証明書/鍵を取得
 - $aws/provisioning-templates/<template>/provision/json で RegisterThing
 - 新本番証明書で再接続し、Shadow の GET 応答（accepted）で「有効化」を確認
+- --batch devices.csv で多数台を並列にプロビジョニング（量産時のオンボーディング）
 ※ すべて QoS=1。Publish 前に accepted/rejected を Subscribe 済みにする。
 """
 
-import os, ssl, json, time, stat, threading, argparse
+import os, time, stat, threading, argparse
+import csv, json, queue, random
+from collections import OrderedDict, deque
 import uuid
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
 from typing import Optional
 import paho.mqtt.client as mqtt
 
+import codec
+import tlsctx
+
 # ======== 設定 =========
 IOT_ENDPOINT = "a2osrgpri6xnln-ats.iot.ap-northeast-1.amazonaws.com"  # IoT データエンドポイント
 PORT = 8883
+USE_TLS = True  # False はローカルのスタンドイン（iot_standin.py）検証専用
 
 # claim（20年・更新専用）で最初に接続する
 CLAIM_CERT = "./certs/claim.crt"
@@ -35,6 +45,12 @@ PROVISION_TOPIC = f"$aws/provisioning-templates/{TEMPLATE_NAME}/provision/json"
 PROVISION_ACCEPTED = PROVISION_TOPIC + "/accepted"
 PROVISION_REJECTED = PROVISION_TOPIC + "/rejected"
 
+
+def provision_topics(template_name: str):
+    """RegisterThing の (要求, accepted, rejected) トピック"""
+    topic = f"$aws/provisioning-templates/{template_name}/provision/json"
+    return topic, topic + "/accepted", topic + "/rejected"
+
 # CreateKeysAndCertificate（MQTT API）
 CREATE_TOPIC = "$aws/certificates/create/json"
 CREATE_ACCEPTED = CREATE_TOPIC + "/accepted"
@@ -43,6 +59,19 @@ CREATE_REJECTED = CREATE_TOPIC + "/rejected"
 # RegisterThing の parameters（テンプレートのプレースホルダに合わせて）
 PARAMETERS = {"SerialNumber": "001"}  # 必要に応じて追加/変更
 
+# バッチ（--batch）設定
+BATCH_WORKERS = 8  # 同時に処理する台数
+BATCH_RETRIES = 3  # スロットリング/タイムアウト時の再試行回数
+BATCH_BACKOFF_BASE = 1.0  # 秒（指数バックオフの初期値。ジッタ付き）
+BATCH_BACKOFF_MAX = 30.0  # 秒
+BATCH_OUT_DIR = "./certs/fleet"  # <SerialNumber>.crt / .key の書き出し先
+BATCH_CLAIM_SESSIONS = 2  # 使い回す claim 接続数（0 で台ごとに接続）
+
+# 受信履歴（MqttSession）の上限
+HISTORY_PER_TOPIC = 16  # トピックごとに保持する件数（古いものから捨てる）
+HISTORY_MAX_TOPICS = 256  # 保持するトピック数（超えたら最も長く受信の無いトピックを捨てる）
+HISTORY_MAX_BYTES = 4 * 1024 * 1024  # 全トピック合計のペイロードサイズ
+
 # 検証方法：Shadow GET が accepted で返れば「本番証明書で有効」
 def shadow_topics(thing_name: str):
     base = f"$aws/things/{thing_name}/shadow"
@@ -55,10 +84,91 @@ def verify_topics(thing_name: str):
 
 
 # ======== ユーティリティ =========
+def fsync_dir(path: str):
+    """ディレクトリエントリ（rename 結果）をディスクへ反映
+
+    Windows はディレクトリを os.open できない（PermissionError）ので何もしない。
+    rename は既に済んでいるので、ディレクトリの fsync に失敗しても書込み自体は失敗扱いにしない。
+    """
+    if os.name == "nt":
+        return
+    try:
+        fd = os.open(path or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class BulkWrite:
+    """secure_write のディレクトリ fsync を commit() 時の 1 回にまとめる（一括プロビジョニング用）
+
+    各ファイル自体は書込み直後に fsync 済みで、rename によって常に完全な内容で見える。
+    まとめて遅らせるのは rename の永続化だけ。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dirs = set()
+        self.files = 0
+
+    def add(self, directory: str):
+        with self._lock:
+            self._dirs.add(directory)
+            self.files += 1
+
+    def commit(self):
+        with self._lock:
+            dirs, self._dirs = self._dirs, set()
+        for d in dirs:
+            fsync_dir(d)
+
+
+_bulk: Optional[BulkWrite] = None  # bulk_writes() の間だけ有効
+
+
+@contextmanager
+def bulk_writes():
+    """この中の secure_write はディレクトリ fsync を抜ける時に 1 回だけ行う"""
+    global _bulk
+    _bulk = BulkWrite()
+    try:
+        yield _bulk
+    finally:
+        bulk, _bulk = _bulk, None
+        bulk.commit()
+
+
 def secure_write(path: str, data: str, mode=0o600):
-    with open(path, "w") as f:
-        f.write(data)
-    os.chmod(path, mode)
+    """原子的に書き込む: 同じディレクトリに mode で一時ファイル作成 → fsync → rename → ディレクトリ fsync
+
+    途中で落ちても path は旧内容か新内容のどちらか（途中まで書かれた鍵は残らない）。
+    一時ファイルは作成時から mode のため、他ユーザーから読める瞬間も無い。
+    """
+    directory = os.path.dirname(path) or "."
+    tmp = os.path.join(directory, f".{os.path.basename(path)}.{uuid.uuid4().hex[:8]}.tmp")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, mode)  # umask で削られた分を戻す
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    if _bulk is not None:
+        _bulk.add(directory)
+    else:
+        fsync_dir(directory)
 
 def wait_event(evt: threading.Event, timeout: float, what: str):
     if not evt.wait(timeout):
@@ -67,32 +177,54 @@ def wait_event(evt: threading.Event, timeout: float, what: str):
 
 # ======== MQTT クライアント（共通） =========
 class MqttSession:
-    def __init__(self, client_id: str, certfile: str, keyfile: str):
+    """接続先・TLS 設定は引数で指定（省略時はモジュールの設定値。他スクリプトからは明示して渡す）"""
+
+    def __init__(self, client_id: str, certfile: str, keyfile: str, endpoint: Optional[str] = None,
+                 port: Optional[int] = None, root_ca: Optional[str] = None, use_tls: Optional[bool] = None):
+        self.endpoint = endpoint or IOT_ENDPOINT
+        self.port = port or PORT
         self.client = mqtt.Client(client_id=client_id, clean_session=True, protocol=mqtt.MQTTv311)
-        self.client.tls_set(
-            ca_certs=ROOT_CA,
-            certfile=certfile,
-            keyfile=keyfile,
-            cert_reqs=ssl.CERT_REQUIRED,
-            tls_version=ssl.PROTOCOL_TLS_CLIENT,
-        )
-        self.client.tls_insecure_set(False)
+        if USE_TLS if use_tls is None else use_tls:
+            # 同じ証明書の接続（claim 接続の張り直し・本番証明書での再接続）はコンテキストと TLS セッションを共有
+            self.client.tls_set_context(tlsctx.get_context(root_ca or ROOT_CA, certfile, keyfile))
+            self.client.tls_insecure_set(False)
         self.client.on_connect = self._on_connect
         self.client.on_subscribe = self._on_subscribe
         self.client.on_message = self._on_message
         self.client.on_disconnect = self._on_disconnect
 
         self._connected = threading.Event()
-        self._messages = {}  # topic -> last json payload
-        self._suback = threading.Event()
+        self._cond = threading.Condition()  # 受信通知（wait_message 用）
+        self._seq = 0  # 受信通番
+        # topic -> deque[(seq, json payload, size)]。受信の新しいトピックほど末尾（LRU）
+        self._messages = OrderedDict()
+        self._history_bytes = 0
+        self._subacks = {}  # mid -> granted_qos（SUBACK 到着済み、subscribe が回収）
+        self._unawaited = set()  # 待つ呼び出し元の無い mid（再接続時の再購読・タイムアウト済み）
+        self._topics = []  # 購読済みトピック（再接続時に再購読）
         self.client.on_subscribe = self._on_subscribe
 
     def _on_subscribe(self, c, userdata, mid, granted_qos, properties=None):
-        self._suback.set()
+        with self._cond:
+            if mid in self._unawaited:
+                # 回収されない SUBACK は保持しない（拒否だけは記録に残す）
+                self._unawaited.discard(mid)
+                if 0x80 in granted_qos:
+                    print(f"[WARN] 再購読が拒否された: mid={mid} granted={list(granted_qos)}")
+                return
+            self._subacks[mid] = list(granted_qos)
+            self._cond.notify_all()
 
     def _on_connect(self, c, userdata, flags, rc):
         if rc == 0:
             print(f"[OK] Connected: rc={rc}")
+            # clean_session のため、自動再接続後は購読をやり直す
+            if self._connected.is_set() and self._topics:
+                # SUBACK は同じネットワークスレッドで後から届くため、ここで登録すれば取りこぼさない
+                rc, mid = c.subscribe([(tp, 1) for tp in self._topics])
+                if rc == mqtt.MQTT_ERR_SUCCESS:
+                    with self._cond:
+                        self._unawaited.add(mid)
             self._connected.set()
         else:
             print(f"[ERR] Connect failed: rc={rc}")
@@ -102,18 +234,43 @@ class MqttSession:
 
     def _on_message(self, c, userdata, msg):
         try:
-            payload = msg.payload.decode("utf-8") if msg.payload else ""
-            js = json.loads(payload) if payload else {}
+            js = codec.decode(msg.payload) if msg.payload else {}
         except Exception:
             js = {"_raw": msg.payload.decode("utf-8", errors="ignore")}
-        self._messages[msg.topic] = js
+        with self._cond:
+            self._seq += 1
+            self._record(msg.topic, (self._seq, js, len(msg.payload)))
+            self._cond.notify_all()
         print(f"[MSG] {msg.topic} -> {js}")
 
+    def _record(self, topic: str, entry):
+        """受信履歴に追加し、件数・トピック数・合計サイズの上限を守る（_cond 保持中に呼ぶ）"""
+        hist = self._messages.get(topic)
+        if hist is None:
+            hist = self._messages[topic] = deque()
+        else:
+            self._messages.move_to_end(topic)
+        hist.append(entry)
+        self._history_bytes += entry[2]
+        if len(hist) > HISTORY_PER_TOPIC:
+            self._history_bytes -= hist.popleft()[2]
+        # 受信の途絶えたトピックから捨てる（今受信したトピックは残す）
+        while len(self._messages) > 1 and (
+            len(self._messages) > HISTORY_MAX_TOPICS or self._history_bytes > HISTORY_MAX_BYTES
+        ):
+            _, old = self._messages.popitem(last=False)
+            self._history_bytes -= sum(e[2] for e in old)
+        while len(hist) > 1 and self._history_bytes > HISTORY_MAX_BYTES:
+            self._history_bytes -= hist.popleft()[2]
+
     def connect(self):
-        self.client.connect(IOT_ENDPOINT, PORT, keepalive=60)
+        self.client.connect(self.endpoint, self.port, keepalive=60)
         self.client.loop_start()
         wait_event(self._connected, 20, "MQTT 接続")
 
+    def is_connected(self) -> bool:
+        return self.client.is_connected()
+
     def disconnect(self):
         try:
             self.client.loop_stop()
@@ -124,22 +281,37 @@ class MqttSession:
         except Exception:
             pass
 
-    # def subscribe(self, topics_qos1):
-    #     # topics_qos1: list[str]
-    #     for tp in topics_qos1:
-    #         print(f"[SUB] {tp}")
-    #         self.client.subscribe(tp, qos=1)
     def subscribe(self, topics_qos1):
+        """全トピックを 1 つの SUBSCRIBE で送り、その mid の SUBACK を待つ（往復 1 回）"""
+        topics_qos1 = list(topics_qos1)
         for tp in topics_qos1:
             print(f"[SUB] {tp}")
-            self._suback.clear()
-            (rc, mid) = self.client.subscribe(tp, qos=1)
-            if rc != mqtt.MQTT_ERR_SUCCESS:
-                raise RuntimeError(f"Subscribe失敗: {tp} rc={rc}")
-            wait_event(self._suback, 5, f"SUBACK: {tp}")
+        (rc, mid) = self.client.subscribe([(tp, 1) for tp in topics_qos1])
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            raise RuntimeError(f"Subscribe失敗: {topics_qos1} rc={rc}")
+        granted = self._wait_suback(mid, 5, f"SUBACK: {topics_qos1}")
+        # 0x80 はブローカ（ポリシー）による拒否
+        denied = [tp for tp, q in zip(topics_qos1, granted) if q == 0x80]
+        if denied:
+            raise RuntimeError(f"Subscribe が拒否された: {denied}")
+        for tp in topics_qos1:
+            if tp not in self._topics:
+                self._topics.append(tp)
+
+    def _wait_suback(self, mid: int, timeout: float, what: str) -> list:
+        """mid に対応する SUBACK を待って granted_qos を返す（他の mid の SUBACK では抜けない）"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while mid not in self._subacks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._unawaited.add(mid)  # 遅れて届いても保持しない
+                    raise TimeoutError(f"タイムアウト: {what}")
+                self._cond.wait(remaining)
+            return self._subacks.pop(mid)
 
     def publish_json(self, topic: str, obj):
-        payload = json.dumps(obj).encode("utf-8")
+        payload = codec.encode(obj)
         print(f"[PUB] {topic} -> {obj}")
         r = self.client.publish(topic, payload=payload, qos=1)
         r.wait_for_publish()
@@ -147,50 +319,75 @@ class MqttSession:
             raise RuntimeError(f"Publish に失敗: {topic} rc={r.rc}")
 
     def last_message(self, topic: str) -> Optional[dict]:
-        return self._messages.get(topic)
+        with self._cond:
+            hist = self._messages.get(topic)
+            return hist[-1][1] if hist else None
+
+    def mark(self) -> int:
+        """現在の受信位置。Publish 前に取得し、wait_message(since=...) に渡す"""
+        with self._cond:
+            return self._seq
+
+    def wait_message(self, topics, timeout: float, since: int = 0, match=None, client_token=None):
+        """topics のいずれかに since より後のメッセージが届くまで待つ（ポーリングなし）
+
+        複数届いていれば最も早いものを返す。戻り値は (topic, payload)、タイムアウト時 None。
+        client_token を渡すと、その clientToken を持つ応答だけを対象にする（Shadow API）。
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                hits = []
+                for tp in topics:
+                    for seq, js, _ in self._messages.get(tp, ()):
+                        if seq <= since:
+                            continue
+                        if client_token is not None and (
+                            not isinstance(js, dict) or js.get("clientToken") != client_token
+                        ):
+                            continue
+                        if match is None or match(js):
+                            hits.append((seq, tp, js))
+                            break
+                if hits:
+                    _, tp, js = min(hits, key=lambda h: h[0])
+                    return tp, js
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
 
 
 # ======== メインフロー =========
-def run():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--thing", default=None, help="既知の Thing 名（テンプレート側で自動採番なら省略可）")
-    args = parser.parse_args()
+class RetryableError(RuntimeError):
+    """スロットリング等、時間をおいて再試行すれば回復し得る失敗"""
 
-    # --- 1) claim で接続 ---
-    claim_id = f"claim-{uuid.uuid4().hex[:8]}"
-    claim = MqttSession(client_id=claim_id, certfile=CLAIM_CERT, keyfile=CLAIM_KEY)
-    claim.connect()
 
-    # 受信（accepted/rejected）を先に subscribe
-    claim.subscribe([CREATE_ACCEPTED, CREATE_REJECTED, PROVISION_ACCEPTED, PROVISION_REJECTED])
+def check_rejected(what: str, topic: str, resp: dict, rejected_topic: str):
+    """rejected 応答なら例外（429/503・Throttling は RetryableError）"""
+    if topic != rejected_topic:
+        return
+    code = resp.get("statusCode")
+    err = str(resp.get("errorCode", ""))
+    if code in (429, 503) or "Throttl" in err:
+        raise RetryableError(f"{what} がスロットリング: {resp}")
+    raise RuntimeError(f"{what} が rejected: {resp}")
 
+
+def create_and_register(claim: MqttSession, params: dict, cert_out: str, key_out: str,
+                        template_name: Optional[str] = None) -> str:
+    """claim セッション上で CreateKeysAndCertificate → RegisterThing。thingName を返す"""
+    provision_topic, provision_accepted, provision_rejected = provision_topics(template_name or TEMPLATE_NAME)
     # --- 2) 新しい鍵/証明書を作成 ---
-    create_ev = threading.Event()
-    provision_ev = threading.Event()
-
-    def wait_create():
-        # ポーリングで簡易待機（受信は callback が埋める）
-        for _ in range(200):  # ~20秒
-            m = claim.last_message(CREATE_ACCEPTED) or claim.last_message(CREATE_REJECTED)
-            if m:
-                return m
-            time.sleep(0.1)
-        return None
-
-    def wait_provision():
-        for _ in range(300):  # ~30秒
-            m = claim.last_message(PROVISION_ACCEPTED) or claim.last_message(PROVISION_REJECTED)
-            if m:
-                return m
-            time.sleep(0.1)
-        return None
-
-    # Publish（空 JSON）
+    # Publish（空 JSON）。応答（accepted/rejected）が届いた時点で待機を抜ける
+    mark = claim.mark()
     claim.publish_json(CREATE_TOPIC, {})
 
-    resp = wait_create()
-    if resp is None:
+    got = claim.wait_message([CREATE_ACCEPTED, CREATE_REJECTED], 20, since=mark)
+    if got is None:
         raise TimeoutError("CreateKeysAndCertificate の応答なし")
+    topic, resp = got
+    check_rejected("CreateKeysAndCertificate", topic, resp, CREATE_REJECTED)
     if "certificatePem" not in resp or "privateKey" not in resp or "certificateOwnershipToken" not in resp:
         raise RuntimeError(f"CreateKeysAndCertificate が失敗: {resp}")
 
@@ -199,103 +396,381 @@ def run():
     token = resp["certificateOwnershipToken"]
 
     # 書き出し（0600）
-    os.makedirs(os.path.dirname(NEW_CERT_OUT), exist_ok=True)
-    secure_write(NEW_CERT_OUT, new_cert_pem, 0o600)
-    secure_write(NEW_KEY_OUT, new_priv_key, 0o600)
-    print(f"[OK] 新しい本番証明書/鍵を書き出し: {NEW_CERT_OUT}, {NEW_KEY_OUT}")
+    os.makedirs(os.path.dirname(cert_out), exist_ok=True)
+    secure_write(cert_out, new_cert_pem, 0o600)
+    secure_write(key_out, new_priv_key, 0o600)
+    print(f"[OK] 新しい本番証明書/鍵を書き出し: {cert_out}, {key_out}")
 
     # --- 3) RegisterThing（provision）---
-    params = dict(PARAMETERS)  # コピー
-    if args.thing:
-        # テンプレートが ThingName を受けるならここで渡す（テンプレート側に合わせて key 名を調整）
-        params.setdefault("ThingName", args.thing)
-
-    claim.publish_json(PROVISION_TOPIC, {
+    mark = claim.mark()
+    claim.publish_json(provision_topic, {
         "certificateOwnershipToken": token,
         "parameters": params
     })
 
-    resp2 = wait_provision()
-    if resp2 is None:
+    got = claim.wait_message([provision_accepted, provision_rejected], 30, since=mark)
+    if got is None:
         raise TimeoutError("RegisterThing (provision) の応答なし")
-    if resp2 is claim.last_message(PROVISION_REJECTED):
-        raise RuntimeError(f"RegisterThing が rejected: {resp2}")
+    topic2, resp2 = got
+    check_rejected("RegisterThing", topic2, resp2, provision_rejected)
 
     # 期待ペイロードの一例: {"thingName": "...", ...}
     thing_name = resp2.get("thingName") or params.get("ThingName") or "UNKNOWN"
     print(f"[OK] RegisterThing accepted: thingName={thing_name}")
+    return thing_name
+
+
+class ClaimSession:
+    """1 本の claim 接続を使い回し、複数台を順番にプロビジョニングする
+
+    CreateKeysAndCertificate / RegisterThing の応答には要求を識別する値が無いため、
+    1 接続あたりの要求は常に 1 件（ロックで直列化）とし、Publish 前の mark() 以降に
+    届いた応答をその要求のものとみなす。タイムアウト後は遅れて届く応答と
+    取り違えないよう、接続を張り直す。
+
+    claim 証明書・テンプレート名・接続先（MqttSession の引数）は省略時はモジュールの設定値。
+    """
+
+    def __init__(self, claim_cert: Optional[str] = None, claim_key: Optional[str] = None,
+                 template_name: Optional[str] = None, **connection):
+        self.claim_cert = claim_cert or CLAIM_CERT
+        self.claim_key = claim_key or CLAIM_KEY
+        self.template_name = template_name or TEMPLATE_NAME
+        self.connection = connection  # endpoint / port / root_ca / use_tls
+        self._lock = threading.Lock()
+        self._session: Optional[MqttSession] = None
+        self.served = 0  # この接続で登録した台数
+        self.connects = 0  # 接続（TLS ハンドシェイク）回数
+
+    def _open(self) -> MqttSession:
+        if self._session is not None and self._session.is_connected():
+            return self._session
+        self._close()
+        session = MqttSession(client_id=f"claim-{uuid.uuid4().hex[:8]}", certfile=self.claim_cert,
+                              keyfile=self.claim_key, **self.connection)
+        session.connect()
+        try:
+            _, provision_accepted, provision_rejected = provision_topics(self.template_name)
+            session.subscribe([CREATE_ACCEPTED, CREATE_REJECTED, provision_accepted, provision_rejected])
+        except Exception:
+            session.disconnect()
+            raise
+        self._session = session
+        self.connects += 1
+        return session
+
+    def _close(self):
+        if self._session is not None:
+            self._session.disconnect()
+            self._session = None
+
+    def provision(self, params: dict, cert_out: str, key_out: str) -> str:
+        with self._lock:
+            session = self._open()
+            try:
+                thing_name = create_and_register(session, params, cert_out, key_out, self.template_name)
+            except TimeoutError:
+                self._close()
+                raise
+            self.served += 1
+            return thing_name
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+class ClaimPool:
+    """ClaimSession の貸し出し（空きが無ければ返却を待つ）"""
+
+    def __init__(self, size: int):
+        self.sessions = [ClaimSession() for _ in range(size)]
+        self._free = queue.Queue()
+        for cs in self.sessions:
+            self._free.put(cs)
+
+    @contextmanager
+    def acquire(self):
+        cs = self._free.get()
+        try:
+            yield cs
+        finally:
+            self._free.put(cs)
 
-    # claim セッションを終了
-    claim.disconnect()
-    time.sleep(1.0)
+    def close(self):
+        for cs in self.sessions:
+            cs.close()
 
-    # --- 4) 新・本番証明書で再接続して検証 ---
+
+def verify_production(thing_name: str, cert_out: str, key_out: str) -> bool:
+    """新・本番証明書で接続し、Shadow GET と自エコーで権限を確認"""
     # prod_id = f"{thing_name}-prod-{uuid.uuid4().hex[:4]}"
     prod_id = thing_name
-    prod = MqttSession(client_id=prod_id, certfile=NEW_CERT_OUT, keyfile=NEW_KEY_OUT)
+    prod = MqttSession(client_id=prod_id, certfile=cert_out, keyfile=key_out)
     prod.connect()
-
-    # 検証1：Shadow GET → accepted が返るか
-    get_topic, get_acc, get_rej = shadow_topics(thing_name)
-    # prod.subscribe([get_acc, get_rej])
-    # GET/UPDATE の両方を購読
-    upd_topic_acc = f"$aws/things/{thing_name}/shadow/update/accepted"
-    upd_topic_rej = f"$aws/things/{thing_name}/shadow/update/rejected"
-    prod.subscribe([get_acc, get_rej, upd_topic_acc, upd_topic_rej])
-    prod.publish_json(get_topic, {})  # GET は空 JSON
-
-    ok = False
-    for _ in range(200):  # ~20秒
-        if prod.last_message(get_acc):
-            print(f"[OK] Shadow GET accepted を受信。新本番証明書での権限有効を確認。")
-            ok = True
-            break
-        # if prod.last_message(get_rej):
-        #     raise RuntimeError(f"Shadow GET が rejected: {prod.last_message(get_rej)}")
-        rej = prod.last_message(get_rej)
-        if rej:
+    try:
+        # 検証1：Shadow GET → accepted が返るか
+        get_topic, get_acc, get_rej = shadow_topics(thing_name)
+        # GET/UPDATE の両方を購読
+        upd_topic_acc = f"$aws/things/{thing_name}/shadow/update/accepted"
+        upd_topic_rej = f"$aws/things/{thing_name}/shadow/update/rejected"
+        prod.subscribe([get_acc, get_rej, upd_topic_acc, upd_topic_rej])
+        token = uuid.uuid4().hex
+        mark = prod.mark()
+        prod.publish_json(get_topic, {"clientToken": token})  # 応答を clientToken で突き合わせる
+
+        ok = False
+        deadline = time.monotonic() + 20
+        while not ok:
+            got = prod.wait_message([get_acc, get_rej], deadline - time.monotonic(), since=mark, client_token=token)
+            if got is None:
+                break
+            topic, m = got
+            if topic == get_acc:
+                print(f"[OK] Shadow GET accepted を受信。新本番証明書での権限有効を確認。")
+                ok = True
+                break
             # 404: Shadow がまだ存在しない → 最小 update で作ってから再GET
-            if rej.get("code") == 404:
-                print("[INFO] Shadow が未作成。最小 update で作成します。")
-                # 端末の“自己紹介”など、無害な reported を1つ置く
-                init_doc = {"state": {"reported": {"_init": True, "ts": int(time.time())}}}
-                prod.publish_json(f"$aws/things/{thing_name}/shadow/update", init_doc)
-                # update/accepted 待ち
-                for _ in range(200):
-                    if prod.last_message(upd_topic_acc):
-                        print("[OK] Shadow update accepted（初期作成）。再度 GET します。")
-                        break
-                    err2 = prod.last_message(upd_topic_rej)
-                    if err2:
-                        raise RuntimeError(f"Shadow update が rejected: {err2}")
-                    time.sleep(0.1)
-                # 再GET
-                prod.publish_json(get_topic, {})
-                # 以降のループで拾う
-            else:
-                raise RuntimeError(f"Shadow GET が rejected: {rej}")
-        time.sleep(0.1)
-
-    # 検証2：自エコー（任意）。Subscribeして Publish → 自分自身にも配信されることを確認
-    if ok:
-        v_pub, v_sub = verify_topics(thing_name)
-        prod.subscribe([v_sub])
-        payload = {"ts": int(time.time()), "msg": "cert-rotation-verify"}
-        prod.publish_json(v_pub, payload)
-
-        echoed = False
-        for _ in range(100):
-            m = prod.last_message(v_sub)
-            if m and m.get("msg") == "cert-rotation-verify":
-                echoed = True
+            if m.get("code") != 404:
+                raise RuntimeError(f"Shadow GET が rejected: {m}")
+            print("[INFO] Shadow が未作成。最小 update で作成します。")
+            # 端末の“自己紹介”など、無害な reported を1つ置く
+            init_doc = {"state": {"reported": {"_init": True, "ts": int(time.time())}}, "clientToken": token}
+            mark = prod.mark()
+            prod.publish_json(f"$aws/things/{thing_name}/shadow/update", init_doc)
+            # update/accepted 待ち
+            upd = prod.wait_message([upd_topic_acc, upd_topic_rej], 20, since=mark, client_token=token)
+            if upd and upd[0] == upd_topic_rej:
+                raise RuntimeError(f"Shadow update が rejected: {upd[1]}")
+            if upd:
+                print("[OK] Shadow update accepted（初期作成）。再度 GET します。")
+            # 再GET（以降のループで拾う）
+            mark = prod.mark()
+            prod.publish_json(get_topic, {"clientToken": token})
+
+        # 検証2：自エコー（任意）。Subscribeして Publish → 自分自身にも配信されることを確認
+        if ok:
+            v_pub, v_sub = verify_topics(thing_name)
+            prod.subscribe([v_sub])
+            payload = {"ts": int(time.time()), "msg": "cert-rotation-verify"}
+            mark = prod.mark()
+            prod.publish_json(v_pub, payload)
+
+            echoed = prod.wait_message(
+                [v_sub], 10, since=mark, match=lambda m: m.get("msg") == "cert-rotation-verify"
+            ) is not None
+            if echoed:
                 print("[OK] 検証 Publish を自分で受信できた（トピック権限 OK）")
+            else:
+                print("[WARN] 自エコーは未確認（Subscribe/Pub のタイミングやポリシー範囲を確認してください）")
+        return ok
+    finally:
+        prod.disconnect()
+
+
+def provision_device(params: dict, cert_out: str, key_out: str, claims: Optional[ClaimPool] = None) -> dict:
+    """1 台分: claim 接続 → 作成/登録 → 本番証明書で検証。工程ごとの所要時間を返す
+
+    claims を渡すと、claim 接続は新規に張らずプールの接続を使い回す。
+    """
+    timings = {}
+    t0 = time.monotonic()
+
+    if claims is not None:
+        with claims.acquire() as cs:
+            timings["claimWait"] = time.monotonic() - t0
+            t1 = time.monotonic()
+            thing_name = cs.provision(params, cert_out, key_out)
+            timings["register"] = time.monotonic() - t1
+        t2 = time.monotonic()
+        verified = verify_production(thing_name, cert_out, key_out)
+        timings["verify"] = time.monotonic() - t2
+        timings["total"] = time.monotonic() - t0
+        return {"thingName": thing_name, "verified": verified, "timings": timings}
+
+    # --- 1) claim で接続 ---
+    claim_id = f"claim-{uuid.uuid4().hex[:8]}"
+    claim = MqttSession(client_id=claim_id, certfile=CLAIM_CERT, keyfile=CLAIM_KEY)
+    claim.connect()
+    try:
+        # 受信（accepted/rejected）を先に subscribe
+        claim.subscribe([CREATE_ACCEPTED, CREATE_REJECTED, PROVISION_ACCEPTED, PROVISION_REJECTED])
+        timings["claimConnect"] = time.monotonic() - t0
+
+        t1 = time.monotonic()
+        thing_name = create_and_register(claim, params, cert_out, key_out)
+        timings["register"] = time.monotonic() - t1
+    finally:
+        # claim セッションを終了
+        claim.disconnect()
+    time.sleep(1.0)
+
+    # --- 4) 新・本番証明書で再接続して検証 ---
+    t2 = time.monotonic()
+    verified = verify_production(thing_name, cert_out, key_out)
+    timings["verify"] = time.monotonic() - t2
+    timings["total"] = time.monotonic() - t0
+    return {"thingName": thing_name, "verified": verified, "timings": timings}
+
+
+# ======== バッチ =========
+def load_batch(path: str) -> list:
+    """CSV（ヘッダ必須、SerialNumber 列必須）を読み、行ごとの RegisterThing parameters を返す
+
+    SerialNumber 以外の列（ThingName など）もそのまま parameters に渡す。
+    SerialNumber は <out_dir>/<SerialNumber>.crt/.key のファイル名になるため、重複
+    （大文字小文字違いを含む）とパス区切り・".." を含むものは拒否する。
+    """
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        rows = [
+            {k.strip(): (v or "").strip() for k, v in row.items() if k and (v or "").strip()}
+            for row in csv.DictReader(f)
+        ]
+    rows = [r for r in rows if r]
+    missing = [i + 2 for i, r in enumerate(rows) if not r.get("SerialNumber")]
+    if missing:
+        raise ValueError(f"SerialNumber が空の行があります（行番号: {missing}）")
+    serials = [r["SerialNumber"] for r in rows]
+    bad = [sn for sn in serials if any(x in sn for x in ("/", "\\", ".."))]
+    if bad:
+        raise ValueError(f"SerialNumber にパス区切りまたは '..' が含まれています: {bad}")
+    seen, dup = set(), []
+    for sn in serials:
+        if sn.casefold() in seen:
+            dup.append(sn)
+        seen.add(sn.casefold())
+    if dup:
+        raise ValueError(f"SerialNumber が重複しています: {dup}")
+    return rows
+
+
+def provision_with_retry(params: dict, out_dir: str, retries: int, claims: Optional[ClaimPool] = None) -> dict:
+    """1 台分をバックオフ付きで再試行しながら実行し、結果レコードを返す"""
+    serial = params["SerialNumber"]
+    cert_out = os.path.join(out_dir, f"{serial}.crt")
+    key_out = os.path.join(out_dir, f"{serial}.key")
+    rec = {"SerialNumber": serial, "ok": False, "attempts": 0}
+    started = time.monotonic()
+    for attempt in range(retries + 1):
+        rec["attempts"] = attempt + 1
+        try:
+            rec.update(provision_device(params, cert_out, key_out, claims))
+            rec["ok"] = bool(rec.get("verified"))
+            if not rec["ok"]:
+                rec["error"] = "本番証明書での Shadow GET を確認できず"
+            break
+        except (RetryableError, TimeoutError, OSError) as e:
+            rec["error"] = str(e)
+            if attempt >= retries:
                 break
-            time.sleep(0.1)
+            delay = min(BATCH_BACKOFF_MAX, BATCH_BACKOFF_BASE * (2 ** attempt))
+            delay = random.uniform(delay / 2, delay)  # ジッタで同時再試行を分散
+            print(f"[RETRY] {serial}: {e}（{delay:.1f}秒後に再試行 {attempt + 1}/{retries}）")
+            time.sleep(delay)
+        except Exception as e:
+            rec["error"] = str(e)
+            break
+    rec["elapsed"] = round(time.monotonic() - started, 3)
+    rec["certFile"] = cert_out if rec["ok"] else None
+    return rec
+
+
+def _percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def run_batch(path: str, workers: int, retries: int, out_dir: str, report: Optional[str],
+              claim_sessions: int = BATCH_CLAIM_SESSIONS) -> bool:
+    """CSV の全台を並列にプロビジョニングし、サマリを表示・JSON 保存する。全台成功で True
+
+    claim_sessions > 0 なら、その本数の claim 接続を全台で使い回す（登録は接続ごとに直列）。
+    """
+    devices = load_batch(path)
+    claim_sessions = min(claim_sessions, workers, len(devices))
+    print(f"[BATCH] 対象 {len(devices)} 台 / 並列 {workers} / 再試行 {retries} / claim 接続 {claim_sessions or '台ごと'}")
+    claims = ClaimPool(claim_sessions) if claim_sessions > 0 else None
+    started = time.monotonic()
+    results = []
+    try:
+        with bulk_writes(), ThreadPoolExecutor(max_workers=workers) as pool:
+            futs = {pool.submit(provision_with_retry, d, out_dir, retries, claims): d for d in devices}
+            for fut in as_completed(futs):
+                rec = fut.result()
+                results.append(rec)
+                mark = "OK" if rec["ok"] else "NG"
+                print(f"[BATCH] {mark} {rec['SerialNumber']} {rec['elapsed']:.2f}s attempts={rec['attempts']}"
+                      + (f" error={rec['error']}" if not rec["ok"] else ""))
+    finally:
+        if claims is not None:
+            claims.close()
+
+    wall = time.monotonic() - started
+    oks = [r for r in results if r["ok"]]
+    elapsed = [r["elapsed"] for r in results]
+    summary = {
+        "devices": len(results),
+        "succeeded": len(oks),
+        "failed": len(results) - len(oks),
+        "retried": sum(1 for r in results if r["attempts"] > 1),
+        "wallSeconds": round(wall, 3),
+        "p50Seconds": round(_percentile(elapsed, 50), 3),
+        "p95Seconds": round(_percentile(elapsed, 95), 3),
+        "maxSeconds": round(max(elapsed, default=0.0), 3),
+        "tlsHandshakes": tlsctx.stats()["handshakes"],
+        "tlsResumed": tlsctx.stats()["resumed"],
+        "claimConnects": sum(cs.connects for cs in claims.sessions) if claims else sum(r["attempts"] for r in results),
+    }
+
+    print("\n=== Batch Provisioning Summary ===")
+    for k, v in summary.items():
+        print(f"{k:<13}: {v}")
+    for r in sorted(results, key=lambda r: r["SerialNumber"]):
+        if not r["ok"]:
+            print(f"[FAIL] {r['SerialNumber']}: {r.get('error')}")
+
+    report = report or os.path.join(
+        out_dir, f"provision-report-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(report) or ".", exist_ok=True)
+    with open(report, "w", encoding="utf-8") as f:
+        json.dump({"summary": summary, "results": results}, f, ensure_ascii=False, indent=2)
+    print(f"Saved report: {report}")
+    return summary["failed"] == 0
+
 
-        if not echoed:
-            print("[WARN] 自エコーは未確認（Subscribe/Pub のタイミングやポリシー範囲を確認してください）")
+def run():
+    global IOT_ENDPOINT, PORT, USE_TLS
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--thing", default=None, help="既知の Thing 名（テンプレート側で自動採番なら省略可）")
+    parser.add_argument("--batch", default=None, help="一括プロビジョニング用 CSV（SerialNumber 列必須）")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS, help="--batch の並列数")
+    parser.add_argument("--retries", type=int, default=BATCH_RETRIES, help="--batch の再試行回数")
+    parser.add_argument("--out-dir", default=BATCH_OUT_DIR, help="--batch の証明書/鍵の書き出し先")
+    parser.add_argument("--claim-sessions", type=int, default=BATCH_CLAIM_SESSIONS,
+                        help="--batch で使い回す claim 接続数（0 で台ごとに接続）")
+    parser.add_argument("--report", default=None, help="--batch の結果 JSON（省略時は out-dir に保存）")
+    parser.add_argument("--endpoint", default=None, help="接続先（ローカル検証時に上書き）")
+    parser.add_argument("--port", type=int, default=None, help="接続ポート（ローカル検証時に上書き）")
+    parser.add_argument("--no-tls", action="store_true", help="TLS なしで接続（iot_standin.py 検証専用）")
+    args = parser.parse_args()
+
+    IOT_ENDPOINT = args.endpoint or IOT_ENDPOINT
+    PORT = args.port or PORT
+    USE_TLS = not args.no_tls
+
+    if args.batch:
+        ok = run_batch(args.batch, args.workers, args.retries, args.out_dir, args.report, args.claim_sessions)
+        raise SystemExit(0 if ok else 1)
+
+    params = dict(PARAMETERS)  # コピー
+    if args.thing:
+        # テンプレートが ThingName を受けるならここで渡す（テンプレート側に合わせて key 名を調整）
+        params.setdefault("ThingName", args.thing)
 
-    prod.disconnect()
+    provision_device(params, NEW_CERT_OUT, NEW_KEY_OUT)
     print("[DONE] 証明書ローテーション検証フロー完了")
 
 if __name__ == "__main__":
@@ -3,42 +3,602 @@
 """
 役割: 設備側サーバ（MQTT/TLS 8883, X.509）
 シンプル版 - 基本的なフローでAMR状態管理
+複数 Thing を 1 プロセス・1 接続で収容（THING_NAMES）
+asyncio のイベントループ 1 本で MQTT・タイマー・ハートビートを処理
 """
 
-import json
+import asyncio
+import base64
+import itertools
+import os
+import random
+import shutil
+import signal
 import ssl
-import time
+import sys
 import threading
+import time
 import uuid
 from datetime import datetime, timezone
 
 import paho.mqtt.client as mqtt
+from cryptography import x509
+
+import codec
+import provision_and_verify
+import tlsctx
 
 # ========= 設定（すべて定数で定義） =========
 IOT_ENDPOINT = "a2osrgpri6xnln-ats.iot.ap-northeast-1.amazonaws.com"
 PORT = 8883
 THING_NAME = "AMR-001"
+# 1 プロセスで収容する Thing 一覧（フリートモード）。1 台運用なら THING_NAME のみ
+THING_NAMES = [THING_NAME]
+# MQTT クライアントID。全 Thing を 1 本の TLS 接続に多重化する
+CLIENT_ID = THING_NAME
 SHADOW_NAME = "robot"
 ROOT_CA_PATH = "./certs/AmazonRootCA1.pem"
-CERT_PATH = "./certs/new_production.crt"
+CERT_PATH = "./certs/new_production.crt"  # 初回プロビジョニングの証明書（CERT_STORE_DIR に有効な版が無い間使う）
 KEY_PATH = "./certs/new_production.key"
 
-# トピック
-TOPIC_CALL = f"amr/{THING_NAME}/cmd/call"
-TOPIC_STATUS = f"amr/{THING_NAME}/status"
-SHADOW_UPDATE = f"$aws/things/{THING_NAME}/shadow/name/{SHADOW_NAME}/update"
-SHADOW_GET = f"$aws/things/{THING_NAME}/shadow/name/{SHADOW_NAME}/get"
-
 # タイミング設定
 QOS = 1
+KEEPALIVE = 60  # 秒
 HEARTBEAT_INTERVAL = 10  # 秒
 MOVING_DURATION = 5  # 秒
+METRICS_INTERVAL = 60  # 秒（スケジューラのメトリクス出力間隔）
+# ステータスの送出形式。"cbor" を加えると amr/{thing}/status/cbor にバイナリ版も送る
+# （JSON 版は UI 用に常に送る）
+STATUS_ENCODINGS = ("json",)
+SHADOW_COALESCE_WINDOW = 0.05  # 秒（この間の Shadow 変更は 1 回の update にまとめる。0 で即時）
+PUBACK_TIMEOUT = 5  # 秒（終了時の PUBACK 待ち上限）
+RECONNECT_MIN_DELAY = 1  # 秒（再接続バックオフの初期値）
+RECONNECT_MAX_DELAY = 60  # 秒（再接続バックオフの上限）
+
+# アウトボックス（切断中のステータス/Shadow をディスクに退避し、再接続後に送出）
+OUTBOX_DIR = "./outbox"
+OUTBOX_SEGMENT_BYTES = 256 * 1024  # 1 セグメントファイルの上限
+OUTBOX_MAX_BYTES = 16 * 1024 * 1024  # 全体の上限（超過分は古いセグメントから破棄）
+OUTBOX_FSYNC_INTERVAL = 1  # 秒（追記後この時間内に fsync をまとめて実行）
+OUTBOX_FSYNC_BATCH = 50  # 件（これだけ溜まったら即 fsync）
+OUTBOX_DRAIN_RATE = 20  # 件/秒（再接続後の送出レート）
+OUTBOX_DRAIN_BATCH = 10  # 件（PUBACK をまとめて待つ単位）
+OUTBOX_DRAIN_RETRY_MIN = 1  # 秒（接続したまま送出が中断した場合の再開待ち。中断のたびに倍）
+OUTBOX_DRAIN_RETRY_MAX = 30  # 秒
+
+# 証明書ローテーション（本番証明書の期限前に claim で再発行し、接続を張り替える）
+CLAIM_CERT_PATH = "./certs/claim.crt"
+CLAIM_KEY_PATH = "./certs/claim.key"
+PROVISION_TEMPLATE = provision_and_verify.TEMPLATE_NAME
+CERT_STORE_DIR = "./certs/production"  # ローテーションで発行した証明書（版ごとのディレクトリ + current が指す版）
+PROVISION_PARAMETERS = {"SerialNumber": "001", "ThingName": THING_NAME}  # RegisterThing に渡す
+CERT_ROTATE_BEFORE_DAYS = 30  # 期限のこの日数前から更新対象
+CERT_ROTATE_JITTER_DAYS = 14  # 更新日を台ごとに 0〜この日数だけ前倒し（フリート全体で分散）
+CERT_ROTATE_CHECK_INTERVAL = 24 * 3600  # 秒（期限の再確認間隔。時刻補正・手動差し替えに追従）
+CERT_ROTATE_RETRY_INTERVAL = 3600  # 秒（更新失敗時の再試行間隔）
+CERT_ROTATE_CONNECT_TIMEOUT = 30  # 秒（新証明書での再接続を待つ上限。超えたら旧証明書に戻す）
+
+
+# ========= ロボット（Thing 単位の状態） =========
+class Robot:
+    """1 台分の AMR 状態とトピック
+
+    状態の読み書きはすべてイベントループ上で行うためロック不要。
+    """
+
+    def __init__(self, thing_name: str):
+        self.thing_name = thing_name
+
+        # トピック
+        self.topic_call = f"amr/{thing_name}/cmd/call"
+        self.topic_status = f"amr/{thing_name}/status"
+        self.topic_status_cbor = f"amr/{thing_name}/status/cbor"
+        self.shadow_update = (
+            f"$aws/things/{thing_name}/shadow/name/{SHADOW_NAME}/update"
+        )
+        self.shadow_get = f"$aws/things/{thing_name}/shadow/name/{SHADOW_NAME}/get"
+
+        # 状態
+        self.state = "idle"
+        self.last_request_id = None
+        self.reported_version = 0
+
+        # Shadow reported の送信待ち（差分集約用）と送信済みの値
+        self.shadow_pending = {}
+        self.shadow_reported = {}
+
+
+# ========= スケジューラ =========
+class Scheduler:
+    """イベントループ上のタイマースケジューラ
+
+    ハートビートと移動完了タイマーを全ロボット分まとめて loop.call_at で管理する。
+    ジョブは key で識別し、同じ key の登録は置き換えになる（再接続しても重複しない）。
+    イベントループのスレッドからのみ呼び出すこと。
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._handles = {}  # key -> asyncio.TimerHandle
+        self._anon = itertools.count()
+
+        # メトリクス（drift = 実行時刻 - 予定時刻）
+        self.runs = 0
+        self.drift_last = 0.0
+        self.drift_max = 0.0
+        self._drift_sum = 0.0
+
+    def start(self, loop=None):
+        self._loop = loop or asyncio.get_running_loop()
+
+    def schedule(self, delay, fn, *args, key=None, interval=None):
+        """delay 秒後に fn(*args) を実行。interval 指定で周期実行。fn はコルーチン関数も可"""
+        if key is None:
+            key = ("anon", next(self._anon))
+        else:
+            self.cancel(key)
+        self._arm(key, self._loop.time() + delay, fn, args, interval)
+
+    def cancel(self, key):
+        """key のジョブを取り消す。取り消した場合 True"""
+        handle = self._handles.pop(key, None)
+        if handle is None:
+            return False
+        handle.cancel()
+        return True
+
+    def cancel_all(self):
+        for key in list(self._handles):
+            self.cancel(key)
+
+    def has(self, key):
+        return key in self._handles
+
+    def depth(self):
+        return len(self._handles)
+
+    def metrics(self):
+        avg = self._drift_sum / self.runs if self.runs else 0.0
+        return {
+            "depth": len(self._handles),
+            "runs": self.runs,
+            "driftLastMs": round(self.drift_last * 1000, 1),
+            "driftMaxMs": round(self.drift_max * 1000, 1),
+            "driftAvgMs": round(avg * 1000, 1),
+        }
+
+    def _arm(self, key, due, fn, args, interval):
+        self._handles[key] = self._loop.call_at(
+            due, self._fire, key, due, fn, args, interval
+        )
+
+    def _fire(self, key, due, fn, args, interval):
+        now = self._loop.time()
+        drift = now - due
+        self.runs += 1
+        self.drift_last = drift
+        self.drift_max = max(self.drift_max, drift)
+        self._drift_sum += drift
+
+        if interval:
+            # 予定時刻基準で次回を決める（遅延が積み上がらない）。大幅遅延時は読み飛ばす
+            nxt = due + interval
+            if nxt <= now:
+                nxt = now + interval
+            self._arm(key, nxt, fn, args, interval)
+        else:
+            self._handles.pop(key, None)
+
+        try:
+            ret = fn(*args)
+            if asyncio.iscoroutine(ret):
+                self._loop.create_task(ret)
+        except Exception as e:
+            print(f"[ERROR] スケジュールジョブエラー ({key}): {e}")
+
+
+# ========= MQTT ランタイム（asyncio） =========
+class MqttRuntime:
+    """paho クライアントを asyncio イベントループ上で駆動する
+
+    paho のソケットコールバックで読み書きをイベントループに登録し、loop_start() の
+    バックグラウンドスレッドを使わない。publish/subscribe は PUBACK/SUBACK で完了する
+    Future を返す。
+
+    接続（TLS ハンドシェイク）だけは executor で行うため、paho のネットワーク処理
+    （connect / loop_read / loop_write / loop_misc）は _io_lock で直列化する。
+    add_reader/add_writer を使うため、Windows では SelectorEventLoop で動かすこと（main() で設定）。
+
+    証明書を替えるときは新しいクライアントを作って switch_client() で入れ替える
+    （paho は作成後の TLS 設定変更を許さない）。旧クライアントからの通知は無視する。
+    """
+
+    def __init__(self, client, on_connect, on_message, on_disconnect):
+        self.client = client
+        self.on_connect = on_connect
+        self.on_message = on_message
+        self.on_disconnect = on_disconnect
+
+        self._loop = None
+        self._pending = {}  # mid -> Future（PUBACK/SUBACK 待ち）
+        self.connected = False
+        self._connected_evt = None
+        self._disconnected = None
+        self._switched = None  # switch_client() で再接続待ちを打ち切る
+        self._reconnect_now = False
+        self._misc_task = None
+        self._connect_fut = None  # executor で実行中の接続
+        self._address = None  # (host, port, keepalive)
+        self._io_lock = threading.RLock()
+        self._attach(client)
+
+    def _attach(self, client):
+        client.on_connect = self._on_connect
+        client.on_message = self._on_message
+        client.on_disconnect = self._on_disconnect
+        client.on_publish = self._on_ack
+        client.on_subscribe = self._on_subscribe
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    # --- 公開 API ---
+    def publish(self, topic, payload, qos=0, retain=False):
+        """発行して PUBACK（QoS0 は送信完了）で完了する Future を返す
+
+        未接続時の QoS1 は paho の送信キューに積まれ、再接続後に送られる。
+        """
+        info = self.client.publish(topic, payload, qos=qos, retain=retain)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS and not (
+            qos > 0 and info.rc == mqtt.MQTT_ERR_NO_CONN
+        ):
+            raise RuntimeError(f"Publish に失敗: {topic} rc={info.rc}")
+        return self._track(info.mid)
+
+    def subscribe(self, topics_qos):
+        """複数トピックを 1 回の SUBSCRIBE で購読し、SUBACK で完了する Future を返す"""
+        rc, mid = self.client.subscribe(topics_qos)
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            raise RuntimeError(f"Subscribe失敗: rc={rc}")
+        return self._track(mid)
+
+    async def switch_client(self, client):
+        """クライアントを入れ替え、すぐに新しいクライアントで張り直す（証明書ローテーション用）
+
+        旧クライアントの PUBACK を待ってから DISCONNECT を送るため LWT は発火しない。
+        差し替え中の送信はアウトボックスへ回る。
+        """
+        if self._connect_fut is not None and not self._connect_fut.done():
+            await asyncio.wait([self._connect_fut])  # 接続処理中なら終わるまで待つ
+        if self.connected:
+            self.connected = False  # 以降の送信はアウトボックスへ
+            await self._wait_pending(PUBACK_TIMEOUT)
+        for fut in self._pending.values():
+            fut.cancel()  # mid は新しいクライアントで振り直される
+        self._pending.clear()
+
+        old = self.client
+        self._attach(client)
+        with self._io_lock:
+            self.client = client
+            live = old.socket() is not None
+            if live:
+                old.disconnect()
+                old.loop_write()  # DISCONNECT を送り切る
+        self._connected_evt.clear()
+        print("[MQTT] クライアントを差し替えて再接続")
+        if live:
+            self._reconnect_now = True
+            self._disconnected.set()
+        else:
+            self._switched.set()  # 再接続のバックオフ中ならすぐ接続する
+
+    async def wait_connected(self, timeout):
+        """接続（CONNACK rc=0）まで待つ。タイムアウトで False"""
+        try:
+            await asyncio.wait_for(self._connected_evt.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def run(self, host, port, keepalive, stop):
+        """stop がセットされるまで接続を維持（切断時は指数バックオフで再接続）"""
+        self._loop = asyncio.get_running_loop()
+        self._connected_evt = asyncio.Event()
+        self._disconnected = asyncio.Event()
+        self._switched = asyncio.Event()
+        self._misc_task = self._loop.create_task(self._misc_loop())
+        self._address = (host, port, keepalive)
+
+        delay = RECONNECT_MIN_DELAY
+        while not stop.is_set():
+            self._disconnected.clear()
+            self._switched.clear()
+            try:
+                print("[MQTT] 接続開始...")
+                # TLS ハンドシェイクはブロッキングのため executor で実行
+                self._connect_fut = self._loop.run_in_executor(None, self._connect_blocking, self.client)
+                await self._connect_fut
+                delay = RECONNECT_MIN_DELAY
+                await _wait_first(stop.wait(), self._disconnected.wait())
+            except (OSError, ssl.SSLError, mqtt.WebsocketConnectionError) as e:
+                print(f"[ERROR] 接続エラー: {e}")
+
+            if stop.is_set():
+                break
+            if self._reconnect_now:
+                # 自分で切った張り替えはバックオフ不要
+                self._reconnect_now = False
+                continue
+            print(f"[MQTT] {delay}秒後に再接続")
+            await _wait_first(stop.wait(), self._switched.wait(), asyncio.sleep(delay))
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    async def close(self, timeout=PUBACK_TIMEOUT):
+        """未完了の PUBACK を待ってから切断"""
+        await self._wait_pending(timeout)
+        with self._io_lock:
+            self.client.disconnect()
+            self.client.loop_write()  # DISCONNECT を送り切る（LWT を発火させない）
+        if self._misc_task:
+            self._misc_task.cancel()
+        for fut in self._pending.values():
+            fut.cancel()
+        self._pending.clear()
+
+    # --- 内部 ---
+    async def _wait_pending(self, timeout):
+        pending = [f for f in self._pending.values() if not f.done()]
+        if pending:
+            done, _ = await asyncio.wait(pending, timeout=timeout)
+            if len(done) < len(pending):
+                print(f"[WARN] PUBACK 未受信のまま切断: {len(pending) - len(done)}件")
+
+    def _track(self, mid):
+        fut = self._loop.create_future()
+        self._pending[mid] = fut
+        return fut
+
+    def _resolve(self, mid, value=None):
+        fut = self._pending.pop(mid, None)
+        if fut and not fut.done():
+            fut.set_result(value)
+
+    def _connect_blocking(self, client):
+        # executor スレッドで実行。接続中はループ側のネットワーク処理を止める
+        with self._io_lock:
+            if client is self.client:  # 待っている間に差し替えられていれば接続しない
+                host, port, keepalive = self._address
+                client.connect(host, port, keepalive=keepalive)
+
+    async def _misc_loop(self):
+        # keepalive（PINGREQ）と再送タイムアウトの処理
+        while True:
+            await asyncio.sleep(1)
+            # 接続処理中（ロック保持中）はイベントループを止めないよう読み飛ばす
+            if self._io_lock.acquire(blocking=False):
+                try:
+                    self.client.loop_misc()
+                finally:
+                    self._io_lock.release()
+
+    def _on_connect(self, c, userdata, flags, rc):
+        if c is not self.client:
+            return
+        self.connected = rc == 0
+        if self.connected:
+            self._connected_evt.set()
+        self._loop.create_task(self.on_connect(self, flags, rc))
+
+    def _on_message(self, c, userdata, msg):
+        if c is self.client:
+            self.on_message(self, msg)
+
+    def _on_disconnect(self, c, userdata, rc):
+        if c is not self.client:
+            return
+        self.connected = False
+        self._connected_evt.clear()
+        self.on_disconnect(self, rc)
+        self._disconnected.set()
+
+    def _on_ack(self, c, userdata, mid):
+        if c is self.client:
+            self._resolve(mid)
+
+    def _on_subscribe(self, c, userdata, mid, granted_qos, properties=None):
+        if c is self.client:
+            self._resolve(mid, granted_qos)
+
+    # paho のソケット通知はイベントループ外（executor の reconnect）からも来るため
+    # ループ外からの通知は call_soon_threadsafe 経由で登録する
+    def _call_in_loop(self, fn, *args):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            fn(*args)
+        else:
+            self._loop.call_soon_threadsafe(fn, *args)
+
+    # 読み書きはそのソケットを持つクライアントで行う（差し替え直後の旧クライアントも含む）
+    def _on_socket_open(self, c, userdata, sock):
+        self._call_in_loop(self._watch, self._loop.add_reader, sock, self._on_readable, c)
+
+    def _on_socket_close(self, c, userdata, sock):
+        self._call_in_loop(self._remove_socket, sock)
+
+    def _on_socket_register_write(self, c, userdata, sock):
+        self._call_in_loop(self._watch, self._loop.add_writer, sock, self._on_writable, c)
+
+    def _on_socket_unregister_write(self, c, userdata, sock):
+        self._call_in_loop(self._loop.remove_writer, sock)
+
+    def _watch(self, add, sock, callback, c):
+        # executor の接続失敗時は、登録がループに届く前にソケットが閉じられていることがある
+        if sock.fileno() >= 0:
+            add(sock, callback, c)
+
+    def _remove_socket(self, sock):
+        try:
+            self._loop.remove_reader(sock)
+            self._loop.remove_writer(sock)
+        except (ValueError, OSError):
+            pass  # クローズ済みソケット
+
+    def _on_writable(self, c):
+        with self._io_lock:
+            c.loop_write()
+
+    def _on_readable(self, c):
+        with self._io_lock:
+            c.loop_read()
+            # TLS のバッファ済みデータは select で検知できないため続けて読む
+            sock = c.socket()
+            while sock is not None and getattr(sock, "pending", lambda: 0)():
+                c.loop_read()
+                sock = c.socket()
+
+
+async def _wait_first(*aws):
+    """いずれか 1 つが完了するまで待ち、残りは取り消す"""
+    tasks = [asyncio.ensure_future(a) for a in aws]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for t in tasks:
+            t.cancel()
+
+
+# ========= アウトボックス（ディスク永続の送信待ちキュー） =========
+class Outbox:
+    """追記専用のセグメントファイルに QoS1 メッセージを退避する
+
+    1 行 1 メッセージ（JSON）で seg-XXXXXXXX.log に追記し、fsync は
+    OUTBOX_FSYNC_INTERVAL / OUTBOX_FSYNC_BATCH 単位でまとめる。送出は古いセグメントから
+    行い、全件の PUBACK を受けたセグメントを削除する（少なくとも 1 回の配送）。
+    """
+
+    def __init__(self, directory, scheduler):
+        self.directory = directory
+        self.scheduler = scheduler
+        self._segments = []  # 古い順のパス
+        self._sizes = {}  # path -> bytes
+        self._fh = None  # 追記中セグメント
+        self._unsynced = 0
+        self._next_seq = 1
+        self.dropped = 0
+
+    def open(self):
+        """既存セグメント（前回起動時の未送出分）を読み込む"""
+        os.makedirs(self.directory, exist_ok=True)
+        names = sorted(
+            n
+            for n in os.listdir(self.directory)
+            if n.startswith("seg-") and n.endswith(".log")
+        )
+        for n in names:
+            path = os.path.join(self.directory, n)
+            self._segments.append(path)
+            self._sizes[path] = os.path.getsize(path)
+            self._next_seq = max(self._next_seq, int(n[4:-4]) + 1)
+        if self._segments:
+            print(f"[OUTBOX] 未送出セグメント: {len(self._segments)}件")
+
+    def pending(self):
+        return bool(self._segments)
+
+    def append(self, topic, payload, retain=False):
+        rec = {"t": topic, "r": retain}
+        if isinstance(payload, bytes):
+            try:
+                rec["p"] = payload.decode("utf-8")
+            except UnicodeDecodeError:
+                rec["b"] = base64.b64encode(payload).decode("ascii")
+        else:
+            rec["p"] = payload
+        data = codec.encode(rec) + b"\n"
+        if self._fh is None or self._fh.tell() + len(data) > OUTBOX_SEGMENT_BYTES:
+            self._rotate()
+        self._fh.write(data)
+        self._sizes[self._fh.name] += len(data)
+        self._enforce_limit()
+
+        self._unsynced += 1
+        if self._unsynced >= OUTBOX_FSYNC_BATCH:
+            self.sync()
+        elif not self.scheduler.has("outbox-fsync"):
+            self.scheduler.schedule(OUTBOX_FSYNC_INTERVAL, self.sync, key="outbox-fsync")
+
+    def sync(self):
+        self.scheduler.cancel("outbox-fsync")
+        if self._fh and self._unsynced:
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+        self._unsynced = 0
+
+    def take_oldest(self):
+        """最も古いセグメントの (path, [(topic, payload, retain), ...]) を返す"""
+        path = self._segments[0]
+        if self._fh and self._fh.name == path:
+            # 追記中なら封印し、以降の追記は新しいセグメントへ
+            self._seal()
+        records = []
+        with open(path, "rb") as f:
+            for raw in f:
+                try:
+                    m = codec.decode(raw)
+                    payload = m["p"] if "p" in m else base64.b64decode(m["b"])
+                    records.append((m["t"], payload, m.get("r", False)))
+                except (ValueError, KeyError):
+                    continue  # クラッシュ時の書きかけ行
+        return path, records
+
+    def remove(self, path):
+        if path in self._segments:
+            self._segments.remove(path)
+        self._sizes.pop(path, None)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        self._seal()
+
+    def _seal(self):
+        if self._fh:
+            self.sync()
+            self._fh.close()
+            self._fh = None
+
+    def _rotate(self):
+        self._seal()
+        path = os.path.join(self.directory, f"seg-{self._next_seq:08d}.log")
+        self._next_seq += 1
+        self._fh = open(path, "ab")
+        self._segments.append(path)
+        self._sizes[path] = 0
+
+    def _enforce_limit(self):
+        total = sum(self._sizes.values())
+        while total > OUTBOX_MAX_BYTES and len(self._segments) > 1:
+            oldest = self._segments[0]
+            total -= self._sizes.get(oldest, 0)
+            self.dropped += 1
+            print(f"[WARN] アウトボックス上限超過: 古いセグメントを破棄 {oldest}")
+            self.remove(oldest)
+
 
 # ========= グローバル状態 =========
-current_state = "idle"
-last_request_id = None
-reported_version = 0
-state_lock = threading.Lock()
+robots = {name: Robot(name) for name in THING_NAMES}
+robots_by_call_topic = {r.topic_call: r for r in robots.values()}
+scheduler = Scheduler()
+outbox = Outbox(OUTBOX_DIR, scheduler)
+_drain_task = None
+_drain_retry_delay = OUTBOX_DRAIN_RETRY_MIN
 
 
 def now_ms():
@@ -46,209 +606,536 @@ def now_ms():
     return int(time.time() * 1000)
 
 
-def build_status_payload():
+def send(client, topic, payload, retain=False):
+    """QoS1 発行。切断中またはアウトボックス送出中は順序を保つためアウトボックスへ退避"""
+    if not client.connected or outbox.pending():
+        outbox.append(topic, payload, retain)
+        return None
+    return client.publish(topic, payload, qos=QOS, retain=retain)
+
+
+async def drain_outbox(client):
+    """アウトボックスを古い順に送出（OUTBOX_DRAIN_RATE で流量制御）。空にできたら True"""
+    loop = asyncio.get_running_loop()
+    sent = 0
+    while client.connected and outbox.pending():
+        path, records = outbox.take_oldest()
+        for i in range(0, len(records), OUTBOX_DRAIN_BATCH):
+            batch = records[i : i + OUTBOX_DRAIN_BATCH]
+            started = loop.time()
+            try:
+                futs = [
+                    client.publish(t, p, qos=QOS, retain=r) for t, p, r in batch
+                ]
+            except RuntimeError as e:
+                print(f"[ERROR] アウトボックス送出エラー: {e}")
+                return False
+            _, not_acked = await asyncio.wait(futs, timeout=PUBACK_TIMEOUT)
+            if not_acked or not client.connected:
+                # セグメントは残し、再開時に先頭から再送する
+                print("[WARN] アウトボックス送出を中断（PUBACK 未受信/切断）")
+                return False
+            sent += len(batch)
+            await asyncio.sleep(
+                max(0.0, len(batch) / OUTBOX_DRAIN_RATE - (loop.time() - started))
+            )
+        outbox.remove(path)
+    if sent:
+        print(f"[OUTBOX] 送出完了: {sent}件")
+    return not outbox.pending()
+
+
+async def _drain_and_retry(client):
+    """送出し、接続したまま中断した場合はバックオフ付きで再開を予約
+
+    アウトボックスが残っている間は send() がすべて退避に回り、ハートビートも止まるため、
+    次の再接続まで放置しない（切断による中断は on_connect で再開する）。
+    """
+    global _drain_retry_delay
+    if await drain_outbox(client):
+        _drain_retry_delay = OUTBOX_DRAIN_RETRY_MIN
+        return
+    if client.connected and outbox.pending():
+        print(f"[OUTBOX] {_drain_retry_delay}秒後に送出を再開")
+        scheduler.schedule(_drain_retry_delay, start_drain, client, key="outbox-drain")
+        _drain_retry_delay = min(_drain_retry_delay * 2, OUTBOX_DRAIN_RETRY_MAX)
+
+
+def start_drain(client):
+    """アウトボックス送出を開始（実行中なら何もしない）"""
+    global _drain_task
+    if outbox.pending() and (_drain_task is None or _drain_task.done()):
+        _drain_task = asyncio.ensure_future(_drain_and_retry(client))
+
+
+def build_status_payload(robot):
     """ステータスペイロード作成"""
-    with state_lock:
-        payload = {
-            "state": current_state,
-            "updatedAt": now_ms(),
-            "heartbeatAt": now_ms(),
-        }
-        if last_request_id:
-            payload["requestId"] = last_request_id
-        return payload
+    payload = {
+        "state": robot.state,
+        "updatedAt": now_ms(),
+        "heartbeatAt": now_ms(),
+    }
+    if robot.last_request_id:
+        payload["requestId"] = robot.last_request_id
+    return payload
 
 
-def publish_status(client, heartbeat=False):
-    """ステータス発行"""
-    payload = build_status_payload()
+def publish_status(client, robot, heartbeat=False):
+    """ステータス発行（PUBACK で完了する Future を返す）"""
+    payload = build_status_payload(robot)
     if heartbeat:
         payload["heartbeatAt"] = now_ms()
 
     try:
-        client.publish(TOPIC_STATUS, json.dumps(payload), qos=QOS, retain=True)
+        fut = send(client, robot.topic_status, codec.encode_status(payload), retain=True)
+        if "cbor" in STATUS_ENCODINGS:
+            send(
+                client,
+                robot.topic_status_cbor,
+                codec.encode_status_binary(payload),
+                retain=True,
+            )
         if heartbeat:
-            print(f"[HB] {payload['state']}")
+            print(f"[HB] {robot.thing_name}: {payload['state']}")
         else:
-            print(f"[STATUS] {payload['state']}")
+            print(f"[STATUS] {robot.thing_name}: {payload['state']}")
+        return fut
     except Exception as e:
-        print(f"[ERROR] ステータス発行エラー: {e}")
-
-
-def publish_shadow(client):
-    """Shadow状態報告"""
-    global reported_version
-    with state_lock:
-        reported_version += 1
-        doc = {
-            "state": {
-                "reported": {
-                    "state": current_state,
-                    "version": reported_version,
-                    "updatedAt": now_ms(),
-                }
-            }
-        }
+        print(f"[ERROR] ステータス発行エラー ({robot.thing_name}): {e}")
+        return None
+
+
+def shadow_job_key(robot):
+    """Shadow 送信ジョブの key（ロボットごとに 1 件だけ保持）"""
+    return ("shadow", robot.thing_name)
+
+
+def publish_shadow(client, robot):
+    """Shadow状態報告（SHADOW_COALESCE_WINDOW 内の変更はまとめて 1 回で送る）"""
+    robot.shadow_pending["state"] = robot.state
+    if SHADOW_COALESCE_WINDOW <= 0:
+        return flush_shadow(client, robot)
+
+    key = shadow_job_key(robot)
+    if not scheduler.has(key):
+        # 期限は最初の変更から固定（後続の変更で延長しない）
+        scheduler.schedule(
+            SHADOW_COALESCE_WINDOW, flush_shadow, client, robot, key=key
+        )
+    return None
+
+
+def flush_shadow(client, robot):
+    """保留中の reported のうち、前回送信分から変わったキーだけを送る"""
+    scheduler.cancel(shadow_job_key(robot))
+    delta = {
+        k: v
+        for k, v in robot.shadow_pending.items()
+        if k not in robot.shadow_reported or robot.shadow_reported[k] != v
+    }
+    robot.shadow_pending.clear()
+    if not delta:
+        return None
+
+    robot.reported_version += 1
+    reported = dict(delta)
+    reported["version"] = robot.reported_version
+    reported["updatedAt"] = now_ms()
 
     try:
-        client.publish(SHADOW_UPDATE, json.dumps(doc), qos=QOS)
-        print(f"[SHADOW] 状態更新: {current_state}")
+        fut = send(client, robot.shadow_update, codec.encode_shadow(reported))
+        robot.shadow_reported.update(delta)
+        print(f"[SHADOW] {robot.thing_name}: 状態更新: {delta}")
+        return fut
     except Exception as e:
-        print(f"[ERROR] Shadow更新エラー: {e}")
+        print(f"[ERROR] Shadow更新エラー ({robot.thing_name}): {e}")
+        return None
 
 
-def transition_to_idle(client):
-    """アイドル状態に遷移"""
-    global current_state
-    with state_lock:
-        current_state = "idle"
+def move_job_key(robot):
+    """移動完了ジョブの key（ロボットごとに 1 件だけ保持）"""
+    return ("move", robot.thing_name)
 
-    publish_shadow(client)
-    publish_status(client)
-    print("[TRANSITION] moving -> idle")
 
+def transition_to_idle(client, robot, request_id):
+    """アイドル状態に遷移（request_id が最新の移動要求のときのみ）"""
+    if robot.state != "moving" or robot.last_request_id != request_id:
+        print(
+            f"[TRANSITION] {robot.thing_name}: 後続要求があるため完了を破棄: "
+            f"requestId={request_id}"
+        )
+        return
+    robot.state = "idle"
+
+    publish_shadow(client, robot)
+    publish_status(client, robot)
+    print(f"[TRANSITION] {robot.thing_name}: moving -> idle (requestId={request_id})")
 
-def handle_call_message(client, payload):
-    """呼出しメッセージ処理"""
-    global current_state, last_request_id
 
+def handle_call_message(client, robot, payload):
+    """呼出しメッセージ処理"""
     try:
-        data = json.loads(payload.decode("utf-8"))
-        req_id = data.get("requestId", str(uuid.uuid4()))
-        dest = data.get("dest", "A-01")
+        call = codec.decode_call(payload)
+        req_id = call.requestId or str(uuid.uuid4())
+        dest = call.dest or "A-01"
+
+        print(
+            f"[CALL] {robot.thing_name}: 呼出し受信: dest={dest}, requestId={req_id}"
+        )
 
-        print(f"[CALL] 呼出し受信: dest={dest}, requestId={req_id}")
+        if robot.state == "moving" and robot.last_request_id == req_id:
+            # QoS1 の再送や同一要求の重複クリックは移動中の要求に合流させる
+            print(f"[CALL] {robot.thing_name}: 移動中の同一要求のため無視")
+            return
+        superseded = robot.last_request_id if robot.state == "moving" else None
+        robot.state = "moving"
+        robot.last_request_id = req_id
 
-        with state_lock:
-            current_state = "moving"
-            last_request_id = req_id
+        if superseded:
+            print(
+                f"[CALL] {robot.thing_name}: 移動中の要求を置き換え: "
+                f"{superseded} -> {req_id}"
+            )
 
         # 状態更新
-        publish_shadow(client)
-        publish_status(client)
+        publish_shadow(client, robot)
+        publish_status(client, robot)
 
-        # 移動完了タイマー設定
-        timer = threading.Timer(MOVING_DURATION, transition_to_idle, args=(client,))
-        timer.daemon = True
-        timer.start()
+        # 移動完了タイマー設定（同じ key の未完了ジョブは置き換わる）
+        scheduler.schedule(
+            MOVING_DURATION,
+            transition_to_idle,
+            client,
+            robot,
+            req_id,
+            key=move_job_key(robot),
+        )
 
     except Exception as e:
-        print(f"[ERROR] 呼出し処理エラー: {e}")
+        print(f"[ERROR] 呼出し処理エラー ({robot.thing_name}): {e}")
 
 
-def heartbeat_loop(client):
-    """ハートビートループ"""
-    while True:
-        try:
-            publish_status(client, heartbeat=True)
-        except Exception as e:
-            print(f"[ERROR] ハートビートエラー: {e}")
-        time.sleep(HEARTBEAT_INTERVAL)
+def send_heartbeat(client, robot):
+    """ハートビート送出（スケジューラから周期実行）
+
+    切断中・アウトボックス送出中は送らない（状態変化を伴わないため退避不要。
+    送出中に現在値を出すと、後から届く退避済みの retain で上書きされるため）。
+    """
+    if not client.connected or outbox.pending():
+        return
+    publish_status(client, robot, heartbeat=True)
+
+
+def start_heartbeats(client):
+    """全ロボットのハートビートを登録（key 単位で置換されるため再接続しても重複しない）"""
+    for i, robot in enumerate(robots.values()):
+        key = ("heartbeat", robot.thing_name)
+        if scheduler.has(key):
+            continue
+        # 台数分の送出タイミングを間隔内に分散させてバーストを避ける
+        offset = HEARTBEAT_INTERVAL * i / len(robots)
+        scheduler.schedule(
+            HEARTBEAT_INTERVAL + offset,
+            send_heartbeat,
+            client,
+            robot,
+            key=key,
+            interval=HEARTBEAT_INTERVAL,
+        )
+
+
+def log_metrics():
+    """スケジューラのメトリクス出力"""
+    m = scheduler.metrics()
+    print(
+        f"[METRICS] depth={m['depth']} runs={m['runs']} "
+        f"drift(last/avg/max)={m['driftLastMs']}/{m['driftAvgMs']}/{m['driftMaxMs']}ms"
+    )
+    t = tlsctx.stats()
+    print(
+        f"[METRICS] tls handshakes={t['handshakes']} resumed={t['resumed']} "
+        f"handshake(avg/max)={t['handshakeAvgMs']}/{t['handshakeMaxMs']}ms"
+    )
+
+
+# ========= 証明書ローテーション =========
+# 発行した証明書は CERT_STORE_DIR/<版>/cert.pem・key.pem に置き、CERT_STORE_DIR/current に
+# 使用中の版（1 行目）と 1 つ前の版（2 行目）を書く。切り替えは current の 1 回の rename で行い、
+# 新しい証明書で接続できたことを確認してから切り替える。
+def cert_expiry(path):
+    """証明書の (期限 epoch 秒, シリアル番号)"""
+    with open(path, "rb") as f:
+        cert = x509.load_pem_x509_certificate(f.read())
+    return cert.not_valid_after_utc.timestamp(), format(cert.serial_number, "X")
+
+
+def cert_pair_ok(cert_path, key_path):
+    """証明書と鍵が読み込め、組になっているか"""
+    try:
+        ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT).load_cert_chain(cert_path, key_path)
+        return True
+    except (OSError, ssl.SSLError):
+        return False
+
+
+def _cert_version_paths(version):
+    directory = os.path.join(CERT_STORE_DIR, version)
+    return os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+
+
+def _cert_versions():
+    """current に記録された版（使用中、1 つ前の順）"""
+    try:
+        with open(os.path.join(CERT_STORE_DIR, "current"), encoding="utf-8") as f:
+            return f.read().split()
+    except OSError:
+        return []
+
+
+def _active_version():
+    """使用する版（current の順に、証明書と鍵が組として読み込める最初のもの。無ければ None）"""
+    for version in _cert_versions():
+        if cert_pair_ok(*_cert_version_paths(version)):
+            return version
+        print(f"[CERT] 証明書 {version} を読み込めません。1 つ前の証明書を使います")
+    return None
+
+
+def active_cert():
+    """使用する (証明書, 鍵) のパス（CERT_STORE_DIR に有効な版が無ければ CERT_PATH/KEY_PATH）"""
+    version = _active_version()
+    return _cert_version_paths(version) if version else (CERT_PATH, KEY_PATH)
+
+
+def _activate_cert_version(version, previous):
+    """current を書き換えて version を使用中にする（previous は予備に残し、他の版は削除）"""
+    keep = [version] + ([previous] if previous else [])
+    provision_and_verify.secure_write(
+        os.path.join(CERT_STORE_DIR, "current"), "\n".join(keep) + "\n", 0o600
+    )
+    for name in os.listdir(CERT_STORE_DIR):
+        path = os.path.join(CERT_STORE_DIR, name)
+        if name not in keep and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def cert_rotation_due(path):
+    """この端末の更新予定時刻（epoch 秒）
+
+    ジッタは Thing と証明書シリアルから決めるため、再起動しても予定日は変わらない。
+    """
+    expires, serial = cert_expiry(path)
+    jitter = random.Random(f"{CLIENT_ID}:{serial}").uniform(0, CERT_ROTATE_JITTER_DAYS)
+    return expires - (CERT_ROTATE_BEFORE_DAYS + jitter) * 86400
+
+
+def schedule_cert_check(runtime, delay=0):
+    scheduler.schedule(delay, check_cert_rotation, runtime, key="cert-rotate")
+
+
+def check_cert_rotation(runtime):
+    """更新予定を過ぎていればローテーション開始、まだなら次回確認を予約"""
+    try:
+        due = cert_rotation_due(active_cert()[0])
+    except (OSError, ValueError) as e:
+        print(f"[CERT] 証明書の期限を取得できません: {e}")
+        schedule_cert_check(runtime, CERT_ROTATE_RETRY_INTERVAL)
+        return
+    remaining = due - time.time()
+    if remaining > 0:
+        print(f"[CERT] 更新予定: {datetime.fromtimestamp(due).isoformat(timespec='minutes')}")
+        schedule_cert_check(runtime, min(remaining, CERT_ROTATE_CHECK_INTERVAL))
+        return
+    return rotate_cert(runtime)
+
+
+def provision_new_cert(cert_out, key_out):
+    """claim 証明書で新しい本番証明書を発行・登録（ブロッキング。executor で実行）"""
+    claim = provision_and_verify.ClaimSession(
+        claim_cert=CLAIM_CERT_PATH,
+        claim_key=CLAIM_KEY_PATH,
+        template_name=PROVISION_TEMPLATE,
+        endpoint=IOT_ENDPOINT,
+        port=PORT,
+        root_ca=ROOT_CA_PATH,
+        use_tls=True,
+    )
+    try:
+        return claim.provision(dict(PROVISION_PARAMETERS), cert_out, key_out)
+    finally:
+        claim.close()
+
+
+async def rotate_cert(runtime):
+    """新証明書を発行し、新しいクライアントに差し替えて張り直す（ロボットの処理は止めない）
+
+    新証明書で接続できなければ旧証明書のクライアントに戻し、再試行を予約する。
+    """
+    print("[CERT] 証明書ローテーション開始")
+    previous = _active_version()
+    old_cert, old_key = _cert_version_paths(previous) if previous else (CERT_PATH, KEY_PATH)
+    version = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:6]}"
+    cert_path, key_path = _cert_version_paths(version)
+    loop = asyncio.get_running_loop()
+    switched = False
+    try:
+        thing = await loop.run_in_executor(None, provision_new_cert, cert_path, key_path)
+        print(f"[CERT] 新証明書を発行: thingName={thing}")
+        if not cert_pair_ok(cert_path, key_path):
+            raise RuntimeError("発行された証明書と鍵を読み込めません")
+        await runtime.switch_client(make_client(cert_path, key_path))
+        switched = True
+        if not await runtime.wait_connected(CERT_ROTATE_CONNECT_TIMEOUT):
+            raise RuntimeError("新証明書で接続できません")
+        _activate_cert_version(version, previous)
+    except Exception as e:
+        print(f"[CERT] ローテーション失敗: {e}")
+        if switched:
+            await runtime.switch_client(make_client(old_cert, old_key))
+            print("[CERT] 旧証明書に戻しました")
+        shutil.rmtree(os.path.dirname(cert_path), ignore_errors=True)
+        schedule_cert_check(runtime, CERT_ROTATE_RETRY_INTERVAL)
+        return
+    print(f"[CERT] 証明書ローテーション完了: {version}")
+    schedule_cert_check(runtime)
 
 
 # ========= MQTTコールバック =========
-def on_connect(client, userdata, flags, rc):
+async def on_connect(client, flags, rc):
     """接続コールバック"""
     if rc == 0:
         print("[MQTT] 接続成功")
 
-        # 購読開始
-        client.subscribe(TOPIC_CALL, qos=QOS)
-        print(f"[MQTT] 購読開始: {TOPIC_CALL}")
+        # 購読開始（全ロボットの呼出しトピックを 1 回の SUBSCRIBE で）
+        suback = client.subscribe([(r.topic_call, QOS) for r in robots.values()])
 
-        # Shadow GET（初期同期）
-        client.publish(SHADOW_GET, "{}", qos=QOS)
+        for robot in robots.values():
+            # Shadow GET（初期同期）
+            client.publish(robot.shadow_get, "{}", qos=QOS)
 
-        # 初期ステータス発行
-        publish_status(client)
+            # 初期ステータス発行
+            publish_status(client, robot)
 
-        # ハートビート開始
-        hb_thread = threading.Thread(target=heartbeat_loop, args=(client,), daemon=True)
-        hb_thread.start()
-        print(f"[HEARTBEAT] 開始 (間隔: {HEARTBEAT_INTERVAL}秒)")
+        # ハートビート開始（登録済みなら何もしない）
+        start_heartbeats(client)
+        print(
+            f"[HEARTBEAT] 開始 (間隔: {HEARTBEAT_INTERVAL}秒, 対象: {len(robots)}台)"
+        )
+
+        # 切断中に退避したメッセージを送出
+        start_drain(client)
+
+        await suback
+        for robot in robots.values():
+            print(f"[MQTT] 購読開始: {robot.topic_call}")
 
     else:
         print(f"[ERROR] 接続失敗: rc={rc}")
 
 
-def on_message(client, userdata, msg):
+def on_message(client, msg):
     """メッセージ受信コールバック"""
     try:
-        if msg.topic == TOPIC_CALL:
-            handle_call_message(client, msg.payload)
+        robot = robots_by_call_topic.get(msg.topic)
+        if robot:
+            handle_call_message(client, robot, msg.payload)
         else:
             # その他のメッセージ（Shadow応答など）
-            payload = json.loads(msg.payload.decode("utf-8"))
+            payload = codec.decode(msg.payload)
             print(f"[MSG] {msg.topic}: {payload}")
     except Exception as e:
         print(f"[ERROR] メッセージ処理エラー: {e}")
 
 
-def on_disconnect(client, userdata, rc):
+def on_disconnect(client, rc):
     """切断コールバック"""
     print(f"[MQTT] 切断: rc={rc}")
 
 
-def main():
-    """メイン実行関数"""
+def make_client(cert_path, key_path):
+    """MQTT クライアントを作成（全ロボットで共有。証明書ローテーションでは作り直して差し替える）"""
+    client = mqtt.Client(
+        client_id=CLIENT_ID, clean_session=True, protocol=mqtt.MQTTv311
+    )
+
+    # TLS設定（共有コンテキスト。再接続時は TLS セッション再開を試みる）
+    client.tls_set_context(tlsctx.get_context(ROOT_CA_PATH, cert_path, key_path))
+    client.tls_insecure_set(False)
+
+    # LWT設定（MQTT の LWT は 1 接続 1 件のため CLIENT_ID の Thing に設定。
+    # 他のロボットはハートビート欠落で UI 側がオフラインを検知する）
+    lwt_robot = robots.get(CLIENT_ID) or next(iter(robots.values()))
+    lwt_payload = {"state": "offline", "updatedAt": now_ms()}
+    client.will_set(
+        lwt_robot.topic_status, codec.encode_status(lwt_payload), qos=QOS, retain=True
+    )
+    return client
+
+
+async def amain():
+    """メイン実行関数（イベントループ上）"""
     print("=== AMR Server 開始 ===")
-    print(f"Thing: {THING_NAME}")
+    print(f"Things: {', '.join(robots)}")
+    print(f"Client ID: {CLIENT_ID}")
     print(f"Endpoint: {IOT_ENDPOINT}")
     print(f"Shadow: {SHADOW_NAME}")
+    print(f"JSON codec: {codec.codec.name}")
 
-    # MQTTクライアント作成
-    client = mqtt.Client(
-        client_id=THING_NAME, clean_session=True, protocol=mqtt.MQTTv311
-    )
-
-    # TLS設定
+    # MQTTクライアント作成（ローテーション済みの証明書があればそちらを使う）
     try:
-        client.tls_set(
-            ca_certs=ROOT_CA_PATH,
-            certfile=CERT_PATH,
-            keyfile=KEY_PATH,
-            cert_reqs=ssl.CERT_REQUIRED,
-            tls_version=ssl.PROTOCOL_TLS_CLIENT,
-        )
-        client.tls_insecure_set(False)
+        client = make_client(*active_cert())
     except Exception as e:
         print(f"[ERROR] TLS設定エラー: {e}")
         return
 
-    # コールバック設定
-    client.on_connect = on_connect
-    client.on_message = on_message
-    client.on_disconnect = on_disconnect
-
-    # LWT設定
-    lwt_payload = {"state": "offline", "updatedAt": now_ms()}
-    client.will_set(TOPIC_STATUS, json.dumps(lwt_payload), qos=QOS, retain=True)
+    runtime = MqttRuntime(client, on_connect, on_message, on_disconnect)
 
-    # 接続
-    try:
-        print("[MQTT] 接続開始...")
-        client.connect(IOT_ENDPOINT, PORT, keepalive=60)
-        client.loop_start()
+    # 終了シグナル（SIGINT/SIGTERM）でグレースフルに停止
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows は KeyboardInterrupt で停止
 
-        # メインループ
-        while True:
-            time.sleep(1)
+    # スケジューラ・アウトボックス開始
+    scheduler.start(loop)
+    outbox.open()
+    scheduler.schedule(
+        METRICS_INTERVAL, log_metrics, key="metrics", interval=METRICS_INTERVAL
+    )
+    schedule_cert_check(runtime)
 
-    except KeyboardInterrupt:
+    try:
+        await runtime.run(IOT_ENDPOINT, PORT, KEEPALIVE, stop)
         print("\n[EXIT] 終了シグナル受信")
     except Exception as e:
         print(f"[ERROR] 実行エラー: {e}")
     finally:
-        # 最終ステータス送信
-        global current_state
-        with state_lock:
-            current_state = "offline"
-        publish_status(client)
-
-        client.loop_stop()
-        client.disconnect()
+        # 保留中の Shadow を送り、未完了の移動完了ジョブ・ハートビートを止めて最終ステータス送信
+        for robot in robots.values():
+            flush_shadow(runtime, robot)
+        scheduler.cancel_all()
+        for robot in robots.values():
+            robot.state = "offline"
+            publish_status(runtime, robot)
+
+        await runtime.close()
+        outbox.close()
         print("[EXIT] 終了")
 
 
+def main():
+    """メイン実行関数"""
+    if sys.platform == "win32":
+        # 既定の ProactorEventLoop は add_reader/add_writer 非対応
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    try:
+        asyncio.run(amain())
+    except KeyboardInterrupt:
+        print("\n[EXIT] 終了")
+
+
 if __name__ == "__main__":
     main()
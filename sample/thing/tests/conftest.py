@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+"""sample/thing のモジュール（codec / iot_standin / provision_and_verify）を import できるようにする"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
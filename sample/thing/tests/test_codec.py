@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+codec のバックエンド（json / orjson / msgspec のうちインストール済みのもの）が同じ入力に同じ結果を返すか
+- encode / decode の往復
+- 呼出し（decode_call）・ステータス・Shadow reported のスキーマ検証（不正な入力はどれも ValueError）
+- バイナリステータス（CBOR）の往復・不正/途中で切れた入力（cbor2 があれば cbor2 とも突き合わせる）
+
+実行: cd sample/thing && python -m pytest -q tests
+"""
+
+import json
+
+import pytest
+
+import codec
+
+
+@pytest.fixture(params=sorted(codec.BACKENDS))
+def backend(request):
+    return codec.BACKENDS[request.param]()
+
+
+STATUS = {"state": "moving", "updatedAt": 1700000000000, "heartbeatAt": 1700000000500, "requestId": "r-1"}
+
+
+def test_encode_decode_round_trip(backend):
+    obj = {"a": 1, "b": "日本語", "c": [1, 2, None], "d": {"e": True}}
+    data = backend.encode(obj)
+    assert isinstance(data, bytes)
+    assert json.loads(data) == obj
+    assert backend.decode(data) == obj
+
+
+def test_decode_rejects_malformed_json(backend):
+    with pytest.raises(ValueError):
+        backend.decode(b'{"a":')
+
+
+def test_decode_call(backend):
+    msg = backend.decode_call(b'{"requestId":"r-1","dest":"A-01","extra":1}')
+    assert (msg.requestId, msg.dest) == ("r-1", "A-01")
+    msg = backend.decode_call(b"{}")
+    assert (msg.requestId, msg.dest) == (None, None)
+
+
+@pytest.mark.parametrize("data", [b'{"requestId":1}', b'{"dest":["A"]}', b"[]", b'"x"', b"{"])
+def test_decode_call_rejects_invalid(backend, data):
+    with pytest.raises(ValueError):
+        backend.decode_call(data)
+
+
+@pytest.mark.parametrize("payload", [
+    STATUS,
+    {"state": "offline", "updatedAt": 1700000000000},  # LWT（heartbeatAt なし）
+])
+def test_status_round_trip(backend, payload):
+    data = backend.encode_status(payload)
+    assert json.loads(data) == payload
+    assert backend.decode_status(data) == payload
+
+
+@pytest.mark.parametrize("payload", [
+    {"state": 1, "updatedAt": "x"},
+    {"state": "idle", "updatedAt": True},
+    {"state": None, "updatedAt": 1},
+    {"state": "idle"},
+    {"state": "idle", "updatedAt": 1, "unknown": 1},
+])
+def test_encode_status_rejects_invalid(backend, payload):
+    with pytest.raises(ValueError):
+        backend.encode_status(payload)
+
+
+@pytest.mark.parametrize("data", [b'{"state":"idle"}', b'{"state":"idle","updatedAt":"x"}', b"[]", b"{"])
+def test_decode_status_rejects_invalid(backend, data):
+    with pytest.raises(ValueError):
+        backend.decode_status(data)
+
+
+def test_encode_shadow(backend):
+    reported = {"state": "idle", "version": 3, "updatedAt": 1700000000000}
+    assert json.loads(backend.encode_shadow(reported)) == {"state": {"reported": reported}}
+    # 変更のあったキーだけを送る場合（state 省略）
+    partial = {"version": 4, "updatedAt": 1700000000001}
+    assert json.loads(backend.encode_shadow(partial)) == {"state": {"reported": partial}}
+
+
+@pytest.mark.parametrize("reported", [
+    {"state": "idle", "version": "3", "updatedAt": 1},
+    {"state": 1, "version": 3, "updatedAt": 1},
+    {"state": "idle", "updatedAt": 1},
+    {"state": "idle", "version": 3, "updatedAt": 1, "unknown": 1},
+])
+def test_encode_shadow_rejects_invalid(backend, reported):
+    with pytest.raises(ValueError):
+        backend.encode_shadow(reported)
+
+
+# ========= バイナリステータス（CBOR） =========
+@pytest.mark.parametrize("payload", [
+    STATUS,
+    {"state": "idle", "updatedAt": 1700000000000, "heartbeatAt": 1700000000000},
+    {"state": "offline", "updatedAt": 1700000000000},  # LWT（heartbeatAt なし）
+    {"state": "charging", "updatedAt": 0, "heartbeatAt": 70000, "requestId": "日本語"},  # 未知の状態は文字列
+])
+def test_status_binary_round_trip(payload):
+    data = codec.encode_status_binary(payload)
+    assert data[0] == codec.STATUS_BINARY_VERSION
+    assert codec.decode_status_binary(data) == payload
+
+
+def test_status_binary_matches_cbor2():
+    cbor2 = pytest.importorskip("cbor2")
+    data = codec.encode_status_binary(STATUS)
+    assert cbor2.loads(data[1:]) == [1, STATUS["updatedAt"], 500, "r-1"]
+    items = [0, 2 ** 40, None, "x" * 300]
+    assert codec.decode_status_binary(bytes([codec.STATUS_BINARY_VERSION]) + cbor2.dumps(items)) == {
+        "state": "idle", "updatedAt": 2 ** 40, "requestId": "x" * 300,
+    }
+
+
+def test_status_binary_rejects_truncated():
+    data = codec.encode_status_binary(dict(STATUS, requestId="x" * 300))
+    for n in range(len(data)):
+        with pytest.raises(ValueError):
+            codec.decode_status_binary(data[:n])
+
+
+@pytest.mark.parametrize("data", [
+    b"\x02\x84\x00\x00\x00\xf6",  # 未対応のバージョン
+    b"\x01\x84\x00\x00\x00\xf6\x00",  # 余分なデータ
+    b"\x01\x83\x00\x00\x00",  # 要素数が違う
+    b"\x01\x84\x09\x00\x00\xf6",  # 未知の状態コード
+    b"\x01\x84\x00\xf6\x00\xf6",  # updatedAt が null
+    b"\x01\x84\x00\x00\x00\x01",  # requestId が整数
+])
+def test_status_binary_rejects_invalid(data):
+    with pytest.raises(ValueError):
+        codec.decode_status_binary(data)
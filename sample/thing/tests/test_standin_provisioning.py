@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+iot_standin（ローカルの IoT Core スタンドイン）に対する provision_and_verify の結合テスト
+- 1 台分のフロー（claim 接続 → CreateKeysAndCertificate → RegisterThing → Shadow 検証）
+- --batch（claim 接続の使い回し・スロットリング時の再試行・再試行の打ち切り）
+- MqttSession の再接続時の再購読
+
+実行: cd sample/thing && python -m pytest -q tests
+"""
+
+import asyncio
+import json
+import os
+import stat
+import threading
+import time
+
+import pytest
+
+import iot_standin
+import provision_and_verify as pv
+
+
+@pytest.fixture
+def standin(monkeypatch):
+    """空きポートでスタンドインを別スレッドのイベントループで起動し、pv の接続先をそこへ向ける"""
+    broker = iot_standin.Broker()
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(iot_standin.start(broker))
+    port = server.sockets[0].getsockname()[1]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    broker.loop = loop  # テストからブローカー側の操作を投入するため
+
+    monkeypatch.setattr(pv, "IOT_ENDPOINT", "127.0.0.1")
+    monkeypatch.setattr(pv, "PORT", port)
+    monkeypatch.setattr(pv, "USE_TLS", False)
+    monkeypatch.setattr(pv, "BATCH_BACKOFF_BASE", 0.01)
+    monkeypatch.setattr(pv, "BATCH_BACKOFF_MAX", 0.05)
+    yield broker
+
+    loop.call_soon_threadsafe(server.close)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5)
+
+
+def throttle_first(broker, n):
+    """最初の n 件の API 要求だけ 429 で拒否する（確率ではなく決定的に）"""
+    original = broker._throttled
+    remaining = [n]
+    lock = threading.Lock()
+
+    def throttled(session, base):
+        with lock:
+            if remaining[0] <= 0:
+                return False
+            remaining[0] -= 1
+        broker.throttle = 1.0
+        try:
+            return original(session, base)
+        finally:
+            broker.throttle = 0.0
+
+    broker._throttled = throttled
+
+
+def write_csv(path, serials):
+    path.write_text("SerialNumber,ThingName\n" + "".join(f"{s},AMR-{s}\n" for s in serials), encoding="utf-8")
+    return str(path)
+
+
+def read_report(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_load_batch(tmp_path):
+    rows = pv.load_batch(write_csv(tmp_path / "devices.csv", ["001", "002"]))
+    assert rows == [{"SerialNumber": "001", "ThingName": "AMR-001"}, {"SerialNumber": "002", "ThingName": "AMR-002"}]
+
+
+@pytest.mark.parametrize("serials", [
+    ["001", "001"],
+    ["ab", "AB"],  # 大文字小文字だけ違う（Windows では同じファイル）
+    ["../x"],
+    ["a/b"],
+    ["a\\b"],
+    [".."],
+])
+def test_load_batch_rejects_unsafe_serials(tmp_path, serials):
+    with pytest.raises(ValueError):
+        pv.load_batch(write_csv(tmp_path / "devices.csv", serials))
+
+
+def test_provision_device(standin, tmp_path):
+    cert, key = str(tmp_path / "dev.crt"), str(tmp_path / "dev.key")
+
+    result = pv.provision_device({"SerialNumber": "001", "ThingName": "AMR-001"}, cert, key)
+
+    assert result["thingName"] == "AMR-001"
+    assert result["verified"] is True
+    assert standin.stats["create"] == 1 and standin.stats["provision"] == 1
+    for path in (cert, key):
+        assert os.path.exists(path)
+        if os.name == "posix":
+            assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+
+def test_run_batch_reuses_claim_sessions(standin, tmp_path):
+    serials = [f"{i:03d}" for i in range(6)]
+    report = str(tmp_path / "report.json")
+
+    ok = pv.run_batch(write_csv(tmp_path / "devices.csv", serials), workers=3, retries=0,
+                      out_dir=str(tmp_path / "fleet"), report=report, claim_sessions=2)
+
+    assert ok
+    summary = read_report(report)["summary"]
+    assert summary["succeeded"] == len(serials)
+    assert summary["claimConnects"] == 2
+    assert standin.stats["provision"] == len(serials)
+    for s in serials:
+        assert os.path.exists(tmp_path / "fleet" / f"{s}.crt")
+
+
+def test_run_batch_retries_throttled_requests(standin, tmp_path):
+    throttle_first(standin, 3)
+    serials = [f"{i:03d}" for i in range(4)]
+    report = str(tmp_path / "report.json")
+
+    ok = pv.run_batch(write_csv(tmp_path / "devices.csv", serials), workers=2, retries=3,
+                      out_dir=str(tmp_path / "fleet"), report=report, claim_sessions=1)
+
+    assert ok
+    data = read_report(report)
+    assert data["summary"]["succeeded"] == len(serials)
+    assert data["summary"]["retried"] >= 1
+    assert sum(r["attempts"] for r in data["results"]) == len(serials) + 3
+    assert standin.stats["throttled"] == 3
+
+
+def test_run_batch_gives_up_after_retries(standin, tmp_path):
+    standin.throttle = 1.0
+    report = str(tmp_path / "report.json")
+
+    ok = pv.run_batch(write_csv(tmp_path / "devices.csv", ["001", "002"]), workers=2, retries=1,
+                      out_dir=str(tmp_path / "fleet"), report=report, claim_sessions=0)
+
+    assert not ok
+    data = read_report(report)
+    assert data["summary"]["failed"] == 2
+    for r in data["results"]:
+        assert r["attempts"] == 2
+        assert "スロットリング" in r["error"]
+        assert r["certFile"] is None
+
+
+def drop_connections(broker):
+    """ブローカー側から全接続を切断する"""
+    for s in list(broker.sessions):
+        broker.loop.call_soon_threadsafe(s.writer.close)
+
+
+def wait_until(cond, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > deadline:
+            raise TimeoutError
+        time.sleep(0.05)
+
+
+def test_session_resubscribes_without_keeping_subacks(standin):
+    session = pv.MqttSession(client_id="resub-test", certfile="", keyfile="")
+    session.client.reconnect_delay_set(min_delay=1, max_delay=1)
+    session.connect()
+    try:
+        session.subscribe(["test/resub"])
+        for n in (2, 3):
+            drop_connections(standin)
+            wait_until(lambda: standin.stats["connects"] >= n and session.is_connected())
+
+        # 再購読の SUBACK は届き次第捨てられ、購読自体は有効
+        mark = session.mark()
+        got = None
+        for _ in range(20):
+            session.publish_json("test/resub", {"n": 1})
+            got = session.wait_message(["test/resub"], 0.5, since=mark)
+            if got:
+                break
+        assert got == ("test/resub", {"n": 1})
+        assert session._subacks == {}
+        assert session._unawaited == set()
+    finally:
+        session.disconnect()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+役割: MQTT クライアント用 TLS コンテキストの共有とセッション再開（server.py / provision_and_verify.py 共通）
+- (RootCA, 証明書, 鍵) ごとに SSLContext を 1 つだけ作り、クライアント間・再接続間で使い回す
+  （ファイルが更新されたら別のコンテキストを作る＝証明書差し替え後は新しい鍵で接続）
+- 接続先ホストごとに直近の TLS セッションを保持し、再接続時はセッション再開（短縮ハンドシェイク）を試みる
+- ハンドシェイク時間・再開成功数を集計（stats()）
+
+使い方:
+    client.tls_set_context(tlsctx.get_context(ROOT_CA, CERT_PATH, KEY_PATH))
+"""
+
+import os
+import ssl
+import threading
+import time
+
+
+class _TimedSSLSocket(ssl.SSLSocket):
+    """ハンドシェイクを計測し、終了時に TLS セッションをコンテキストへ返す"""
+
+    def do_handshake(self, *args, **kwargs):
+        t0 = time.perf_counter()
+        super().do_handshake(*args, **kwargs)
+        self.context._handshake_done(self, time.perf_counter() - t0)
+
+    def close(self):
+        # TLS 1.3 のセッションチケットはハンドシェイク後に届くため、切断時にも取り直す
+        self.context._save_session(self)
+        super().close()
+
+
+class ResumingContext(ssl.SSLContext):
+    """セッション再開とハンドシェイク計測を行う SSLContext（paho の wrap_socket から使われる）"""
+
+    sslsocket_class = _TimedSSLSocket
+
+    def __new__(cls, protocol=ssl.PROTOCOL_TLS_CLIENT, *args, **kwargs):
+        self = super().__new__(cls, protocol, *args, **kwargs)
+        self._lock = threading.Lock()
+        self._sessions = {}  # server_hostname -> ssl.SSLSession
+        self.handshakes = 0
+        self.resumed = 0
+        self.handshake_total = 0.0
+        self.handshake_max = 0.0
+        return self
+
+    def wrap_socket(self, sock, *args, server_hostname=None, session=None, **kwargs):
+        if session is None and server_hostname is not None:
+            with self._lock:
+                session = self._sessions.get(server_hostname)
+        sslsock = super().wrap_socket(sock, *args, server_hostname=server_hostname, session=session, **kwargs)
+        sslsock._resume_key = server_hostname
+        return sslsock
+
+    def _save_session(self, sslsock):
+        key = getattr(sslsock, "_resume_key", None)
+        if key is None:
+            return
+        try:
+            session = sslsock.session
+        except (ValueError, OSError):
+            return
+        if session is None:
+            return
+        with self._lock:
+            # チケット付きのセッションを優先（チケット到着前の版で上書きしない）
+            current = self._sessions.get(key)
+            if session.has_ticket or current is None or not current.has_ticket:
+                self._sessions[key] = session
+
+    def _handshake_done(self, sslsock, elapsed: float):
+        with self._lock:
+            self.handshakes += 1
+            self.handshake_total += elapsed
+            self.handshake_max = max(self.handshake_max, elapsed)
+            if sslsock.session_reused:
+                self.resumed += 1
+        self._save_session(sslsock)
+
+
+_contexts = {}  # (ca, cert, key, mtime...) -> ResumingContext
+_contexts_lock = threading.Lock()
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except (OSError, TypeError):
+        return None
+
+
+def get_context(ca_certs: str, certfile: str, keyfile: str) -> ResumingContext:
+    """(RootCA, 証明書, 鍵) に対応する共有 SSLContext を返す（無ければ作成）"""
+    key = (ca_certs, certfile, keyfile, _mtime(ca_certs), _mtime(certfile), _mtime(keyfile))
+    with _contexts_lock:
+        ctx = _contexts.get(key)
+        if ctx is None:
+            ctx = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+            ctx.load_verify_locations(cafile=ca_certs)
+            ctx.load_cert_chain(certfile=certfile, keyfile=keyfile)
+            ctx.verify_mode = ssl.CERT_REQUIRED
+            ctx.check_hostname = True
+            # 同じファイルの古い版のコンテキストは破棄（証明書差し替え後）
+            for old in [k for k in _contexts if k[:3] == key[:3]]:
+                del _contexts[old]
+            _contexts[key] = ctx
+        return ctx
+
+
+def stats() -> dict:
+    """全コンテキスト合計のハンドシェイク統計"""
+    with _contexts_lock:
+        ctxs = list(_contexts.values())
+    handshakes = sum(c.handshakes for c in ctxs)
+    total = sum(c.handshake_total for c in ctxs)
+    return {
+        "contexts": len(ctxs),
+        "handshakes": handshakes,
+        "resumed": sum(c.resumed for c in ctxs),
+        "handshakeAvgMs": round(total / handshakes * 1000, 1) if handshakes else 0.0,
+        "handshakeMaxMs": round(max((c.handshake_max for c in ctxs), default=0.0) * 1000, 1),
+    }